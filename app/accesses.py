@@ -1,7 +1,6 @@
 from django.core.exceptions import PermissionDenied
 
-from .functions import is_pi_in_area, get_users_in_area_by_pi
-from key_request.functions import is_room_approver, is_approval_group_coordinator
+from .permissions import get_permissions
 
 def access_admin_only(view_func):
     """ Access an admin only """
@@ -21,7 +20,7 @@ def access_pi_admin_key_request(view_func):
     """
 
     def wrap(request, *args, **kwargs):
-        if request.user.is_superuser or is_room_approver(request.user.id):
+        if request.user.is_superuser or get_permissions(request).is_room_approver:
             return view_func(request, *args, **kwargs)
         else:
             raise PermissionDenied
@@ -30,7 +29,7 @@ def access_pi_admin_key_request(view_func):
 
 def access_group_coordinator_admin_key_request(view_func):
     def wrap(request, *args, **kwargs):
-        if request.user.is_superuser or is_approval_group_coordinator(request.user.id):
+        if request.user.is_superuser or get_permissions(request).is_group_coordinator:
             return view_func(request, *args, **kwargs)
         else:
             raise PermissionDenied
@@ -44,7 +43,7 @@ def access_pi_admin(view_func):
     """
 
     def wrap(request, *args, **kwargs):
-        if request.user.is_superuser or is_pi_in_area(request.user.id, kwargs['area_id']):
+        if request.user.is_superuser or get_permissions(request).is_pi_in_area(kwargs['area_id']):
             return view_func(request, *args, **kwargs)
         else:
             raise PermissionDenied
@@ -59,8 +58,7 @@ def access_loggedin_user_pi_admin(view_func):
     """
 
     def wrap(request, *args, **kwargs):
-        user_id = kwargs['user_id']
-        if request.user.id == user_id or request.user.is_superuser or user_id in get_users_in_area_by_pi(request.user.id):
+        if get_permissions(request).can_view_user(kwargs['user_id']):
             return view_func(request, *args, **kwargs)
         else:
             raise PermissionDenied
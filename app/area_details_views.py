@@ -19,6 +19,7 @@ from key_request.models import Room
 from lfs_lab_cert_tracker.models import Cert, LabCert, UserLab
 from .forms import UserAreaForm, AreaTrainingForm
 from .accesses import access_admin_only, access_pi_admin
+from .permissions import get_permissions
 from . import functions as func
 # from .utils import *
 
@@ -43,7 +44,7 @@ class Index(LoginRequiredMixin, View):
 
         return render(request, 'app/area_details/index.html', {
             'area': self.area,
-            'is_pi': func.is_pi_in_area(request.user.id, self.area.id),
+            'is_pi': get_permissions(request).is_pi_in_area(self.area.id),
             'required_certs': Cert.objects.filter(labcert__lab_id=self.area.id).order_by('name'),
             'users_in_area': func.get_users_in_area(self.area)
         })
@@ -181,22 +182,12 @@ class UsersMissingTrainings(LoginRequiredMixin, View):
     
     @method_decorator(require_GET)
     def get(self, request, *args, **kwargs):
-        required_certs = Cert.objects.filter(labcert__lab_id=self.area.id).order_by('name')
-
-        users_missing_certs = []
-        for user_lab in self.area.userlab_set.all():
-            certs = Cert.objects.filter(usercert__user_id=user_lab.user.id).distinct()
-            missing_certs = required_certs.difference(certs)
-            if len(missing_certs) > 0:
-                users_missing_certs.append({
-                    'user': user_lab.user, 
-                    'missing_certs': missing_certs.order_by('name')
-                })
-        
+        missing_compliance = func.get_missing_compliance().filter(lab_id=self.area.id)
+
         return render(request, 'app/area_details/users_missing_trainings.html', {
             'area': self.area,
-            'is_pi': func.is_pi_in_area(request.user.id, self.area.id),
-            'users_missing_certs': users_missing_certs
+            'is_pi': get_permissions(request).is_pi_in_area(self.area.id),
+            'users_missing_certs': func.group_compliance_by_user(missing_compliance, 'missing_certs')
         })
     
 
@@ -214,23 +205,12 @@ class UsersExpiredTrainings(LoginRequiredMixin, View):
     
     @method_decorator(require_GET)
     def get(self, request, *args, **kwargs):
-        required_certs = Cert.objects.filter(labcert__lab_id=self.area.id).order_by('name')
-
-        users_expired_certs = []
-        for user_lab in self.area.userlab_set.all():
-            expired_certs = func.get_user_expired_certs(user_lab.user)
-            expired_certs_in_lab = required_certs.intersection(expired_certs)
-
-            if len(expired_certs_in_lab) > 0:
-                users_expired_certs.append({
-                    'user': user_lab.user, 
-                    'expired_certs': expired_certs_in_lab.order_by('name')
-                })
+        expired_compliance = func.get_expired_compliance().filter(lab_id=self.area.id)
 
         return render(request, 'app/area_details/users_expired_trainings.html', {
             'area': self.area,
-            'is_pi': func.is_pi_in_area(request.user.id, self.area.id),
-            'users_expired_certs': users_expired_certs
+            'is_pi': get_permissions(request).is_pi_in_area(self.area.id),
+            'users_expired_certs': func.group_compliance_by_user(expired_compliance, 'expired_certs')
         })
     
 
@@ -250,7 +230,7 @@ class AddUserToArea(LoginRequiredMixin, View):
     def get(self, request, *args, **kwargs):
         return render(request, 'app/area_details/add_user_to_area.html', {
             'area': self.area,
-            'is_pi': func.is_pi_in_area(request.user.id, self.area.id),
+            'is_pi': get_permissions(request).is_pi_in_area(self.area.id),
             'user_area_form': UserAreaForm(initial={ 'lab': self.area.id }),
             'recent_users': func.get_users_in_area(self.area)[:15]
         })
@@ -318,7 +298,7 @@ class AddTrainingToArea(LoginRequiredMixin, View):
 
         return render(request, 'app/area_details/add_training_to_area.html', {
             'area': self.area,
-            'is_pi': func.is_pi_in_area(request.user.id, self.area.id),
+            'is_pi': get_permissions(request).is_pi_in_area(self.area.id),
             'area_training_form': AreaTrainingForm(initial={ 'lab': self.area.id }),
             'required_trainings': Cert.objects.filter(labcert__lab_id=self.area.id).order_by('name')
         })
@@ -1,7 +1,8 @@
 from django.conf import settings
 from django.shortcuts import get_object_or_404
-from django.db.models import Q, F, Max
-from django.core.mail import send_mail
+from django.db.models import Q, F, Max, Count, Exists, OuterRef
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.db import transaction, IntegrityError
 from django.urls import resolve
 from django.core.validators import validate_email
 from django.core.exceptions import ValidationError
@@ -13,6 +14,8 @@ from key_request.models import *
 
 from datetime import date
 
+from .permissions import invalidate_permissions
+
 
 # User
 def get_users(option=None):
@@ -63,14 +66,122 @@ def get_user_certs_with_info(user):
             check.append(uc.cert.id)
     return user_certs
 
+def get_latest_user_certs(user_ids=None):
+    """
+    Get the current record of each (user, cert), which is the one with the latest expiry date.
+    Records whose expiry date equals the completion date never expire, so they are not included.
+    user_ids (a list or a queryset of IDs) limits the records before they are de-duplicated
+    """
+
+    latest = UserCert.objects.exclude(completion_date=F('expiry_date'))
+    if user_ids is not None:
+        latest = latest.filter(user_id__in=user_ids)
+
+    latest = latest.order_by('user_id', 'cert_id', '-expiry_date', '-id').distinct('user_id', 'cert_id')
+    return UserCert.objects.filter(id__in=latest.values('id'))
+
 def get_user_missing_certs(user_id):
-    required_certs = Cert.objects.filter(labcert__lab__userlab__user_id=user_id).distinct()
-    certs = Cert.objects.filter(usercert__user_id=user_id).distinct()
-    return required_certs.difference(certs).order_by('name')
+    return Cert.objects.filter(id__in=get_missing_compliance().filter(user_id=user_id).values('cert_id')).order_by('name')
 
 def get_user_expired_certs(user):
-    usercerts_with_max_expiry_date = user.usercert_set.values('cert_id').annotate(max_expiry_date=Max('expiry_date')).filter( Q(max_expiry_date__lt=date.today()) & ~Q(completion_date=F('expiry_date')) )
-    return Cert.objects.filter(id__in=[item['cert_id'] for item in usercerts_with_max_expiry_date])
+    """ Get every cert of a user whose latest record has expired, whether or not an area requires it """
+    return Cert.objects.filter(id__in=get_latest_user_certs([user.id]).filter(expiry_date__lt=date.today()).values('cert_id')).order_by('name')
+
+
+def get_new_user_certs(chunk):
+    """ Get the user certs of a chunk whose (user, cert, completion_date) neither exists nor repeats in the chunk """
+
+    keys = set(UserCert.objects.filter(
+        user_id__in=set(uc.user_id for uc in chunk),
+        cert_id__in=set(uc.cert_id for uc in chunk)
+    ).values_list('user_id', 'cert_id', 'completion_date'))
+
+    new_user_certs = []
+    for uc in chunk:
+        key = (uc.user_id, uc.cert_id, uc.completion_date)
+        if key not in keys:
+            new_user_certs.append(uc)
+            keys.add(key)
+    return new_user_certs
+
+
+def bulk_ingest_user_certs(user_certs, batch_size=None):
+    """
+    Insert user certs in chunks, each in its own transaction, skipping rows which already exist
+    with the same (user, cert, completion_date). Returns the counts of each chunk, e.g. [{ 'inserted': 490, 'skipped': 10 }, ...]
+    """
+
+    if batch_size is None:
+        batch_size = getattr(settings, 'USER_CERT_BULK_BATCH_SIZE', 500)
+
+    counts = []
+    for i in range(0, len(user_certs), batch_size):
+        chunk = user_certs[i:i + batch_size]
+
+        # If someone else inserts one of the rows in the meantime, the insert fails and the chunk is filtered again
+        try:
+            with transaction.atomic():
+                new_user_certs = get_new_user_certs(chunk)
+                UserCert.objects.bulk_create(new_user_certs)
+        except IntegrityError:
+            with transaction.atomic():
+                new_user_certs = get_new_user_certs(chunk)
+                UserCert.objects.bulk_create(new_user_certs)
+
+        if len(new_user_certs) > 0:
+            update_user_compliance(list(set(uc.user_id for uc in chunk)), list(set(uc.cert_id for uc in chunk)))
+
+        counts.append({ 'inserted': len(new_user_certs), 'skipped': len(chunk) - len(new_user_certs) })
+
+    return counts
+
+
+# UserCompliance
+
+def get_missing_compliance():
+    """ Get compliance rows of required trainings which have not been uploaded """
+    return UserCompliance.objects.filter(state=UserCompliance.MISSING)
+
+def get_expired_compliance():
+    """ Get compliance rows of required trainings whose latest record has expired """
+    return UserCompliance.objects.filter(state=UserCompliance.COMPLETED, latest_expiry_date__lt=date.today())
+
+def get_num_missing_certs(user_ids):
+    """ Get the number of missing certs of each user, e.g. { user_id: 2, ... } """
+
+    missing_compliance = get_missing_compliance().filter(user_id__in=user_ids).values('user_id').annotate(num_certs=Count('cert_id', distinct=True))
+    return { item['user_id']: item['num_certs'] for item in missing_compliance }
+
+def get_users_with_missing_trainings():
+    """ Get active users who have at least one missing training """
+    return get_users('active').filter(Exists(get_missing_compliance().filter(user_id=OuterRef('pk'))))
+
+def get_users_with_missing_or_expired_trainings():
+    """ Get active users who have at least one missing or expired training """
+
+    compliance = get_missing_compliance() | get_expired_compliance()
+    return get_users('active').filter(Exists(compliance.filter(user_id=OuterRef('pk'))))
+
+def get_missing_trainings_report():
+    """ Get active users who have missing trainings, grouped by user with the names of the trainings """
+
+    return get_missing_compliance().filter(user__is_active=True).values(
+        'user_id', 'user__username', 'user__first_name', 'user__last_name'
+    ).annotate(
+        num_missing_certs=Count('cert_id', distinct=True),
+        missing_certs=ArrayAgg('cert__name', distinct=True, order_by='cert__name')
+    ).order_by('user__last_name', 'user__first_name', 'user_id')
+
+def group_compliance_by_user(compliance, key):
+    """ Group compliance rows by user, e.g. [{ 'user': user, key: [cert, ...] }, ...] """
+
+    users = {}
+    for row in compliance.select_related('user', 'cert').order_by('user_id', 'cert__name'):
+        if row.user_id not in users:
+            users[row.user_id] = { 'user': row.user, key: [] }
+        users[row.user_id][key].append(row.cert)
+
+    return list(users.values())
 
 
 # UserLab
@@ -122,17 +233,8 @@ def is_pi_in_area(user_id, area_id):
 def get_users_in_area_by_pi(user_id):
     """ Get a list of users in PI's area """
 
-    users = set()
-
-    userlabs = UserLab.objects.filter( Q(user_id=user_id) & Q(role=UserLab.PRINCIPAL_INVESTIGATOR) )
-    if userlabs.exists():
-        for userlab in userlabs:
-            labs = UserLab.objects.filter(lab=userlab.lab.id)
-            if labs.exists():
-                for lab in labs:
-                    users.add(lab.user.id)
-
-    return list(users)
+    userlabs = UserLab.objects.filter(lab__userlab__user_id=user_id, lab__userlab__role=UserLab.PRINCIPAL_INVESTIGATOR)
+    return list(userlabs.values_list('user_id', flat=True).distinct())
 
 
 def get_lab_by_id(lab_id):
@@ -158,6 +260,7 @@ def update_or_create_areas_to_user(user, areas):
             if userlab.first().role != int(role):
                 updated = userlab.update(role=role)
                 if updated:
+                    invalidate_permissions()
                     report['updated'].append(lab.name)
         else:
             created = UserLab.objects.create(user=user, lab=lab, role=role)
@@ -235,7 +338,7 @@ def welcome_message():
 
 
 def send_info_email(user):
-    """ Send an email when adding a user to a lab and creating new users """
+    """ Queue an email to a new user, which an admin sends on purpose. Returns the result of enqueue_email """
 
     title = 'You are added to LFS TRMS'
 
@@ -249,10 +352,7 @@ def send_info_email(user):
     </div>
     '''.format(user.first_name, user.last_name, welcome_message(), settings.SITE_URL)
 
-    sent = send_mail(title, message, settings.EMAIL_FROM, [ user.email ], fail_silently=False, html_message=message)
-    if not sent:
-        sent.error = 'Django send_mail went wrong'
-    return sent
+    return enqueue_email(user.email, title, message, get_unique_key())
 
 
 
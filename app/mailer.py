@@ -0,0 +1,176 @@
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.utils import timezone
+from django.db import transaction
+from django.db.models import Q
+from concurrent.futures import ThreadPoolExecutor
+import smtplib
+import threading
+import time
+from datetime import timedelta
+
+from lfs_lab_cert_tracker.models import Outbox, enqueue_emails, enqueue_email, get_unique_key, QUEUED, ALREADY_QUEUED, NOT_QUEUED
+from .utils import RateLimiter
+
+
+# Settings
+
+def get_pool_size():
+    """ The number of SMTP connections (and threads) used at the same time """
+    return getattr(settings, 'EMAIL_POOL_SIZE', 4)
+
+def get_max_per_second():
+    """ The maximum number of emails sent per second, 0 for no limit """
+    return getattr(settings, 'EMAIL_MAX_PER_SECOND', 10)
+
+def get_max_retries():
+    return getattr(settings, 'EMAIL_MAX_RETRIES', 3)
+
+def get_retry_backoff():
+    """ Seconds to wait before the first retry, doubled on each retry """
+    return getattr(settings, 'EMAIL_RETRY_BACKOFF', 1)
+
+def get_claim_timeout():
+    """ Seconds after which emails claimed by a worker that died are sent again """
+    return getattr(settings, 'EMAIL_CLAIM_TIMEOUT', 600)
+
+
+class ConnectionPool:
+    """ Keep one open connection per thread, reused for every email the thread sends """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def get(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = get_connection(fail_silently=False)
+            connection.open()
+            self.local.connection = connection
+            with self.lock:
+                self.connections.append(connection)
+        return connection
+
+    def discard(self):
+        """ Drop the connection of the current thread after an error, so that the next email reconnects """
+
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            self.local.connection = None
+            with self.lock:
+                self.connections.remove(connection)
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def close_all(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+
+def is_transient_error(e):
+    """ Check whether an error may go away by retrying, e.g. a dropped connection or a 4xx reply """
+
+    if isinstance(e, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    if isinstance(e, smtplib.SMTPResponseException):
+        return 400 <= e.smtp_code < 500
+    if isinstance(e, smtplib.SMTPException):
+        return False
+    return isinstance(e, OSError)
+
+
+def send_outbox(pool, limiter, outbox):
+    """ Send an outbox email, retrying transient errors with backoff. Returns (status, attempts, error) """
+
+    attempts = 0
+    while True:
+        attempts += 1
+        limiter.wait()
+        try:
+            email = EmailMessage(outbox.subject, outbox.message, outbox.sender, [outbox.receiver], connection=pool.get())
+            email.content_subtype = 'html'
+            email.send()
+            return Outbox.SENT, attempts, ''
+        except Exception as e:
+            pool.discard()
+            if attempts > get_max_retries() or not is_transient_error(e):
+                return Outbox.FAILED, attempts, '{0}: {1}'.format(type(e).__name__, e)
+
+        time.sleep(get_retry_backoff() * 2 ** (attempts - 1))
+
+
+def deliver(outboxes):
+    """ Send outbox emails concurrently over a pool of connections and save the results """
+
+    outboxes = list(outboxes)
+    if len(outboxes) == 0:
+        return outboxes
+
+    pool = ConnectionPool()
+    limiter = RateLimiter(get_max_per_second())
+    try:
+        with ThreadPoolExecutor(max_workers=min(get_pool_size(), len(outboxes))) as executor:
+            results = list(executor.map(lambda outbox: send_outbox(pool, limiter, outbox), outboxes))
+    finally:
+        pool.close_all()
+
+    now = timezone.now()
+    for outbox, (status, attempts, error) in zip(outboxes, results):
+        outbox.status = status
+        outbox.attempts += attempts
+        outbox.error = error
+        if status == Outbox.SENT:
+            outbox.sent_at = now
+
+    Outbox.objects.bulk_update(outboxes, ['status', 'attempts', 'error', 'sent_at'])
+
+    num_failed = len([outbox for outbox in outboxes if outbox.status == Outbox.FAILED])
+    print('Mailer: sent {0}, failed {1}'.format(len(outboxes) - num_failed, num_failed))
+    return outboxes
+
+
+def claim(batch_size):
+    """ Mark a batch of pending emails as sending, skipping rows locked by other workers """
+
+    now = timezone.now()
+    stale = now - timedelta(seconds=get_claim_timeout())
+    with transaction.atomic():
+        outboxes = list(
+            Outbox.objects.select_for_update(skip_locked=True).filter(
+                Q(status=Outbox.PENDING) | Q(status=Outbox.SENDING, claimed_at__lt=stale)
+            ).order_by('id')[:batch_size]
+        )
+        Outbox.objects.filter(id__in=[outbox.id for outbox in outboxes]).update(status=Outbox.SENDING, claimed_at=now)
+
+    for outbox in outboxes:
+        outbox.status = Outbox.SENDING
+        outbox.claimed_at = now
+    return outboxes
+
+
+def send_pending(batch_size=100):
+    """ Send pending emails in batches until the outbox is drained """
+
+    sent = []
+    while True:
+        outboxes = claim(batch_size)
+        if len(outboxes) == 0:
+            break
+        sent += deliver(outboxes)
+    return sent
+
+
+def send_emails(emails):
+    """ Queue emails and send the outbox right away, for callers which already run in the background """
+
+    enqueue_emails(emails)
+    return send_pending()
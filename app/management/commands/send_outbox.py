@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+import time
+
+from app import mailer
+
+
+class Command(BaseCommand):
+    help = 'Send pending emails in the outbox in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Number of emails claimed at a time')
+        parser.add_argument('--forever', action='store_true', help='Keep polling the outbox instead of exiting once it is drained')
+        parser.add_argument('--interval', type=float, default=5, help='Seconds to wait between polls with --forever')
+
+    def handle(self, *args, **options):
+        while True:
+            sent = mailer.send_pending(options['batch_size'])
+            if len(sent) > 0:
+                self.stdout.write('Outbox: processed {0} emails'.format(len(sent)))
+
+            if not options['forever']:
+                break
+            time.sleep(options['interval'])
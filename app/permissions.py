@@ -0,0 +1,168 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils.functional import cached_property
+import time
+
+from lfs_lab_cert_tracker.models import UserLab
+from key_request.models import Room, ApprovalGroupRole
+
+
+# Permissions of each user are cached under a version, which is bumped whenever
+# UserLab, Room.managers, Room.groups or ApprovalGroupRole change. The version and the
+# permissions are kept in the 'permissions' cache of CACHES, which every process shares,
+# so a change takes effect in every process on its next request
+
+CACHE_ALIAS = 'permissions'
+VERSION_KEY = 'permissions:version'
+
+
+def get_cache():
+    """ The cache shared by every process, or None if CACHES has no 'permissions' cache, in which case nothing is cached """
+
+    if CACHE_ALIAS in settings.CACHES:
+        return caches[CACHE_ALIAS]
+    return None
+
+
+def new_version():
+    """ A version which no earlier version can equal, even if the version key has been evicted """
+    return time.time_ns()
+
+
+def get_version(cache):
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, new_version(), None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def bump_version():
+    cache = get_cache()
+    if cache is None:
+        return
+
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, new_version(), None)
+
+
+def invalidate_permissions():
+    """ Invalidate cached permissions now, and again once the transaction commits so that nothing cached in the meantime is kept """
+
+    bump_version()
+    transaction.on_commit(bump_version)
+
+
+def is_room_approver(user_id):
+    """ A user who manages a room or belongs to a group of a room, read from the set of room approvers in the shared cache """
+
+    cache = get_cache()
+    if cache is None:
+        return Room.objects.filter(Q(managers__id=user_id) | Q(groups__roles__user_id=user_id)).exists()
+
+    key = 'permissions:{0}:room_approvers'.format(get_version(cache))
+    user_ids = cache.get(key)
+    if user_ids is None:
+        managers = Room.managers.through.objects.values_list('user_id')
+        group_members = ApprovalGroupRole.objects.filter(group__group_rooms__isnull=False).values_list('user_id')
+        user_ids = set(user_id for user_id, in managers.union(group_members))
+        cache.set(key, user_ids)
+    return user_id in user_ids
+
+
+def load_permissions(user_id):
+    """ Load the permissions of a user in a handful of queries """
+
+    pi_area_ids = set()
+    supervised_user_ids = set()
+    for lab_id, member_id in UserLab.objects.filter(lab__userlab__user_id=user_id, lab__userlab__role=UserLab.PRINCIPAL_INVESTIGATOR).values_list('lab_id', 'user_id'):
+        pi_area_ids.add(lab_id)
+        supervised_user_ids.add(member_id)
+
+    return {
+        'pi_area_ids': pi_area_ids,
+        'supervised_user_ids': supervised_user_ids,
+        'is_group_coordinator': ApprovalGroupRole.objects.filter(user_id=user_id, role=ApprovalGroupRole.Role.COORDINATOR).exists()
+    }
+
+
+def get_user_permissions(user_id):
+    """ Get the permissions of a user from the shared cache, loading them on a miss """
+
+    cache = get_cache()
+    if cache is None:
+        return load_permissions(user_id)
+
+    key = 'permissions:{0}:{1}'.format(get_version(cache), user_id)
+    permissions = cache.get(key)
+    if permissions is None:
+        permissions = load_permissions(user_id)
+        cache.set(key, permissions)
+    return permissions
+
+
+class PermissionContext:
+    """ Permissions of the logged-in user. Each is loaded on first use and kept for the request """
+
+    def __init__(self, user):
+        self.user = user
+
+    @cached_property
+    def _permissions(self):
+        if not self.user.is_authenticated:
+            return { 'pi_area_ids': set(), 'supervised_user_ids': set(), 'is_group_coordinator': False }
+        return get_user_permissions(self.user.id)
+
+    @property
+    def pi_area_ids(self):
+        return self._permissions['pi_area_ids']
+
+    @property
+    def supervised_user_ids(self):
+        return self._permissions['supervised_user_ids']
+
+    @property
+    def is_group_coordinator(self):
+        return self._permissions['is_group_coordinator']
+
+    @cached_property
+    def is_room_approver(self):
+        """ Read on every page by the navigation, so it does not load the other permissions """
+        return self.user.is_authenticated and is_room_approver(self.user.id)
+
+    def is_pi_in_area(self, area_id):
+        return int(area_id) in self.pi_area_ids
+
+    def can_view_user(self, user_id):
+        """ The user themselves, an admin, or a PI in one of the user's areas """
+        return self.user.id == user_id or self.user.is_superuser or user_id in self.supervised_user_ids
+
+
+def get_permissions(request):
+    """ Get the permission context of a request, memoized on the request """
+
+    if not hasattr(request, '_permission_context'):
+        request._permission_context = PermissionContext(request.user)
+    return request._permission_context
+
+
+# Signals
+
+@receiver([post_save, post_delete], sender=UserLab)
+@receiver([post_save, post_delete], sender=ApprovalGroupRole)
+@receiver(post_delete, sender=Room)
+def invalidate_permissions_on_change(sender, **kwargs):
+    invalidate_permissions()
+
+
+@receiver(m2m_changed, sender=Room.managers.through)
+@receiver(m2m_changed, sender=Room.groups.through)
+def invalidate_permissions_on_room_change(sender, action, **kwargs):
+    if action in ['post_add', 'post_remove', 'post_clear']:
+        invalidate_permissions()
@@ -1,7 +1,7 @@
 from django.conf import settings
 from django.shortcuts import render, redirect
 from django.urls import reverse
-from django.http import HttpResponseRedirect, JsonResponse
+from django.http import HttpResponseRedirect, JsonResponse, StreamingHttpResponse, FileResponse
 from django.views import View
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.decorators import login_required
@@ -10,20 +10,24 @@ from django.views.decorators.http import require_http_methods, require_GET, requ
 from django.views.decorators.cache import cache_control, never_cache
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.contrib import messages
-from django.db.models import Q
+from django.db.models import Q, Prefetch
 from datetime import date, timedelta
 from django.core.exceptions import ValidationError
 from django.core.validators import validate_email
+from openpyxl import Workbook
 
 from django.contrib.auth.models import User
-from lfs_lab_cert_tracker.models import Lab, Cert, UserLab, UserCert, UserInactive
+from lfs_lab_cert_tracker.models import Lab, Cert, UserLab, UserCert, UserInactive, update_user_compliance, QUEUED, ALREADY_QUEUED
 from .forms import AreaForm, TrainingForm, UserForm
 from .accesses import access_admin_only
 
 from . import functions as func
-from .utils import NUM_PER_PAGE
+from .utils import NUM_PER_PAGE, get_keyset_page, get_cursor
 
 from datetime import datetime
+import csv
+import json
+import tempfile
 
 
 @method_decorator([never_cache, access_admin_only], name='dispatch')
@@ -189,6 +193,7 @@ def edit_training(request):
                 objs.append(user_cert)
 
             UserCert.objects.bulk_update(objs, ['expiry_date'])
+            update_user_compliance(user_certs.values('user_id'), [training.id])
             messages.success(request, 'Success! {0} training and {1} user training record(s) updated'.format(updated_training.name, len(objs)))
         else:
             messages.success(request, 'Success! {0} training has been updated'.format(updated_training.name))
@@ -264,6 +269,8 @@ class AllUsers(LoginRequiredMixin, View):
                 Q(username__icontains=query) | Q(first_name__icontains=query) | Q(last_name__icontains=query) | Q(email__icontains=query)
             ).order_by('id').distinct()
 
+        user_list = user_list.prefetch_related(Prefetch('userlab_set', queryset=UserLab.objects.select_related('lab').order_by('lab__name')))
+
         page = request.GET.get('page', 1)
         paginator = Paginator(user_list, NUM_PER_PAGE)
 
@@ -274,21 +281,32 @@ class AllUsers(LoginRequiredMixin, View):
         except EmptyPage:
             users = paginator.page(paginator.num_pages)
 
+        # Look up the users in this page at once instead of per user
+        user_ids = [user.id for user in users]
+        num_missing_certs = func.get_num_missing_certs(user_ids)
+        inactive_users = {}
+        for user_inactive in UserInactive.objects.filter(user_id__in=user_ids).order_by('-id'):
+            inactive_users[user_inactive.user_id] = user_inactive
+
+        has_lab_users = {}
+        has_pis = {}
         for user in users:
-            user.missing_certs = func.get_user_missing_certs(user.id)
-            user.inactive = None
-            user_inactive = UserInactive.objects.filter(user_id=user.id)
-            if user_inactive.exists():
-                user.inactive = user_inactive.first()
+            user.num_missing_certs = num_missing_certs.get(user.id, 0)
+            user.inactive = inactive_users.get(user.id, None)
+            for userlab in user.userlab_set.all():
+                if userlab.role == UserLab.PRINCIPAL_INVESTIGATOR:
+                    has_pis.setdefault(userlab.lab_id, set()).add(user.id)
+                else:
+                    has_lab_users.setdefault(userlab.lab_id, set()).add(user.id)
 
         areas = []
         for area in Lab.objects.all():
-            area.has_lab_users = area.userlab_set.filter(role=UserLab.LAB_USER).values_list('user_id', flat=True)
-            area.has_pis = area.userlab_set.filter(role=UserLab.PRINCIPAL_INVESTIGATOR).values_list('user_id', flat=True)
+            area.has_lab_users = has_lab_users.get(area.id, set())
+            area.has_pis = has_pis.get(area.id, set())
             areas.append(area)
 
         return render(request, 'app/settings/all_users.html', {
-            'total_users': len(user_list),
+            'total_users': paginator.count,
             'users': users,
             'areas': areas,
             'roles': { 
@@ -444,11 +462,13 @@ class CreateUser(LoginRequiredMixin, View):
                          email_error = e
 
                     if email_error is None:
-                        sent = func.send_info_email(user)
-                        if sent:
-                            messages.success(request, 'Success! {0} has been created and sent an email.'.format(user.get_full_name()))
+                        result = func.send_info_email(user)
+                        if result == QUEUED:
+                            messages.success(request, 'Success! {0} has been created and an email has been queued.'.format(user.get_full_name()))
+                        elif result == ALREADY_QUEUED:
+                            messages.info(request, 'Info! {0} has been created, and an email has already been queued.'.format(user.get_full_name()))
                         else:
-                            messages.warning(request, 'Warning! {0} has been created, but failed to send an email due to {1}'.format(user.get_full_name(), sent.error))
+                            messages.warning(request, 'Warning! {0} has been created, but failed to queue an email.'.format(user.get_full_name()))
                 else:
                     messages.success(request, 'Success! {0} has been created.'.format(user.get_full_name()))
             else:
@@ -467,51 +487,95 @@ class UserReportMissingTrainings(LoginRequiredMixin, View):
     @method_decorator(require_GET)
     def get(self, request, *args, **kwargs):
 
-        # Find users who have missing certs
-        user_list = []
-        for user in func.get_users('active'):
-            missing_certs = func.get_user_missing_certs(user.id)
-            if len(missing_certs) > 0: 
-                user.missing_certs = missing_certs
-                user_list.append(user)
+        user_list = func.get_users_with_missing_trainings()
+        users = get_keyset_page(
+            user_list,
+            ['last_name', 'first_name', 'id'],
+            after=get_cursor(request.GET.get('after')),
+            before=get_cursor(request.GET.get('before')),
+            per_page=10
+        )
 
-        page = request.GET.get('page', 1)
-        paginator = Paginator(user_list, 10)
+        missing_certs = {}
+        for row in func.get_missing_trainings_report().filter(user_id__in=[user.id for user in users]):
+            missing_certs[row['user_id']] = row['missing_certs']
 
-        try:
-            users = paginator.page(page)
-        except PageNotAnInteger:
-            users = paginator.page(1)
-        except EmptyPage:
-            users = paginator.page(paginator.num_pages)
+        for user in users:
+            user.missing_certs = missing_certs.get(user.id, [])
 
         return render(request, 'app/settings/user_report_missing_trainings.html', {
-            'total_users': len(user_list),
+            'total_users': user_list.count(),
             'users': users,
             'download_user_report_missing_trainings_url': reverse('app:download_user_report_missing_trainings')
         })
 
 
+MISSING_TRAININGS_REPORT_HEADER = ['ID', 'CWL', 'First Name', 'Last Name', 'Number of Missing Trainings', 'Missing Trainings']
+
+class Echo:
+    """ A pseudo-buffer which returns the value to write instead of storing it """
+
+    def write(self, value):
+        return value
+
+
+def get_missing_trainings_report_rows():
+    """ Yield the rows of the missing trainings report as they are read from the database """
+
+    for row in func.get_missing_trainings_report().iterator(chunk_size=2000):
+        yield [row['user_id'], row['user__username'], row['user__first_name'], row['user__last_name'], row['num_missing_certs'], row['missing_certs']]
+
+
+def stream_missing_trainings_csv(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(MISSING_TRAININGS_REPORT_HEADER)
+    for row in rows:
+        yield writer.writerow(row[:-1] + ['\n'.join(row[-1])])
+
+
+def stream_missing_trainings_ndjson(rows):
+    keys = ['id', 'username', 'first_name', 'last_name', 'num_missing_trainings', 'missing_trainings']
+    for row in rows:
+        yield json.dumps(dict(zip(keys, row))) + '\n'
+
+
+def write_missing_trainings_xlsx(rows):
+    """ Write rows to a write-only workbook, which keeps only the current row in memory """
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Missing Trainings')
+    ws.append(MISSING_TRAININGS_REPORT_HEADER)
+    for row in rows:
+        ws.append(row[:-1] + ['\n'.join(row[-1])])
+
+    f = tempfile.SpooledTemporaryFile(max_size=10 * 1024 * 1024)
+    wb.save(f)
+    f.seek(0)
+    return f
+
+
 @login_required(login_url=settings.LOGIN_URL)
 @cache_control(no_cache=True, must_revalidate=True, no_store=True)
 @access_admin_only
 @require_http_methods(['GET'])
 def download_user_report_missing_trainings(request):
+    """ Download a report of users who have missing trainings as CSV, XLSX or NDJSON """
+
+    file_format = request.GET.get('format', 'csv')
+    filename = 'TRMS - Report - Missing Trainings {0}.{1}'.format(date.today().isoformat(), file_format)
+    rows = get_missing_trainings_report_rows()
+
+    if file_format == 'csv':
+        response = StreamingHttpResponse(stream_missing_trainings_csv(rows), content_type='text/csv; charset=utf-8')
+    elif file_format == 'ndjson':
+        response = StreamingHttpResponse(stream_missing_trainings_ndjson(rows), content_type='application/x-ndjson')
+    elif file_format == 'xlsx':
+        return FileResponse(write_missing_trainings_xlsx(rows), as_attachment=True, filename=filename)
+    else:
+        return JsonResponse({ 'status': 'error', 'message': 'Invalid format. Please choose csv, xlsx or ndjson.' }, status=400)
 
-    # Find users who have missing certs
-    result = 'ID,CWL,First Name,Last Name,Number of Missing Trainings,Missing Trainings\n'
-    for user in func.get_users('active'):
-        certs = ''
-        missing_certs = func.get_user_missing_certs(user.id)
-        if len(missing_certs) > 0:
-            for i, cert in enumerate(missing_certs):
-                certs += cert.name
-                if i < len(missing_certs) - 1:
-                    certs += '\n'
-
-            result += '{0},{1},{2},{3},{4},"{5}"\n'.format(user.id, user.username, user.first_name, user.last_name, len(missing_certs), certs)
-
-    return JsonResponse({ 'status': 'success', 'data': result })
+    response['Content-Disposition'] = 'attachment; filename="{0}"'.format(filename)
+    return response
 
 
 @method_decorator([never_cache, access_admin_only], name='dispatch')
@@ -0,0 +1,192 @@
+from django.test import TestCase, override_settings
+from django.contrib.auth.models import User
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from datetime import date, timedelta
+import threading
+import json
+
+from lfs_lab_cert_tracker.models import Lab, Cert, UserLab, LabCert, UserCert
+from scheduler.models import ApiSyncState
+from scheduler import tasks
+from scheduler import functions as sfunc
+from app import functions as func
+
+
+class MockAPIHandler(BaseHTTPRequestHandler):
+    """ Return one certificate for each training ID in `trainings`, a page at a time """
+
+    trainings = []
+    requests = []
+    fail_next = 0
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        query = parse_qs(urlparse(self.path).query)
+        page = int(query['page'][0])
+        page_size = int(query['pageSize'][0])
+        MockAPIHandler.requests.append((page, page_size, self.headers.get('X-Client-Id')))
+
+        if MockAPIHandler.fail_next > 0:
+            MockAPIHandler.fail_next -= 1
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        items = []
+        for identifier in body['requestIdentifiers']:
+            for training_id in MockAPIHandler.trainings:
+                items.append({
+                    'requestedIdentifier': { 'identifier': identifier['identifier'] },
+                    'certificate': { 'trainingName': 'Training', 'trainingId': training_id, 'completionDate': '2024-01-15T00:00:00', 'status': 'active' }
+                })
+
+        content = json.dumps({
+            'page': page,
+            'pageSize': page_size,
+            'hasNextPage': page * page_size < len(items),
+            'pageItems': items[(page - 1) * page_size:page * page_size]
+        }).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CheckUserTrainingsByAPITest(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), MockAPIHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = 'http://127.0.0.1:{0}/api'.format(cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        MockAPIHandler.trainings = ['C1', 'M2']
+        MockAPIHandler.requests = []
+        MockAPIHandler.fail_next = 0
+
+        lab = Lab.objects.create(name='API Lab')
+        self.cert1 = Cert.objects.create(name='API Cert 1', expiry_in_years=1, unique_id='C1')
+        self.cert2 = Cert.objects.create(name='API Cert 2', expiry_in_years=2, unique_id='M1, M2')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            LabCert.objects.create(lab=lab, cert=self.cert1)
+            LabCert.objects.create(lab=lab, cert=self.cert2)
+            for i in range(7):
+                user = User.objects.create_user(username='api_user_{0}'.format(i), email='api_user_{0}@example.com'.format(i))
+                UserLab.objects.create(user=user, lab=lab, role=UserLab.LAB_USER)
+
+    def run_sync(self, **kwargs):
+        options = {
+            'LFS_LAB_CERT_TRACKER_API_URL': self.url,
+            'LFS_LAB_CERT_TRACKER_CLIENT_ID': 'client',
+            'LFS_LAB_CERT_TRACKER_API_BATCH_SIZE': 2,
+            'LFS_LAB_CERT_TRACKER_API_PAGE_SIZE': 3,
+            'LFS_LAB_CERT_TRACKER_API_MAX_PER_SECOND': 0,
+            'LFS_LAB_CERT_TRACKER_API_RETRY_BACKOFF': 0
+        }
+        options.update(kwargs)
+        with override_settings(**options):
+            tasks.check_user_trainings_by_api()
+
+    def test_sync(self):
+        self.run_sync()
+
+        self.assertEqual(UserCert.objects.filter(by_api=True).count(), 14)
+        self.assertEqual(UserCert.objects.filter(cert=self.cert2, expiry_date=date(2026, 1, 15)).count(), 7)
+        self.assertFalse(func.get_missing_compliance().exists())
+
+        # 4 batches of 2 users (4 items) or 1 user (2 items) with 3 items per page
+        self.assertEqual(len(MockAPIHandler.requests), 7)
+        self.assertTrue(all(page_size == 3 and client_id == 'client' for _, page_size, client_id in MockAPIHandler.requests))
+
+    def test_retry_failed_requests(self):
+        MockAPIHandler.fail_next = 2
+        self.run_sync()
+
+        self.assertEqual(UserCert.objects.filter(by_api=True).count(), 14)
+        self.assertEqual(len(MockAPIHandler.requests), 9)
+
+    def test_give_up_after_retries(self):
+        MockAPIHandler.fail_next = 100
+        self.run_sync(LFS_LAB_CERT_TRACKER_API_MAX_RETRIES=1)
+
+        self.assertFalse(UserCert.objects.exists())
+        self.assertFalse(ApiSyncState.objects.exists())
+        self.assertEqual(len(MockAPIHandler.requests), 8)
+
+    def test_resume_after_failed_batches(self):
+        # The first two requests of batch 1 fail, so the batch gives up
+        MockAPIHandler.fail_next = 2
+        self.run_sync(LFS_LAB_CERT_TRACKER_API_MAX_RETRIES=1, LFS_LAB_CERT_TRACKER_API_MAX_WORKERS=1)
+
+        self.assertEqual(UserCert.objects.filter(by_api=True).count(), 10)
+        self.assertEqual(ApiSyncState.objects.count(), 5)
+
+        MockAPIHandler.requests = []
+        self.run_sync()
+
+        self.assertEqual(UserCert.objects.filter(by_api=True).count(), 14)
+        self.assertEqual(len(MockAPIHandler.requests), 2)
+
+    def test_skip_recently_synced_users(self):
+        self.run_sync()
+        self.assertEqual(ApiSyncState.objects.count(), 7)
+
+        # Make the users candidates again
+        with self.captureOnCommitCallbacks(execute=True):
+            UserCert.objects.filter(cert=self.cert2).delete()
+        self.assertTrue(func.get_missing_compliance().exists())
+
+        MockAPIHandler.requests = []
+        self.run_sync()
+        self.assertEqual(len(MockAPIHandler.requests), 0)
+
+    def test_pull_older_trainings_of_other_certs(self):
+        self.run_sync()
+        with self.captureOnCommitCallbacks(execute=True):
+            UserCert.objects.filter(cert=self.cert2).delete()
+
+        # A training completed after the others does not hide the older ones on the next sync
+        user = User.objects.get(username='api_user_0')
+        UserCert.objects.create(user=user, cert=self.cert1, cert_file='None', uploaded_date=date.today(), completion_date=date(2024, 6, 1), expiry_date=date(2025, 6, 1))
+        ApiSyncState.objects.update(last_synced_at=ApiSyncState.objects.first().last_synced_at - timedelta(days=1))
+
+        self.run_sync()
+        self.assertEqual(UserCert.objects.filter(cert=self.cert2).count(), 7)
+        self.assertEqual(UserCert.objects.filter(by_api=True).count(), 14)
+
+    def test_existing_trainings_are_skipped(self):
+        user = User.objects.get(username='api_user_0')
+        UserCert.objects.create(user=user, cert=self.cert1, cert_file='None', uploaded_date=date.today(), completion_date=date(2024, 1, 15), expiry_date=date(2025, 1, 15))
+        self.run_sync()
+
+        self.assertEqual(UserCert.objects.filter(by_api=True).count(), 13)
+
+    def test_pull_by_api_runs_no_queries(self):
+        users = { user.username: user for user in User.objects.filter(username__startswith='api_user_') }
+        certs = sfunc.get_certs_by_unique_id()
+        existing = sfunc.get_existing_user_trainings([user.id for user in users.values()])
+        items = [{
+            'requestedIdentifier': { 'identifier': username },
+            'certificate': { 'trainingName': 'Training', 'trainingId': training_id, 'completionDate': '2024-01-15T00:00:00', 'status': 'active' }
+        } for username in ['api_user_0', 'api_user_1', 'unknown'] for training_id in ['c1', 'M1', 'X9']]
+
+        with self.assertNumQueries(0):
+            user_trainings = sfunc.pull_by_api(items + items, users, certs, existing)
+
+        self.assertEqual(len(user_trainings), 4)
+        self.assertEqual({ ut.cert for ut in user_trainings }, { self.cert1, self.cert2 })
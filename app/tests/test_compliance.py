@@ -0,0 +1,225 @@
+from django.test import TestCase, Client
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.urls import reverse
+from django.contrib.auth.models import User
+from datetime import date, timedelta
+from unittest.mock import patch
+
+from lfs_lab_cert_tracker.models import Lab, Cert, UserLab, LabCert, UserCert, UserInactive, UserCompliance, rebuild_all_user_compliance
+from app import functions as func
+
+
+LOGIN_URL = reverse('accounts:local_login')
+
+
+def make_user_cert(user, cert, completion_date, expiry_date):
+    return UserCert.objects.create(
+        user=user,
+        cert=cert,
+        cert_file='None',
+        uploaded_date=date.today(),
+        completion_date=completion_date,
+        expiry_date=expiry_date
+    )
+
+
+class UserComplianceTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='compliance_user', first_name='Comp', last_name='Liance', email='compliance_user@example.com')
+        self.lab = Lab.objects.create(name='Compliance Lab')
+        self.cert1 = Cert.objects.create(name='Compliance Cert 1', expiry_in_years=1)
+        self.cert2 = Cert.objects.create(name='Compliance Cert 2', expiry_in_years=0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            LabCert.objects.create(lab=self.lab, cert=self.cert1)
+            LabCert.objects.create(lab=self.lab, cert=self.cert2)
+            UserLab.objects.create(user=self.user, lab=self.lab, role=UserLab.LAB_USER)
+
+    def test_user_added_to_lab_has_missing_trainings(self):
+        self.assertEqual(UserCompliance.objects.filter(user=self.user, state=UserCompliance.MISSING).count(), 2)
+        self.assertEqual(list(func.get_user_missing_certs(self.user.id)), [self.cert1, self.cert2])
+        self.assertEqual(list(func.get_user_expired_certs(self.user)), [])
+
+    def test_uploaded_training_is_completed(self):
+        today = date.today()
+        with self.captureOnCommitCallbacks(execute=True):
+            make_user_cert(self.user, self.cert1, today, today + timedelta(days=365))
+            make_user_cert(self.user, self.cert2, today, today)
+
+        self.assertEqual(list(func.get_user_missing_certs(self.user.id)), [])
+        self.assertEqual(list(func.get_user_expired_certs(self.user)), [])
+
+        row = UserCompliance.objects.get(user=self.user, cert=self.cert2)
+        self.assertEqual(row.state, UserCompliance.COMPLETED)
+        self.assertIsNone(row.latest_expiry_date)
+
+    def test_expired_training(self):
+        past = date.today() - timedelta(days=400)
+        with self.captureOnCommitCallbacks(execute=True):
+            make_user_cert(self.user, self.cert1, past, past + timedelta(days=365))
+
+        self.assertEqual(list(func.get_user_missing_certs(self.user.id)), [self.cert2])
+        self.assertEqual(list(func.get_user_expired_certs(self.user)), [self.cert1])
+
+        users = func.group_compliance_by_user(func.get_expired_compliance().filter(lab=self.lab), 'expired_certs')
+        self.assertEqual(users, [{ 'user': self.user, 'expired_certs': [self.cert1] }])
+
+    def test_expired_training_not_required_by_lab(self):
+        cert3 = Cert.objects.create(name='Compliance Cert 3', expiry_in_years=1)
+        past = date.today() - timedelta(days=400)
+        with self.captureOnCommitCallbacks(execute=True):
+            make_user_cert(self.user, cert3, past, past + timedelta(days=365))
+
+        self.assertFalse(UserCompliance.objects.filter(user=self.user, cert=cert3).exists())
+        self.assertEqual(list(func.get_user_expired_certs(self.user)), [cert3])
+
+    def test_deleting_user_cert_makes_training_missing(self):
+        today = date.today()
+        with self.captureOnCommitCallbacks(execute=True):
+            user_cert = make_user_cert(self.user, self.cert1, today, today + timedelta(days=365))
+        self.assertNotIn(self.cert1, func.get_user_missing_certs(self.user.id))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            user_cert.delete()
+        self.assertIn(self.cert1, func.get_user_missing_certs(self.user.id))
+
+    def test_removing_required_training_from_lab(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            LabCert.objects.filter(lab=self.lab, cert=self.cert2).delete()
+
+        self.assertEqual(list(func.get_user_missing_certs(self.user.id)), [self.cert1])
+
+    def test_removing_user_from_lab(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            UserLab.objects.filter(user=self.user, lab=self.lab).delete()
+
+        self.assertFalse(UserCompliance.objects.filter(user=self.user).exists())
+
+    def test_deleting_user_and_lab(self):
+        other = User.objects.create_user(username='compliance_other', email='compliance_other@example.com')
+        with self.captureOnCommitCallbacks(execute=True):
+            UserLab.objects.create(user=other, lab=self.lab, role=UserLab.PRINCIPAL_INVESTIGATOR)
+            self.user.delete()
+
+        self.assertEqual(UserCompliance.objects.filter(user=other).count(), 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.lab.delete()
+
+        self.assertFalse(UserCompliance.objects.exists())
+
+    def test_users_with_missing_or_expired_trainings(self):
+        today = date.today()
+        past = today - timedelta(days=400)
+        other = User.objects.create_user(username='compliance_other', email='compliance_other@example.com')
+        inactive = User.objects.create_user(username='compliance_inactive', email='compliance_inactive@example.com', is_active=False)
+        with self.captureOnCommitCallbacks(execute=True):
+            make_user_cert(self.user, self.cert1, today, today + timedelta(days=365))
+            make_user_cert(self.user, self.cert2, today, today)
+            UserLab.objects.create(user=other, lab=self.lab, role=UserLab.LAB_USER)
+            UserLab.objects.create(user=inactive, lab=self.lab, role=UserLab.LAB_USER)
+            make_user_cert(other, self.cert1, past, past + timedelta(days=365))
+            make_user_cert(other, self.cert2, today, today)
+
+        with self.assertNumQueries(1):
+            users = list(func.get_users_with_missing_or_expired_trainings())
+        self.assertEqual(users, [other])
+
+    def test_bulk_ingest_user_certs(self):
+        today = date.today()
+        other = User.objects.create_user(username='compliance_other', email='compliance_other@example.com')
+        with self.captureOnCommitCallbacks(execute=True):
+            make_user_cert(self.user, self.cert1, today, today + timedelta(days=365))
+
+        def new_user_cert(user, cert):
+            return UserCert(user=user, cert=cert, cert_file='None', uploaded_date=today, completion_date=today, expiry_date=today, by_api=True)
+
+        user_certs = [
+            new_user_cert(self.user, self.cert1),
+            new_user_cert(self.user, self.cert2),
+            new_user_cert(self.user, self.cert2),
+            new_user_cert(other, self.cert1),
+            new_user_cert(other, self.cert2)
+        ]
+        counts = func.bulk_ingest_user_certs(user_certs, batch_size=2)
+
+        self.assertEqual(counts, [{ 'inserted': 1, 'skipped': 1 }, { 'inserted': 1, 'skipped': 1 }, { 'inserted': 1, 'skipped': 0 }])
+        self.assertEqual(UserCert.objects.filter(by_api=True).count(), 3)
+        self.assertEqual(list(func.get_user_missing_certs(self.user.id)), [])
+
+    def test_bulk_ingest_counts_rows_inserted_in_the_meantime_as_skipped(self):
+        today = date.today()
+        with self.captureOnCommitCallbacks(execute=True):
+            make_user_cert(self.user, self.cert1, today, today + timedelta(days=365))
+
+        user_certs = [
+            UserCert(user=self.user, cert=self.cert1, cert_file='None', uploaded_date=today, completion_date=today, expiry_date=today, by_api=True),
+            UserCert(user=self.user, cert=self.cert2, cert_file='None', uploaded_date=today, completion_date=today, expiry_date=today, by_api=True)
+        ]
+
+        # The first filter misses the existing row, as if it had been inserted after the chunk was read
+        get_new_user_certs = func.get_new_user_certs
+        with patch('app.functions.get_new_user_certs', side_effect=[user_certs, get_new_user_certs(user_certs)]):
+            counts = func.bulk_ingest_user_certs(user_certs)
+
+        self.assertEqual(counts, [{ 'inserted': 1, 'skipped': 1 }])
+        self.assertEqual(UserCert.objects.filter(by_api=True).count(), 1)
+
+    def test_rebuild_all_user_compliance(self):
+        UserCompliance.objects.all().delete()
+        rebuild_all_user_compliance()
+        self.assertEqual(UserCompliance.objects.filter(user=self.user, state=UserCompliance.MISSING).count(), 2)
+
+
+class AllUsersTest(TestCase):
+
+    def setUp(self):
+        self.client = Client()
+        User.objects.create_superuser(username='all_users_admin', email='all_users_admin@example.com', password='password')
+        self.lab = Lab.objects.create(name='All Users Lab')
+        self.cert = Cert.objects.create(name='All Users Cert', expiry_in_years=1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            LabCert.objects.create(lab=self.lab, cert=self.cert)
+
+        self.client.post(LOGIN_URL, data={'username': 'all_users_admin', 'password': 'password'})
+
+    def add_users(self, start, end):
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(start, end):
+                user = User.objects.create_user(username='all_users_{0}'.format(i), email='all_users_{0}@example.com'.format(i), is_active=i % 2 == 0)
+                role = UserLab.PRINCIPAL_INVESTIGATOR if i % 3 == 0 else UserLab.LAB_USER
+                UserLab.objects.create(user=user, lab=Lab.objects.create(name='All Users Lab {0}'.format(i)), role=role)
+                UserLab.objects.create(user=user, lab=self.lab, role=role)
+                if not user.is_active:
+                    UserInactive.objects.create(user=user, inactive_date=date.today())
+
+    def get_num_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('app:all_users'))
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries), response
+
+    def test_annotations(self):
+        self.add_users(0, 4)
+        _, response = self.get_num_queries()
+
+        self.assertEqual(response.context['total_users'], 5)
+        users = { user.username: user for user in response.context['users'] }
+        self.assertEqual(users['all_users_admin'].num_missing_certs, 0)
+        self.assertEqual(users['all_users_1'].num_missing_certs, 1)
+        self.assertIsNone(users['all_users_0'].inactive)
+        self.assertEqual(users['all_users_1'].inactive.inactive_date, date.today())
+
+        area = [area for area in response.context['areas'] if area.id == self.lab.id][0]
+        self.assertEqual(area.has_pis, { users['all_users_0'].id, users['all_users_3'].id })
+        self.assertEqual(area.has_lab_users, { users['all_users_1'].id, users['all_users_2'].id })
+
+    def test_number_of_queries_does_not_grow_with_users(self):
+        self.add_users(0, 2)
+        num_queries, _ = self.get_num_queries()
+
+        self.add_users(2, 12)
+        self.assertEqual(self.get_num_queries()[0], num_queries)
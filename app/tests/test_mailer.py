@@ -0,0 +1,136 @@
+from django.test import TestCase, override_settings
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.management import call_command
+from django.contrib.auth.models import User
+from django.utils import timezone
+from datetime import timedelta
+from io import StringIO
+import smtplib
+import time
+
+from lfs_lab_cert_tracker.models import Lab, UserLab, Outbox, enqueue_emails, enqueue_email, get_unique_key, QUEUED, ALREADY_QUEUED, NOT_QUEUED
+from app import mailer
+from app.utils import RateLimiter
+
+
+class FlakyBackend(EmailBackend):
+    """ Drop the connection on the first email sent to each receiver """
+
+    seen = set()
+
+    def send_messages(self, messages):
+        for message in messages:
+            receiver = message.to[0]
+            if '<refused' in receiver:
+                raise smtplib.SMTPRecipientsRefused({ receiver: (550, b'No such user') })
+            if receiver not in FlakyBackend.seen:
+                FlakyBackend.seen.add(receiver)
+                raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        return super().send_messages(messages)
+
+
+def make_emails(n, prefix='user'):
+    return [{
+        'receiver': 'User {0} <{1}{0}@example.com>'.format(i, prefix),
+        'subject': 'Subject {0}'.format(i),
+        'message': '<p>Message {0}</p>'.format(i)
+    } for i in range(n)]
+
+
+@override_settings(EMAIL_FROM='noreply@example.com', EMAIL_MAX_PER_SECOND=0, EMAIL_RETRY_BACKOFF=0)
+class MailerTest(TestCase):
+
+    def test_send_emails(self):
+        outboxes = mailer.send_emails(make_emails(6))
+
+        self.assertEqual(len(mail.outbox), 6)
+        self.assertEqual(sorted(email.subject for email in mail.outbox), ['Subject {0}'.format(i) for i in range(6)])
+        self.assertEqual(mail.outbox[0].content_subtype, 'html')
+
+        self.assertEqual(len(outboxes), 6)
+        self.assertEqual(Outbox.objects.filter(status=Outbox.SENT, attempts=1, sent_at__isnull=False).count(), 6)
+
+    @override_settings(EMAIL_BACKEND='app.tests.test_mailer.FlakyBackend')
+    def test_retry_transient_error(self):
+        FlakyBackend.seen = set()
+        mailer.send_emails(make_emails(3))
+
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(Outbox.objects.filter(status=Outbox.SENT, attempts=2).count(), 3)
+
+    @override_settings(EMAIL_BACKEND='app.tests.test_mailer.FlakyBackend')
+    def test_permanent_error_is_not_retried(self):
+        mailer.send_emails(make_emails(1, 'refused'))
+
+        outbox = Outbox.objects.get()
+        self.assertEqual(outbox.status, Outbox.FAILED)
+        self.assertEqual(outbox.attempts, 1)
+        self.assertIn('SMTPRecipientsRefused', outbox.error)
+
+    @override_settings(EMAIL_FROM='')
+    def test_no_sender(self):
+        self.assertEqual(mailer.send_emails(make_emails(1)), [])
+        self.assertFalse(Outbox.objects.exists())
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(50)
+        start = time.monotonic()
+        for _ in range(6):
+            limiter.wait()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+
+@override_settings(EMAIL_FROM='noreply@example.com', EMAIL_MAX_PER_SECOND=0, EMAIL_RETRY_BACKOFF=0)
+class OutboxTest(TestCase):
+
+    def test_enqueue_skips_duplicates(self):
+        emails = make_emails(3)
+        self.assertEqual(enqueue_emails(emails + emails[:1]), 3)
+        self.assertEqual(enqueue_emails(emails), 0)
+        self.assertEqual(enqueue_emails([dict(emails[0], key='other')]), 1)
+
+        self.assertEqual(Outbox.objects.filter(status=Outbox.PENDING).count(), 4)
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_enqueue_email_results(self):
+        email = make_emails(1)[0]
+        self.assertEqual(enqueue_email(email['receiver'], email['subject'], email['message']), QUEUED)
+        self.assertEqual(enqueue_email(email['receiver'], email['subject'], email['message']), ALREADY_QUEUED)
+
+        # Emails which admins send on purpose are queued every time
+        self.assertEqual(enqueue_email(email['receiver'], email['subject'], email['message'], get_unique_key()), QUEUED)
+        self.assertEqual(enqueue_email(email['receiver'], email['subject'], email['message'], get_unique_key()), QUEUED)
+        self.assertEqual(Outbox.objects.count(), 3)
+
+        with self.settings(EMAIL_FROM=None):
+            self.assertEqual(enqueue_email(email['receiver'], email['subject'], email['message'], get_unique_key()), NOT_QUEUED)
+
+    def test_send_outbox_command(self):
+        enqueue_emails(make_emails(5))
+        out = StringIO()
+        call_command('send_outbox', batch_size=2, stdout=out)
+
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(Outbox.objects.filter(status=Outbox.SENT).count(), 5)
+
+        call_command('send_outbox', stdout=out)
+        self.assertEqual(len(mail.outbox), 5)
+
+    def test_claim_skips_recently_claimed(self):
+        enqueue_emails(make_emails(2))
+        self.assertEqual(len(mailer.claim(1)), 1)
+        self.assertEqual(len(mailer.claim(10)), 1)
+        self.assertEqual(len(mailer.claim(10)), 0)
+
+        Outbox.objects.update(claimed_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(len(mailer.claim(10)), 2)
+
+    def test_user_lab_notification_is_queued(self):
+        user = User.objects.create_user(username='outbox_user', first_name='Outbox', last_name='User', email='outbox_user@example.com')
+        user_lab = UserLab.objects.create(user=user, lab=Lab.objects.create(name='Outbox Lab'), role=UserLab.LAB_USER)
+
+        outbox = Outbox.objects.get()
+        self.assertEqual(outbox.idempotency_key, 'user_lab:{0}'.format(user_lab.id))
+        self.assertEqual(outbox.receiver, 'outbox_user@example.com')
+        self.assertEqual(len(mail.outbox), 0)
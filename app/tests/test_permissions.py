@@ -0,0 +1,143 @@
+from django.test import TestCase, Client, RequestFactory, override_settings
+from django.core.cache import caches
+from django.urls import reverse
+from django.contrib.auth.models import User, AnonymousUser
+
+from lfs_lab_cert_tracker.models import Lab, UserLab
+from key_request.models import Building, Floor, Room, ApprovalGroup, ApprovalGroupRole
+from key_request.context_processors import is_room_manager
+from key_request.functions import is_room_approver
+from app.permissions import get_permissions, VERSION_KEY
+from app import functions as func
+
+
+LOGIN_URL = reverse('accounts:local_login')
+
+
+PERMISSION_CACHES = {
+    'default': { 'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'default' },
+    'permissions': { 'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'permissions' }
+}
+
+
+@override_settings(CACHES=PERMISSION_CACHES)
+class PermissionContextTest(TestCase):
+
+    def setUp(self):
+        caches['permissions'].clear()
+
+        self.pi = User.objects.create_user(username='perm_pi', email='perm_pi@example.com', password='password')
+        self.user = User.objects.create_user(username='perm_user', email='perm_user@example.com', password='password')
+        self.other = User.objects.create_user(username='perm_other', email='perm_other@example.com', password='password')
+        self.lab = Lab.objects.create(name='Permission Lab')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            UserLab.objects.create(user=self.pi, lab=self.lab, role=UserLab.PRINCIPAL_INVESTIGATOR)
+            UserLab.objects.create(user=self.user, lab=self.lab, role=UserLab.LAB_USER)
+
+    def get_request(self, user):
+        request = RequestFactory().get('/')
+        request.user = user
+        return request
+
+    def test_permissions_are_cached_across_requests(self):
+        request = self.get_request(self.pi)
+        with self.assertNumQueries(0):
+            permissions = get_permissions(request)
+
+        # Each permission is loaded on first use
+        with self.assertNumQueries(2):
+            self.assertTrue(permissions.is_pi_in_area(self.lab.id))
+        with self.assertNumQueries(1):
+            self.assertFalse(permissions.is_room_approver)
+
+        with self.assertNumQueries(0):
+            self.assertIs(get_permissions(request), permissions)
+            self.assertTrue(permissions.is_pi_in_area(self.lab.id))
+            self.assertTrue(permissions.can_view_user(self.user.id))
+            self.assertFalse(permissions.can_view_user(self.other.id))
+            self.assertFalse(permissions.is_room_approver)
+
+            # The next request reads the shared cache
+            permissions = get_permissions(self.get_request(self.pi))
+            self.assertTrue(permissions.is_pi_in_area(self.lab.id))
+            self.assertFalse(permissions.is_room_approver)
+
+    @override_settings(CACHES={ 'default': PERMISSION_CACHES['default'] })
+    def test_permissions_without_shared_cache(self):
+        for i in range(2):
+            permissions = get_permissions(self.get_request(self.pi))
+            with self.assertNumQueries(3):
+                self.assertTrue(permissions.is_pi_in_area(self.lab.id))
+                self.assertFalse(permissions.is_room_approver)
+
+    def test_userlab_changes_invalidate_permissions(self):
+        self.assertEqual(get_permissions(self.get_request(self.pi)).supervised_user_ids, { self.pi.id, self.user.id })
+
+        UserLab.objects.create(user=self.other, lab=self.lab, role=UserLab.LAB_USER)
+        self.assertIn(self.other.id, get_permissions(self.get_request(self.pi)).supervised_user_ids)
+
+        func.update_or_create_areas_to_user(self.pi, ['{0},{1}'.format(self.lab.id, UserLab.LAB_USER)])
+        self.assertFalse(get_permissions(self.get_request(self.pi)).is_pi_in_area(self.lab.id))
+
+    def test_room_and_group_changes_invalidate_permissions(self):
+        self.assertFalse(get_permissions(self.get_request(self.other)).is_room_approver)
+
+        building = Building.objects.create(name='Permission Building', code='PB')
+        floor = Floor.objects.create(name='Permission Floor')
+        room = Room.objects.create(building=building, floor=floor, number='101')
+        room.managers.add(self.other)
+        self.assertTrue(get_permissions(self.get_request(self.other)).is_room_approver)
+
+        room.managers.remove(self.other)
+        self.assertFalse(get_permissions(self.get_request(self.other)).is_room_approver)
+
+        group = ApprovalGroup.objects.create(name='Permission Group')
+        room.groups.add(group)
+        role = ApprovalGroupRole.objects.create(group=group, user=self.other, role=ApprovalGroupRole.Role.COORDINATOR)
+        permissions = get_permissions(self.get_request(self.other))
+        self.assertTrue(permissions.is_room_approver)
+        self.assertTrue(permissions.is_group_coordinator)
+
+        role.delete()
+        self.assertFalse(get_permissions(self.get_request(self.other)).is_group_coordinator)
+
+    def test_evicted_version_never_returns_to_an_earlier_one(self):
+        get_permissions(self.get_request(self.pi)).pi_area_ids
+        version = caches['permissions'].get(VERSION_KEY)
+
+        caches['permissions'].delete(VERSION_KEY)
+        get_permissions(self.get_request(self.pi)).pi_area_ids
+        self.assertGreater(caches['permissions'].get(VERSION_KEY), version)
+
+    def test_access_to_user_pages(self):
+        client = Client()
+        url = reverse('app:my_training_record', args=[self.user.id])
+
+        client.post(LOGIN_URL, data={'username': 'perm_pi', 'password': 'password'})
+        self.assertEqual(client.get(url).status_code, 200)
+
+        client.post(LOGIN_URL, data={'username': 'perm_other', 'password': 'password'})
+        self.assertEqual(client.get(url).status_code, 403)
+
+    def test_is_room_manager_context_processor(self):
+        building = Building.objects.create(name='Permission Building', code='PB')
+        floor = Floor.objects.create(name='Permission Floor')
+        room = Room.objects.create(building=building, floor=floor, number='101')
+        group = ApprovalGroup.objects.create(name='Permission Group')
+        room.managers.add(self.pi)
+        room.groups.add(group)
+        ApprovalGroupRole.objects.create(group=group, user=self.user)
+
+        self.assertTrue(is_room_manager(self.get_request(self.pi))['is_room_manager'])
+        self.assertTrue(is_room_manager(self.get_request(self.user))['is_room_manager'])
+        self.assertFalse(is_room_manager(self.get_request(self.other))['is_room_manager'])
+        self.assertTrue(is_room_approver(self.pi.id))
+
+        # Pages add no queries once the room approvers are cached, and other permissions are not loaded
+        with self.assertNumQueries(0):
+            self.assertTrue(is_room_manager(self.get_request(self.user))['is_room_manager'])
+            self.assertFalse(is_room_manager(self.get_request(AnonymousUser()))['is_room_manager'])
+
+        room.groups.remove(group)
+        self.assertFalse(is_room_manager(self.get_request(self.user))['is_room_manager'])
@@ -0,0 +1,333 @@
+from django.test import TestCase, override_settings
+from django.core import mail
+from django.core.management import call_command, CommandError
+from django.contrib.auth.models import User
+from django.utils import timezone
+from datetime import date, timedelta
+from io import StringIO
+
+from lfs_lab_cert_tracker.models import Lab, Cert, UserLab, LabCert, UserCert
+from scheduler import tasks
+from scheduler import notifications
+from scheduler.models import NotificationLog, NotificationRun
+from scheduler import functions as sfunc
+from app import functions as func
+
+
+def make_user(username, **kwargs):
+    return User.objects.create_user(username=username, first_name=username.title(), last_name='Test', email='{0}@example.com'.format(username), **kwargs)
+
+
+def make_user_cert(user, cert, completion_date, expiry_date):
+    return UserCert.objects.create(user=user, cert=cert, cert_file='None', uploaded_date=date.today(), completion_date=completion_date, expiry_date=expiry_date)
+
+
+@override_settings(EMAIL_FROM='noreply@example.com', EMAIL_MAX_PER_SECOND=0)
+class SendToPIsTest(TestCase):
+
+    def setUp(self):
+        past = date.today() - timedelta(days=400)
+
+        self.lab1 = Lab.objects.create(name='Reminder Lab 1')
+        self.lab2 = Lab.objects.create(name='Reminder Lab 2')
+        cert1 = Cert.objects.create(name='Reminder Cert 1', expiry_in_years=1)
+        cert2 = Cert.objects.create(name='Reminder Cert 2', expiry_in_years=1)
+
+        self.pi = make_user('pi')
+        self.pi2 = make_user('pi2')
+        user1 = make_user('user1')
+        user2 = make_user('user2')
+        inactive = make_user('inactive', is_active=False)
+
+        LabCert.objects.create(lab=self.lab1, cert=cert1)
+        LabCert.objects.create(lab=self.lab2, cert=cert2)
+        UserLab.objects.create(user=self.pi, lab=self.lab1, role=UserLab.PRINCIPAL_INVESTIGATOR)
+        UserLab.objects.create(user=self.pi, lab=self.lab2, role=UserLab.PRINCIPAL_INVESTIGATOR)
+        UserLab.objects.create(user=self.pi2, lab=self.lab2, role=UserLab.PRINCIPAL_INVESTIGATOR)
+        UserLab.objects.create(user=user1, lab=self.lab1, role=UserLab.LAB_USER)
+        UserLab.objects.create(user=user2, lab=self.lab2, role=UserLab.LAB_USER)
+        UserLab.objects.create(user=inactive, lab=self.lab1, role=UserLab.LAB_USER)
+
+        make_user_cert(user1, cert1, past, past + timedelta(days=365))
+        make_user_cert(user2, cert2, past, past + timedelta(days=365))
+        make_user_cert(inactive, cert1, past, past + timedelta(days=365))
+
+        # Not required by lab 1
+        make_user_cert(user1, cert2, past, past + timedelta(days=365))
+
+        # Expired, but renewed
+        renewed = make_user('renewed')
+        UserLab.objects.create(user=renewed, lab=self.lab1, role=UserLab.LAB_USER)
+        make_user_cert(renewed, cert1, past, past + timedelta(days=365))
+        make_user_cert(renewed, cert1, date.today(), date.today() + timedelta(days=365))
+
+    def test_one_digest_per_pi(self):
+        tasks.send_after_expiry_date_pis()
+
+        emails = { email.to[0]: email.body for email in mail.outbox if email.subject == 'Training Record Notification' }
+        self.assertEqual(len(emails), 2)
+
+        body = emails['Pi Test <pi@example.com>']
+        self.assertIn('Reminder Lab 1', body)
+        self.assertIn('Reminder Lab 2', body)
+        self.assertIn('User1 Test', body)
+        self.assertIn('User2 Test', body)
+        self.assertNotIn('Inactive', body)
+        self.assertNotIn('Renewed', body)
+        self.assertEqual(body.count('Reminder Cert 2'), 1)
+
+        body = emails['Pi2 Test <pi2@example.com>']
+        self.assertNotIn('Reminder Lab 1', body)
+        self.assertNotIn('User1 Test', body)
+
+    def test_nothing_to_send(self):
+        tasks.send_before_expiry_date_pis()
+        self.assertFalse([email for email in mail.outbox if email.subject == 'Training Record Notification'])
+
+
+@override_settings(EMAIL_FROM='noreply@example.com', EMAIL_MAX_PER_SECOND=0)
+class ExpiredTrainingsTest(TestCase):
+
+    def setUp(self):
+        today = date.today()
+        past = today - timedelta(days=400)
+        self.soon = today + timedelta(days=30)
+
+        self.cert1 = Cert.objects.create(name='Expiry Cert 1', expiry_in_years=1)
+        self.cert2 = Cert.objects.create(name='Expiry Cert 2', expiry_in_years=1)
+        self.user1 = make_user('user1')
+        self.user2 = make_user('user2')
+        inactive = make_user('inactive', is_active=False)
+
+        # Expired
+        make_user_cert(self.user1, self.cert1, past, past + timedelta(days=365))
+        # Expired, but renewed
+        make_user_cert(self.user1, self.cert2, past, past + timedelta(days=365))
+        make_user_cert(self.user1, self.cert2, today, today + timedelta(days=365))
+        # Expires in 30 days
+        make_user_cert(self.user2, self.cert1, self.soon - timedelta(days=365), self.soon)
+        # Never expires
+        make_user_cert(self.user2, self.cert2, past, past)
+        make_user_cert(inactive, self.cert1, past, past + timedelta(days=365))
+
+    def test_after_expiry_date(self):
+        users, _ = notifications.collect(notifications.RULES['after_expiry'].get_records(date.today()))
+
+        self.assertEqual(list(users.keys()), [self.user1.id])
+        self.assertEqual([tr['name'] for tr in users[self.user1.id]['trainings']], ['Expiry Cert 1'])
+        self.assertEqual(users[self.user1.id]['email'], 'user1@example.com')
+
+    def test_before_expiry_date(self):
+        users, _ = notifications.collect(notifications.RULES['before_expiry'].get_records(date.today()))
+
+        self.assertEqual(list(users.keys()), [self.user2.id])
+        self.assertEqual([tr['name'] for tr in users[self.user2.id]['trainings']], ['Expiry Cert 1'])
+
+    def test_send_after_expiry_date_users(self):
+        tasks.send_after_expiry_date_users()
+
+        emails = [email for email in mail.outbox if email.subject == 'Training Record Notification']
+        self.assertEqual([email.to[0] for email in emails], ['User1 Test <user1@example.com>'])
+        self.assertIn('Expiry Cert 1', emails[0].body)
+
+    def test_send_after_expiry_date_admins(self):
+        User.objects.create_superuser(username='admin1', first_name='Admin1', last_name='Test', email='admin1@example.com', password='password')
+        User.objects.create_superuser(username='admin2', first_name='Admin2', last_name='Test', email='admin2@example.com', password='password')
+        self.user1.last_name = '<b>Test</b>'
+        self.user1.save()
+
+        tasks.send_after_expiry_date_admins()
+
+        emails = [email for email in mail.outbox if email.subject == 'Training Record Notification']
+        self.assertEqual(sorted(email.to[0] for email in emails), ['Admin1 Test <admin1@example.com>', 'Admin2 Test <admin2@example.com>'])
+        self.assertEqual(emails[0].body, emails[1].body)
+        self.assertIn('Hi LFS TRMS administrators,', emails[0].body)
+        self.assertIn('User1 &lt;b&gt;Test&lt;/b&gt;', emails[0].body)
+        self.assertNotIn('<b>Test</b>', emails[0].body)
+        self.assertIn('/app/users/{0}/report.pdf/'.format(self.user1.id), emails[0].body)
+
+
+class EmailTemplateTest(TestCase):
+
+    def test_message_users_missing_trainings(self):
+        areas = { '1': { 'name': 'Lab & Co', 'missing_trainings': ['Cert <1>'] } }
+        message = sfunc.get_message_users_missing_trainings('7', areas)
+
+        self.assertIn('<p>Lab &amp; Co</p>', message)
+        self.assertIn('<li>Cert &lt;1&gt;</li>', message)
+        self.assertIn('/app/users/7/report.pdf/', message)
+
+    def test_fragments_are_not_escaped_twice(self):
+        contents = sfunc.render_user_trainings([{ 'first_name': 'A&B', 'last_name': 'Test', 'trainings': [{ 'name': 'Cert' }] }], area_name='Lab')
+        message = sfunc.get_message_pis_expired_trainings([ contents ], 30, 'before')
+        template = sfunc.html_template('Pi', '<Test>', message)
+
+        self.assertIn('expire in 30 days', template)
+        self.assertIn('<h4>Lab</h4>', template)
+        self.assertIn('<u>A&amp;B Test</u>', template)
+        self.assertIn('Hi Pi &lt;Test&gt;,', template)
+        self.assertEqual(sfunc.get_message_pis_expired_trainings([ contents ], 30, 'unknown'), '')
+
+
+class LatestUserCertsTest(TestCase):
+
+    def test_latest_record_wins(self):
+        today = date.today()
+        past = today - timedelta(days=400)
+        user = make_user('user1')
+        cert1 = Cert.objects.create(name='Latest Cert 1', expiry_in_years=1)
+        cert2 = Cert.objects.create(name='Latest Cert 2', expiry_in_years=0)
+        make_user_cert(user, cert1, past, past + timedelta(days=365))
+        latest = make_user_cert(user, cert1, today, today + timedelta(days=365))
+        make_user_cert(user, cert2, past, past)
+
+        self.assertEqual(list(func.get_latest_user_certs()), [latest])
+        self.assertFalse(func.get_latest_user_certs().filter(expiry_date__lt=today).exists())
+
+    def test_filter_users_before_distinct(self):
+        today = date.today()
+        user1 = make_user('user1')
+        user2 = make_user('user2')
+        cert = Cert.objects.create(name='Latest Cert', expiry_in_years=1)
+        latest = make_user_cert(user1, cert, today, today + timedelta(days=365))
+        make_user_cert(user2, cert, today, today + timedelta(days=365))
+
+        user_certs = func.get_latest_user_certs([user1.id])
+        self.assertEqual(list(user_certs), [latest])
+
+        # The users are filtered inside the DISTINCT ON subquery
+        subquery = str(user_certs.query).split('DISTINCT ON', 1)[1]
+        self.assertIn('"user_id" IN ({0})'.format(user1.id), subquery)
+
+
+@override_settings(EMAIL_FROM='noreply@example.com', EMAIL_MAX_PER_SECOND=0)
+class NotificationEngineTest(TestCase):
+
+    def setUp(self):
+        self.lab1 = Lab.objects.create(name='Engine Lab 1')
+        self.lab2 = Lab.objects.create(name='Engine Lab 2')
+        self.cert1 = Cert.objects.create(name='Engine Cert 1', expiry_in_years=1)
+        self.cert2 = Cert.objects.create(name='Engine Cert 2', expiry_in_years=1)
+        self.pi = make_user('pi')
+        self.user1 = make_user('user1')
+        self.user2 = make_user('user2')
+        inactive = make_user('inactive', is_active=False)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            LabCert.objects.create(lab=self.lab1, cert=self.cert1)
+            LabCert.objects.create(lab=self.lab2, cert=self.cert1)
+            LabCert.objects.create(lab=self.lab2, cert=self.cert2)
+            UserLab.objects.create(user=self.pi, lab=self.lab1, role=UserLab.PRINCIPAL_INVESTIGATOR)
+            UserLab.objects.create(user=self.pi, lab=self.lab2, role=UserLab.PRINCIPAL_INVESTIGATOR)
+            UserLab.objects.create(user=self.user1, lab=self.lab1, role=UserLab.LAB_USER)
+            UserLab.objects.create(user=self.user1, lab=self.lab2, role=UserLab.LAB_USER)
+            UserLab.objects.create(user=self.user2, lab=self.lab2, role=UserLab.LAB_USER)
+            UserLab.objects.create(user=inactive, lab=self.lab1, role=UserLab.LAB_USER)
+            make_user_cert(self.pi, self.cert1, date.today(), date.today() + timedelta(days=365))
+            make_user_cert(self.pi, self.cert2, date.today(), date.today() + timedelta(days=365))
+            make_user_cert(self.user2, self.cert1, date.today(), date.today() + timedelta(days=365))
+
+        mail.outbox = []
+
+    def get_emails(self):
+        return { email.to[0]: email.body for email in mail.outbox if email.subject == 'Training Record Notification' }
+
+    def test_missing_trainings(self):
+        with self.assertNumQueries(1):
+            users, areas = notifications.collect(notifications.RULES['missing'].get_records(date.today()))
+        self.assertEqual(list(users.keys()), [self.user1.id, self.user2.id])
+        self.assertEqual([tr['name'] for tr in users[self.user1.id]['trainings']], ['Engine Cert 1', 'Engine Cert 2'])
+        self.assertEqual(set(users[self.user1.id]['areas'].keys()), { self.lab1.id, self.lab2.id })
+        self.assertEqual(list(areas[self.lab1.id]['users'].keys()), [self.user1.id])
+
+        notifications.run('missing')
+
+        emails = self.get_emails()
+        self.assertEqual(set(emails.keys()), { 'Pi Test <pi@example.com>', 'User1 Test <user1@example.com>', 'User2 Test <user2@example.com>' })
+        self.assertIn('Engine Lab 1', emails['User1 Test <user1@example.com>'])
+        self.assertNotIn('Engine Cert 1', emails['User2 Test <user2@example.com>'])
+
+        body = emails['Pi Test <pi@example.com>']
+        self.assertIn('<h4>Engine Lab 1</h4>', body)
+        self.assertIn('<h4>Engine Lab 2</h4>', body)
+        self.assertNotIn('Inactive', body)
+
+    def test_expiry_date(self):
+        past = date.today() - timedelta(days=400)
+        with self.captureOnCommitCallbacks(execute=True):
+            make_user_cert(self.user1, self.cert1, past, past + timedelta(days=365))
+            make_user_cert(self.user1, self.cert2, past, past + timedelta(days=300))
+
+        with self.assertNumQueries(2):
+            users, _ = notifications.collect(notifications.RULES['after_expiry'].get_records(date.today()))
+        self.assertEqual(list(users.keys()), [self.user1.id])
+
+        notifications.run('after_expiry', audiences=['pis'])
+
+        body = self.get_emails()['Pi Test <pi@example.com>']
+        self.assertEqual(body.count('Engine Cert 1'), 2)
+        self.assertEqual(body.count('Engine Cert 2'), 1)
+
+        mail.outbox = []
+        notifications.run('after_expiry', audiences=['users'], since=past + timedelta(days=330))
+        body = self.get_emails()['User1 Test <user1@example.com>']
+        self.assertIn('Engine Cert 1', body)
+        self.assertNotIn('Engine Cert 2', body)
+
+    def test_dry_run_and_limit(self):
+        emails = notifications.run('missing', dry_run=True)
+        self.assertEqual(len(emails), 3)
+        self.assertEqual(self.get_emails(), {})
+
+        emails = notifications.run('missing', limit=1)
+        self.assertEqual(len(emails), 1)
+        self.assertEqual(list(self.get_emails().keys()), [emails[0]['receiver']])
+
+    def test_rule_audiences(self):
+        self.assertEqual(notifications.run('missing', audiences=['admins']), [])
+
+        # A rule needs a message builder for each of its audiences
+        with self.assertRaises(TypeError):
+            notifications.MissingRule(audiences=['users', 'admins'])
+
+    def test_command(self):
+        out = StringIO()
+        call_command('send_notifications', 'missing', 'after_expiry', '--audience', 'users', '--audience', 'admins', '--dry-run', stdout=out)
+
+        self.assertIn('missing: 2 emails', out.getvalue())
+        self.assertIn('after_expiry: 0 emails', out.getvalue())
+        self.assertEqual(self.get_emails(), {})
+
+    def test_command_all_rules(self):
+        out = StringIO()
+        call_command('send_notifications', '--dry-run', stdout=out)
+        self.assertIn('missing: 3 emails', out.getvalue())
+
+        with self.assertRaises(CommandError):
+            call_command('send_notifications', 'unknown', stdout=out)
+
+    def test_ledger_skips_unchanged_digests(self):
+        notifications.run('missing')
+        self.assertEqual(len(self.get_emails()), 3)
+        self.assertEqual(NotificationLog.objects.filter(rule='missing', recipient='pi@example.com').count(), 3)
+
+        mail.outbox = []
+        emails = notifications.run('missing')
+        self.assertEqual(emails, [])
+
+        # Only the recipients whose digest changed are reminded again
+        with self.captureOnCommitCallbacks(execute=True):
+            make_user_cert(self.user1, self.cert2, date.today(), date.today() + timedelta(days=365))
+        notifications.run('missing')
+        self.assertEqual(set(self.get_emails().keys()), { 'Pi Test <pi@example.com>', 'User1 Test <user1@example.com>' })
+
+        runs = NotificationRun.objects.filter(rule='missing').order_by('id')
+        self.assertEqual([(run.num_emails, run.num_skipped) for run in runs], [(3, 0), (0, 3), (2, 1)])
+
+    @override_settings(NOTIFICATION_COOLDOWN_DAYS=7)
+    def test_ledger_cooldown(self):
+        notifications.run('missing', audiences=['users'])
+        NotificationLog.objects.update(sent_at=timezone.now() - timedelta(days=8))
+
+        emails = notifications.run('missing', audiences=['users'])
+        self.assertEqual(len(emails), 2)
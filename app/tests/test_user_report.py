@@ -0,0 +1,109 @@
+from django.test import TestCase, Client
+from django.urls import reverse
+from django.contrib.auth.models import User
+from io import BytesIO
+from openpyxl import load_workbook
+import json
+
+from lfs_lab_cert_tracker.models import Lab, Cert, UserLab, LabCert
+
+LOGIN_URL = reverse('accounts:local_login')
+
+
+class DownloadUserReportMissingTrainingsTest(TestCase):
+
+    def setUp(self):
+        self.client = Client()
+        User.objects.create_superuser(username='report_admin', email='report_admin@example.com', password='password')
+        self.user = User.objects.create_user(username='report_user', first_name='Report', last_name='User', email='report_user@example.com')
+        inactive_user = User.objects.create_user(username='report_inactive', email='report_inactive@example.com', is_active=False)
+
+        lab1 = Lab.objects.create(name='Report Lab 1')
+        lab2 = Lab.objects.create(name='Report Lab 2')
+        cert1 = Cert.objects.create(name='Report Cert B', expiry_in_years=1)
+        cert2 = Cert.objects.create(name='Report Cert A', expiry_in_years=1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            LabCert.objects.create(lab=lab1, cert=cert1)
+            LabCert.objects.create(lab=lab1, cert=cert2)
+            LabCert.objects.create(lab=lab2, cert=cert1)
+            UserLab.objects.create(user=self.user, lab=lab1, role=UserLab.LAB_USER)
+            UserLab.objects.create(user=self.user, lab=lab2, role=UserLab.LAB_USER)
+            UserLab.objects.create(user=inactive_user, lab=lab1, role=UserLab.LAB_USER)
+
+        self.client.post(LOGIN_URL, data={'username': 'report_admin', 'password': 'password'})
+        self.url = reverse('app:download_user_report_missing_trainings')
+
+    def test_csv(self):
+        response = self.client.get(self.url)
+        self.assertTrue(response.streaming)
+        self.assertIn('attachment;', response['Content-Disposition'])
+
+        content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertEqual(content, (
+            'ID,CWL,First Name,Last Name,Number of Missing Trainings,Missing Trainings\r\n'
+            '{0},report_user,Report,User,2,"Report Cert A\nReport Cert B"\r\n'.format(self.user.id)
+        ))
+
+    def test_ndjson(self):
+        response = self.client.get(self.url, {'format': 'ndjson'})
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line) for line in lines], [{
+            'id': self.user.id,
+            'username': 'report_user',
+            'first_name': 'Report',
+            'last_name': 'User',
+            'num_missing_trainings': 2,
+            'missing_trainings': ['Report Cert A', 'Report Cert B']
+        }])
+
+    def test_xlsx(self):
+        response = self.client.get(self.url, {'format': 'xlsx'})
+        ws = load_workbook(BytesIO(b''.join(response.streaming_content))).active
+        rows = list(ws.values)
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1], (self.user.id, 'report_user', 'Report', 'User', 2, 'Report Cert A\nReport Cert B'))
+
+    def test_invalid_format(self):
+        response = self.client.get(self.url, {'format': 'pdf'})
+        self.assertEqual(response.status_code, 400)
+
+
+class UserReportMissingTrainingsTest(TestCase):
+
+    def setUp(self):
+        self.client = Client()
+        User.objects.create_superuser(username='report_admin', email='report_admin@example.com', password='password')
+        lab = Lab.objects.create(name='Report Lab')
+        cert = Cert.objects.create(name='Report Cert', expiry_in_years=1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            LabCert.objects.create(lab=lab, cert=cert)
+            for i in range(25):
+                user = User.objects.create_user(username='report_user_{0}'.format(i), first_name='Report', last_name='User {0:02d}'.format(i % 12), email='report_user_{0}@example.com'.format(i))
+                UserLab.objects.create(user=user, lab=lab, role=UserLab.LAB_USER)
+
+        self.client.post(LOGIN_URL, data={'username': 'report_admin', 'password': 'password'})
+        self.url = reverse('app:user_report_missing_trainings')
+        self.expected = list(User.objects.filter(username__startswith='report_user_').order_by('last_name', 'first_name', 'id'))
+
+    def test_keyset_pages(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.context['total_users'], 25)
+
+        pages = [response.context['users']]
+        while pages[-1].has_next:
+            pages.append(self.client.get(self.url, {'after': pages[-1].next_cursor}).context['users'])
+
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual([user for page in pages for user in page], self.expected)
+        self.assertFalse(pages[0].has_previous)
+        self.assertEqual(pages[0].object_list[0].missing_certs, ['Report Cert'])
+
+        previous_page = self.client.get(self.url, {'before': pages[2].previous_cursor}).context['users']
+        self.assertEqual(previous_page.object_list, pages[1].object_list)
+        self.assertTrue(previous_page.has_previous)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url, {'after': 'abc'})
+        self.assertEqual(list(response.context['users']), self.expected[:10])
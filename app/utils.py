@@ -1 +1,83 @@
-NUM_PER_PAGE = 20
\ No newline at end of file
+from django.db.models import Q
+import threading
+import time
+
+NUM_PER_PAGE = 20
+
+
+class KeysetPage:
+    """ A page of a queryset which is located by the row before or after it instead of an offset """
+
+    def __init__(self, object_list, has_previous, has_next):
+        self.object_list = object_list
+        self.has_previous = has_previous
+        self.has_next = has_next
+        self.previous_cursor = object_list[0].pk if object_list else None
+        self.next_cursor = object_list[-1].pk if object_list else None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def get_cursor(value):
+    """ Get a cursor (the pk of a row) from a query string value """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def keyset_filter(fields, values, lookup):
+    """ Build (f1, f2, ...) > (v1, v2, ...) or < as a Q object """
+
+    q = Q()
+    for i, field in enumerate(fields):
+        condition = Q(**{ '{0}__{1}'.format(field, lookup): values[field] })
+        for prev_field in fields[:i]:
+            condition &= Q(**{ prev_field: values[prev_field] })
+        q |= condition
+
+    # f1 >= v1 is implied, but it lets an index on the fields start its scan at the cursor
+    return Q(**{ '{0}__{1}e'.format(fields[0], lookup): values[fields[0]] }) & q
+
+
+def get_keyset_page(queryset, fields, after=None, before=None, per_page=NUM_PER_PAGE):
+    """
+    Get a page of a queryset ordered by fields, starting after or ending before the row of a cursor.
+    The last field must be unique, e.g. ['last_name', 'first_name', 'id']
+    """
+
+    cursor = after if after is not None else before
+    values = queryset.model.objects.filter(pk=cursor).values(*fields).first() if cursor is not None else None
+
+    if values and before is not None:
+        reverse_fields = ['-' + field for field in fields]
+        rows = list(queryset.filter(keyset_filter(fields, values, 'lt')).order_by(*reverse_fields)[:per_page + 1])
+        return KeysetPage(rows[:per_page][::-1], len(rows) > per_page, True)
+
+    if values:
+        queryset = queryset.filter(keyset_filter(fields, values, 'gt'))
+
+    rows = list(queryset.order_by(*fields)[:per_page + 1])
+    return KeysetPage(rows[:per_page], values is not None, len(rows) > per_page)
+
+
+class RateLimiter:
+    """ Spread calls of wait() across threads so that at most `rate` calls pass per second """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
@@ -24,8 +24,9 @@ def find_users_by_days(users, target_day, type):
                     if pi not in pis: pis[pi] = dict()
                     if uid not in pis[pi]: pis[pi][uid] = []
 
-                    for cert in lab['certs']:
-                        if 'expiry_date' in cert and 'completion_date' in cert and cert['expiry_date'] != cert['completion_date']:
+                    for lab_cert in lab['certs']:
+                        cert = get_user_cert(user, lab_cert)
+                        if cert is not None and cert['expiry_date'] != cert['completion_date']:
                             if type == 'before':
                                 if cert['expiry_date'] == target_day:
                                     if contain_cert(lab_user['certs'], cert['id']) == False:
@@ -86,6 +87,16 @@ def send_email_14days_before(users, certs, admin, type):
 
 # Helper functions
 
+def get_user_cert(user, cert):
+    """ Get a cert with the dates of the user's latest record, or None if the user has no record """
+
+    dates = user['certs'].get(cert['id'])
+    if dates is None:
+        return None
+
+    return { 'id': cert['id'], 'name': cert['name'], 'expiry_date': dates['expiry_date'], 'completion_date': dates['completion_date'] }
+
+
 def contain_cert(certs, cert_id):
     """ Check whether user's certs contain a cert """
 
@@ -1,12 +1,14 @@
 import psycopg2
-import copy
+from psycopg2.extras import RealDictCursor
+
+# The number of rows fetched from the server at a time by each cursor
+ITERSIZE = 2000
 
 class CertTrackerDatabase:
 
     def __init__(self, user, password, host, port, database):
         try:
             self.connection = psycopg2.connect(user=user, password=password, host=host, port=port, database=database)
-            self.cursor = self.connection.cursor()
 
         except (Exception, psycopg2.Error) as error :
             print ("Error while connecting to PostgreSQL", error)
@@ -19,45 +21,43 @@ class CertTrackerDatabase:
                 self.certs = certs
 
     def close(self):
-        self.cursor.close()
         self.connection.close()
 
+    def iter_rows(self, name, query):
+        """ Stream rows as dicts through a server-side cursor, so that only ITERSIZE rows are in memory at a time """
+
+        with self.connection.cursor(name=name, cursor_factory=RealDictCursor) as cursor:
+            cursor.itersize = ITERSIZE
+            cursor.execute(query)
+            for row in cursor:
+                yield row
+
     def get_all_users(self):
-        """ Get all users """
+        """ Get all active users """
 
-        self.cursor.execute("SELECT * FROM auth_user;")
-        rows = self.cursor.fetchall()
         users = dict()
-        for row in rows:
-            is_active = row[9]
-            if is_active:
-                id = row[0]
-                users[id] = {
-                    'id': id,
-                    'is_superuser': row[3],
-                    'username': row[4],
-                    'first_name': row[5],
-                    'last_name': row[6],
-                    'email': row[7],
-                    'is_active': is_active,
-                    'has_expiry_cert': False,
-                    'uploaded_certs': set(),
-                    'labs': []
-                }
+        for row in self.iter_rows('users', "SELECT id, is_superuser, username, first_name, last_name, email FROM auth_user WHERE is_active;"):
+            users[row['id']] = {
+                'id': row['id'],
+                'is_superuser': row['is_superuser'],
+                'username': row['username'],
+                'first_name': row['first_name'],
+                'last_name': row['last_name'],
+                'email': row['email'],
+                'is_active': True,
+                'has_expiry_cert': False,
+                'certs': dict(),
+                'labs': []
+            }
         return users
 
 
     def get_all_labs(self):
         """ Get all labs """
 
-        self.cursor.execute("SELECT * FROM lfs_lab_cert_tracker_lab;")
-        rows = self.cursor.fetchall()
         labs = dict()
-        for row in rows:
-            id = row[0]
-            name = row[1]
-            lab = { 'id': id, 'name': name, 'pis': set(), 'certs': [] }
-            labs[id] = lab
+        for row in self.iter_rows('labs', "SELECT id, name FROM lfs_lab_cert_tracker_lab;"):
+            labs[row['id']] = { 'id': row['id'], 'name': row['name'], 'pis': set(), 'certs': [] }
 
         return labs
 
@@ -65,14 +65,9 @@ class CertTrackerDatabase:
     def get_all_certs(self):
         """ Get all certs """
 
-        self.cursor.execute("SELECT * FROM lfs_lab_cert_tracker_cert;")
-        rows = self.cursor.fetchall()
         certs = dict()
-        for row in rows:
-            id = row[0]
-            name = row[1]
-            cert = { 'id': id, 'name': name }
-            certs[id] = cert
+        for row in self.iter_rows('certs', "SELECT id, name FROM lfs_lab_cert_tracker_cert;"):
+            certs[row['id']] = { 'id': row['id'], 'name': row['name'] }
 
         return certs
 
@@ -80,87 +75,57 @@ class CertTrackerDatabase:
     def get_all_userlabs(self):
         """ Get all userlabs """
 
-        self.cursor.execute("SELECT * FROM lfs_lab_cert_tracker_userlab;")
-        rows = self.cursor.fetchall()
-        return [ { 'id': row[0], 'role': row[1],'lab_id': row[2], 'user_id': row[3] } for row in rows ]
+        return self.iter_rows('userlabs', "SELECT id, role, lab_id, user_id FROM lfs_lab_cert_tracker_userlab;")
 
 
     def get_all_labcerts(self):
         """ Get all labcerts """
-        self.cursor.execute("SELECT * FROM lfs_lab_cert_tracker_labcert;")
-        rows = self.cursor.fetchall()
-        return [ { 'id': row[0], 'cert_id': row[1], 'lab_id': row[2] } for row in rows ]
 
+        return self.iter_rows('labcerts', "SELECT id, cert_id, lab_id FROM lfs_lab_cert_tracker_labcert;")
 
-    def get_all_usercerts(self):
-        """ Get all usercerts """
 
-        self.cursor.execute("SELECT * FROM lfs_lab_cert_tracker_usercert;")
-        rows = self.cursor.fetchall()
-        return [ {
-            'id': row[0],
-            'expiry_date': row[4],
-            'cert_id': row[5],
-            'user_id': row[6],
-            'completion_date': row[3]
-        } for row in rows ]
+    def get_latest_usercerts(self):
+        """ Get the latest usercert of each user and cert, preferring certs which expire """
+
+        return self.iter_rows('usercerts', """\
+            SELECT DISTINCT ON (user_id, cert_id) user_id, cert_id, completion_date, expiry_date
+            FROM lfs_lab_cert_tracker_usercert
+            ORDER BY user_id, cert_id, completion_date = expiry_date, expiry_date DESC, id DESC;
+        """)
 
 
     def fetch_data(self):
         """ Fetch data, and users have labs' information and
-        certificates' information """
+        the dates of their latest certificates """
 
         users = self.get_all_users()
         labs = self.get_all_labs()
         certs = self.get_all_certs()
-        labcerts = self.get_all_labcerts()
-        userlabs = self.get_all_userlabs()
-        usercerts = self.get_all_usercerts()
-        all_certs = copy.deepcopy(certs)
 
         # Add cert info to each lab
-        for labcert in labcerts:
-            lab = labs[ labcert['lab_id'] ]
-            cert = certs[ labcert['cert_id'] ]
-            lab['certs'].append(cert)
+        for labcert in self.get_all_labcerts():
+            labs[ labcert['lab_id'] ]['certs'].append(certs[ labcert['cert_id'] ])
 
-        # Add lab info to each user
-        for userlab in userlabs:
+        # Add lab info to each user. Labs are shared by their users, and the dates of each user are kept in user['certs']
+        for userlab in self.get_all_userlabs():
             if userlab['user_id'] in users.keys():
-                role = userlab['role']
                 lab = labs[ userlab['lab_id'] ]
-                user = users[ userlab['user_id'] ]
-
-                if role == 1:
+                if userlab['role'] == 1:
                     lab['pis'].add(userlab['user_id'])
-                user['labs'].append(lab)
-
-        # Add cert info to each user's lab
-        for usercert in usercerts:
-            cert_id = usercert['cert_id']
-            user_id = usercert['user_id']
-            expiry_date = usercert['expiry_date']
-            completion_date = usercert['completion_date']
-
-            if user_id in users.keys():
-                users[user_id]['uploaded_certs'].add(cert_id)
-
-                # Important!
-                # Each lab should be updated by user_id for certificates
-                labs = copy.deepcopy(users[user_id]['labs'])
-
-                for lab in labs:
-                    certs = lab['certs']
-                    for cert in certs:
-                        if cert_id == cert['id']:
-                            cert['expiry_date'] = expiry_date
-                            cert['completion_date'] = completion_date
-                            if users[user_id]['has_expiry_cert'] == False:
-                                users[user_id]['has_expiry_cert'] = expiry_date != completion_date
-
-                users[user_id]['labs'] = labs
-
-        return users, all_certs
+                users[ userlab['user_id'] ]['labs'].append(lab)
+
+        # Add the dates of the latest cert to each user
+        for usercert in self.get_latest_usercerts():
+            user = users.get(usercert['user_id'])
+            if user is not None:
+                expiry_date = usercert['expiry_date']
+                completion_date = usercert['completion_date']
+                user['certs'][ usercert['cert_id'] ] = { 'expiry_date': expiry_date, 'completion_date': completion_date }
+                if expiry_date != completion_date:
+                    user['has_expiry_cert'] = True
+
+        self.connection.commit()
+        return users, certs
 
     def get_users(self):
         """ get all users """
@@ -63,7 +63,7 @@ def find_missing_cert_users(users, certs):
             for cert in lab['certs']:
                 required_certs.add(cert['id'])
 
-        missing_certs = required_certs - user['uploaded_certs']
+        missing_certs = required_certs - user['certs'].keys()
         if len(missing_certs) > 0:
             lab_users.append({ 'id': id, 'missing_certs': list(missing_certs) })
 
@@ -19,12 +19,13 @@ from django.core.exceptions import SuspiciousOperation
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.shortcuts import get_object_or_404
 from django.apps import apps
-from django.core.mail import send_mail
 from django.core.validators import validate_email
 
 from lfs_lab_cert_tracker.models import Lab, Cert
 from app.accesses import access_admin_only, access_pi_admin_key_request, access_group_coordinator_admin_key_request
 from app import functions as appFunc
+from app import mailer
+from app.permissions import invalidate_permissions
 from app.utils import NUM_PER_PAGE
 from .email_coordinator import ApprovalNotificationManager
 
@@ -88,11 +89,7 @@ class AllRequests(LoginRequiredMixin, View):
         except EmptyPage:
             forms = paginator.page(paginator.num_pages)
 
-        for form in forms:
-            user_trainings, total_missing, total_expired = func.check_user_trainings(form.user, [room.id for room in form.rooms.all()])
-            form.user_trainings = user_trainings
-            form.total_missing = total_missing
-            form.total_expired = total_expired
+        func.check_user_trainings_bulk(forms)
 
         return render(request, 'key_request/admin/all_requests.html', {
             'total_forms': coordinator.get_total_forms(),
@@ -337,11 +334,13 @@ def send_emails(request):
 
     user = get_object_or_404(User, id=user_id)
     room = get_object_or_404(Room, id=room_id)
-    sent = send(user, room, email_type, expiry_date)
-    if sent:
-        messages.success(request, 'Success! An email for the {0} has been sent.'.format(email_type))
+    result = send(user, room, email_type, expiry_date)
+    if result == mailer.QUEUED:
+        messages.success(request, 'Success! An email for the {0} has been queued.'.format(email_type))
+    elif result == mailer.ALREADY_QUEUED:
+        messages.info(request, 'Info! An email for the {0} has already been queued.'.format(email_type))
     else:
-        messages.error(request, 'An error occurred. Failed to send an email for the {0}.'.format(email_type))
+        messages.error(request, 'An error occurred. Failed to queue an email for the {0}.'.format(email_type))
 
     return HttpResponseRedirect(next)
 
@@ -382,13 +381,13 @@ def send(user, room, email_type, expiry_date):
 <p>LFS Access and Training Record System (LFS ATRS)</p>
 </div>'''.format(user.get_full_name(), room_name, expiry_date)
 
-    sent = send_mail(title, message, settings.EMAIL_FROM, [ user.email ], fail_silently=False, html_message=message)
+    # An admin may send the same email again on purpose, so it is not deduped by its content
+    result = mailer.enqueue_email(user.email, title, message, mailer.get_unique_key())
 
-    if sent:
+    if result == mailer.QUEUED:
         msg = '<p>{0}</p><hr />{1}'.format(title, message)
         RoomEmail.objects.create(user=user, room=room, type=email_type, message=msg)
-        return True
-    return False
+    return result
 
 
 @login_required(login_url=settings.LOGIN_URL)
@@ -1177,6 +1176,7 @@ class CreateApprovalGroup(LoginRequiredMixin, View):
                 ApprovalGroupRole(group=group, user_id=user_id, role=role)
                 for user_id, role in role_by_id.items()
             ])
+            invalidate_permissions()
 
             messages.success(request, 'Success! {0} has been created.'.format(group.name))
 
@@ -1272,6 +1272,7 @@ class EditApprovalGroups(LoginRequiredMixin, View):
                 ApprovalGroupRole(group=self.group, user_id=user_id, role=role)
                 for user_id, role in role_by_id.items()
             ])
+            invalidate_permissions()
 
             group_name = form.cleaned_data['name']
 
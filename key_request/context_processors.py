@@ -1,9 +1,7 @@
-from key_request import functions as func
+from app.permissions import get_permissions
 
 def is_room_manager(request):
-    exists = False
-    if request.user.is_authenticated:
-        exists = func.is_room_approver(request.user.id)
+    """ Navigation flag read from the set of room approvers in the shared cache, so pages add no queries """
     return {
-        'is_room_manager': exists
+        'is_room_manager': get_permissions(request).is_room_approver
     }
@@ -1,7 +1,9 @@
-from key_request.models import Room, RequestFormStatus, ApprovalGroup, RequestForm
-from django.contrib.auth.models import User
-from django.db.models import Q, Count, OuterRef, Subquery, Exists
-from key_request.functions import has_date_passed, make_request_form_identifier, all_pis_approved
+import copy
+
+from key_request.models import Room, RequestFormApproval, ApprovalGroup, RequestForm
+from django.db.models import Q, F, Count, Value, BooleanField, ExpressionWrapper, OuterRef, Subquery, QuerySet, prefetch_related_objects
+from django.db.models.functions import Concat
+from key_request.functions import make_request_form_identifier, all_pis_approved_many
 from django.utils import timezone
 
 from key_request.utils import REV_REQUEST_STATUS_DICT, APPROVED
@@ -47,32 +49,34 @@ class RequestFormProcessor:
         return filtered_rooms
 
     def get_all_filtered_forms(self):
+        """ Get the filtered forms as a lazy queryset, so that a paginator only loads a page of them """
 
         rooms = self.get_all_filtered_rooms()
 
-        latest_status_sq = RequestFormStatus.objects.filter(
-            form_id=OuterRef('pk'),
-            room__in=rooms,
-        ).order_by('-created_at').values('status')[:1]
+        if self.building_q or self.floor_q or self.number_q:
+            # Latest status in the filtered rooms
+            status = Subquery(
+                RequestFormApproval.objects.filter(form_id=OuterRef('pk'), room__in=rooms)
+                .order_by('-status_created_at').values('status')[:1]
+            )
+        else:
+            status = F('latest_status')
 
         forms = RequestForm.objects.filter(rooms__in=rooms).distinct().annotate(
-            status=Subquery(latest_status_sq)
-        )
-        filtered_forms = []
+            status=status
+        ).annotate(
+            is_new=ExpressionWrapper(Q(status__isnull=True), output_field=BooleanField()),
+            label=Value(self.label),
+            priority=Value(self.priority)
+        ).select_related('user', 'supervisor')
 
-        for form in forms:
-            if self._form_matches_filter(form):
-                is_new = False if form.status else True
-                form = self._annotate_form_object(form, None, is_new)
-                filtered_forms.append(form)
-
-        return filtered_forms
+        return self._filter_by_name(self._filter_by_status(forms))
 
     def get_total_form_stats(self):
 
         result = RequestForm.objects.filter(rooms__in=self.get_all_rooms()).aggregate(
             total_forms=Count('pk', distinct=True),
-            total_new_forms=Count('pk', filter=Q(requestformstatus__isnull=True), distinct=True),
+            total_new_forms=Count('pk', filter=Q(latest_status_at__isnull=True), distinct=True),
         )
         return result['total_forms'], result['total_new_forms']
 
@@ -109,16 +113,26 @@ class RequestFormProcessor:
 
         return False
 
-    def _validate_name(self, user):
-        if not self.name_q:
-            return True
+    def _filter_by_status(self, forms):
+        """ Same as _validate_form_status, on the status annotated in SQL """
+        if not self.status_q:
+            return forms
+
+        if self.status_q == "New":
+            return forms.filter(status__isnull=True)
 
-        fullname = f"{user.get_full_name().lower()}"
+        if self.status_q in REV_REQUEST_STATUS_DICT.keys():
+            return forms.filter(status=REV_REQUEST_STATUS_DICT.get(self.status_q))
+
+        return forms.none()
 
-        return self.name_q in fullname
+    def _filter_by_name(self, forms):
+        if not self.name_q:
+            return forms
 
-    def _form_matches_filter(self, form):
-        return self._validate_form_status(form.status) and self._validate_name(form.user)
+        return forms.annotate(
+            user_full_name=Concat('user__first_name', Value(' '), 'user__last_name')
+        ).filter(user_full_name__icontains=self.name_q)
 
     def _annotate_form_object(self, form, room, is_new):
         form.is_new = is_new
@@ -134,13 +148,14 @@ class ApplicantRequestFormProcessor:
 
     def get_all_status_annotated_forms(self, forms):
 
+        prefetch_related_objects(forms, 'rooms')
+        approved = all_pis_approved_many([(form, room) for form in forms for room in form.rooms.all()])
+
         for form in forms:
             form.status = "Approved"
-            latest_status = form.requestformstatus_set.all().order_by('-created_at')
-            if latest_status:
-                form.status_created_at = latest_status.first().created_at
+            form.status_created_at = form.latest_status_at
             for room in form.rooms.all():
-                if not(all_pis_approved(form, room)):
+                if not approved[(form.id, room.id)]:
                     form.status = 'Pending by Supervisor'
                     form.status_created_at = None
                     break
@@ -148,6 +163,10 @@ class ApplicantRequestFormProcessor:
         return forms
 
 class EntityRequestFormProcessor(RequestFormProcessor):
+    """ Forms of the rooms approved by an entity (a manager or a group), with one entry per (form, room, entity) """
+
+    # Field of RequestFormApproval which holds the entity
+    entity_field = None
 
     def __init__(self, query, user):
         super().__init__(query, user)
@@ -158,86 +177,79 @@ class EntityRequestFormProcessor(RequestFormProcessor):
 
     def get_all_filtered_forms(self):
 
-        # Attach RequestFormStatus & filter
-        filtered_rooms = self.get_all_filtered_rooms()
+        # Attach the latest status & filter
+        rooms = {room.id: room for room in self.get_all_filtered_rooms()}
+        room_ids = list(rooms.keys())
+        room_entities = self._get_room_entities(room_ids)
+        latest_statuses = self._get_latest_statuses(room_ids)
+
         forms = []
-        for room in filtered_rooms:
-            for entity_filter in self._get_entity_filters_for_room(room):
-                self._set_current_entity(room, **entity_filter)
-                latest_status = self._build_latest_status_subquery(room.id, **entity_filter)
-                room_forms = self._get_latest_status_room_forms(room, latest_status)
-                forms += self._process_room_forms(room, room_forms)
+        for room_form in self._get_room_forms(room_ids):
+            room = rooms[room_form.form_room_id]
+            for i, entity in enumerate(room_entities.get(room.id, [])):
+                # Each entity gets its own copy of the form
+                form = room_form if i == 0 else copy.copy(room_form)
+                latest_status = latest_statuses.get((form.id, room.id, entity.id))
+                form.status = latest_status['status'] if latest_status else None
+                form.status_created_at = latest_status['status_created_at'] if latest_status else None
+
+                form = self._annotate_form_object(form, room, entity, latest_status is None)
+                if self._validate_form_status(form.status):
+                    forms.append(form)
         return forms
 
-    def _build_latest_status_subquery(self, room_id, **entity_filter):
-        return RequestFormStatus.objects.filter(
-            form_id=OuterRef('pk'),
-            room_id=room_id,
-            **entity_filter
-        ).order_by('-created_at')
-
-    def _get_latest_status_room_forms(self, room, latest_status_subquery):
-
-        room_forms = (
-            RequestForm.objects.filter(rooms=room)
-            .annotate(
-                status=Subquery(latest_status_subquery.values('status')[:1]),
-                status_created_at=Subquery(latest_status_subquery.values('created_at')[:1]),
-                status_count=Subquery(
-                    latest_status_subquery.values('form_id')
-                    .annotate(c=Count('id'))
-                    .values('c')[:1]
-                ),
-            )
+    def get_total_form_stats(self):
+        room_ids = list(self.get_all_rooms().values_list('id', flat=True))
+        room_entities = self._get_room_entities(room_ids)
+
+        num_room_forms = dict(
+            RequestForm.rooms.through.objects.filter(room_id__in=room_ids)
+            .values('room_id').annotate(c=Count('id')).values_list('room_id', 'c')
         )
+        total_forms = sum(num_room_forms.get(room_id, 0) * len(entities) for room_id, entities in room_entities.items())
 
-        return room_forms
+        # A form is new to an entity until it has a status of the entity in the room
+        actioned = (
+            RequestFormApproval.objects.filter(room_id__in=room_ids, form__rooms=F('room'), **self._get_status_filter())
+            .values_list('form_id', 'room_id', self.entity_field)
+        )
+        entity_ids = {room_id: {entity.id for entity in entities} for room_id, entities in room_entities.items()}
+        num_actioned = sum(1 for _, room_id, entity_id in actioned if entity_id in entity_ids.get(room_id, ()))
 
-    def _get_entity_filters_for_room(self, room):
-        """Yield one or more kwarg-dicts to filter RequestFormStatus by, for this room."""
-        raise NotImplementedError
+        return total_forms, total_forms - num_actioned
 
-    def _process_room_forms(self, room, room_forms):
-        processed_forms = []
+    def _get_room_forms(self, room_ids):
+        """ Get one form object per (form, room), with the room in form_room_id """
+        forms = RequestForm.objects.filter(rooms__in=room_ids).annotate(form_room_id=F('rooms')).select_related('user')
+        return self._filter_by_name(forms)
 
-        for form in room_forms:
-            is_new = not form.status_count
-            annotated_form = self._annotate_form_object(form, room, is_new)
+    def _get_latest_statuses(self, room_ids):
+        """ Get the latest status per (form, room, entity) from RequestFormApproval """
 
-            if self._form_matches_filter(annotated_form):
-                processed_forms.append(annotated_form)
+        statuses = (
+            RequestFormApproval.objects.filter(room_id__in=room_ids, **self._get_status_filter())
+            .values('form_id', 'room_id', self.entity_field, 'status', 'status_created_at')
+        )
+        return {(status['form_id'], status['room_id'], status[self.entity_field]): status for status in statuses}
 
-        return processed_forms
+    def _get_room_entities(self, room_ids):
+        """ Children return {room_id: [entity, ...]} for the rooms """
+        raise NotImplementedError
 
-    def _set_current_entity(self, room, **entity_filter):
-        """Children override this to set self.manager, self.group, etc."""
-        pass
+    def _get_status_filter(self):
+        """ Children return kwargs to filter RequestFormApproval by their entities """
+        raise NotImplementedError
 
-    def _annotate_form_object(self, form, room, is_new):
+    def _annotate_form_object(self, form, room, entity, is_new):
         super()._annotate_form_object(form, room, is_new)
         form.manager = None
         form.group = None
         return form
 
-    def _get_new_forms_subquery(self):
-        return RequestFormStatus.objects.none()
-
-    def get_total_form_stats(self):
-        total_forms = 0
-        total_new_forms = 0
-
-        for room in self.get_all_rooms():
-            for entity_filter in self._get_entity_filters_for_room(room):
-                latest_status = self._build_latest_status_subquery(room.id, **entity_filter)
-                room_forms = self._get_latest_status_room_forms(room, latest_status)
-
-                total_forms += room_forms.count()
-                total_new_forms += room_forms.filter(status_count__isnull=True).count()
-
-        return total_forms, total_new_forms
-
 class GroupFormProcessor(EntityRequestFormProcessor):
 
+    entity_field = 'group_id'
+
     def __init__(self, query, user):
         super().__init__(query, user)
 
@@ -251,29 +263,32 @@ class GroupFormProcessor(EntityRequestFormProcessor):
     def get_all_rooms(self):
         return Room.objects.filter(Q(groups__roles__user=self.user)).distinct()
 
-    def _get_entity_filters_for_room(self, room):
-        room_groups = self.user_groups.filter(group_rooms=room)
-        for group in room_groups:
-            yield {"group_id": group.id}
-
-    def _get_new_forms_subquery(self):
-        return RequestFormStatus.objects.filter(
-            group__in=self.user_groups,
-            form=OuterRef('pk'),
+    def _get_room_entities(self, room_ids):
+        groups = {group.id: group for group in self.user_groups}
+        room_groups = (
+            Room.groups.through.objects.filter(room_id__in=room_ids, approvalgroup_id__in=groups.keys())
+            .order_by('approvalgroup__name', 'approvalgroup_id')
+            .values_list('room_id', 'approvalgroup_id')
         )
 
-    def _set_current_entity(self, room, **entity_filter):
-        group_id = entity_filter.get('group_id')
-        self.current_group = self.user_groups.filter(pk=group_id).first() if group_id else None
+        room_entities = {}
+        for room_id, group_id in room_groups:
+            room_entities.setdefault(room_id, []).append(groups[group_id])
+        return room_entities
 
-    def _annotate_form_object(self, form, room, is_new):
-        form = super()._annotate_form_object(form, room, is_new)
-        form.group = self.current_group
-        form.request_form_identifier = make_request_form_identifier(room, form, 'group_id', self.current_group.id)
+    def _get_status_filter(self):
+        return {'group__in': self.user_groups}
+
+    def _annotate_form_object(self, form, room, entity, is_new):
+        form = super()._annotate_form_object(form, room, entity, is_new)
+        form.group = entity
+        form.request_form_identifier = make_request_form_identifier(room, form, 'group_id', entity.id)
         return form
 
 class ManagerFormProcessor(EntityRequestFormProcessor):
 
+    entity_field = 'manager_id'
+
     def __init__(self, query, user):
         super().__init__(query, user)
 
@@ -283,37 +298,31 @@ class ManagerFormProcessor(EntityRequestFormProcessor):
     def get_all_rooms(self):
         return Room.objects.filter(Q(managers=self.user)).distinct()
 
-    def _get_entity_filters_for_room(self, room):
-        yield {"manager_id": self.user.id}
-
-    def _get_new_forms_subquery(self):
-        return RequestFormStatus.objects.filter(
-            manager=self.user,
-            form=OuterRef('pk'),
-        )
+    def _get_room_entities(self, room_ids):
+        # get_all_rooms only holds the rooms of the manager
+        return {room_id: [self.user] for room_id in room_ids}
 
-    def _set_current_entity(self, room, **entity_filter):
-        manager_id = entity_filter.get('manager_id')
-        self.current_manager = self.user if manager_id == self.user.id else User.objects.filter(pk=manager_id).first()
+    def _get_status_filter(self):
+        return {'manager': self.user}
 
-    def _annotate_form_object(self, form, room, is_new):
-        form = super()._annotate_form_object(form, room, is_new)
-        form.manager = self.current_manager
-        form.request_form_identifier = make_request_form_identifier(room, form, 'manager_id', self.current_manager.id)
+    def _annotate_form_object(self, form, room, entity, is_new):
+        form = super()._annotate_form_object(form, room, entity, is_new)
+        form.manager = entity
+        form.request_form_identifier = make_request_form_identifier(room, form, 'manager_id', entity.id)
         return form
 
 
 
 class ExpiredRequestFormProcessor(RequestFormProcessor):
 
-    def _form_matches_filter(self, form):
-        return has_date_passed(form.expiry_date) and super()._form_matches_filter(form)
+    def get_all_filtered_forms(self):
+        return super().get_all_filtered_forms().filter(expiry_date__lt=timezone.localdate())
 
     def get_total_form_stats(self):
 
         result = RequestForm.objects.filter(rooms__in=self.get_all_rooms(), expiry_date__lt=timezone.now()).aggregate(
             total_forms=Count('pk', distinct=True),
-            total_new_forms=Count('pk', filter=Q(requestformstatus__isnull=True), distinct=True),
+            total_new_forms=Count('pk', filter=Q(latest_status_at__isnull=True), distinct=True),
         )
         return result['total_forms'], result['total_new_forms']
 
@@ -335,16 +344,23 @@ class DashboardCoordinator:
         self.num_total_forms = 0
         self.forms = []
 
+        processed_forms = []
         for processor in self.processors:
 
-            processed_forms = processor.get_all_filtered_forms()
-
-            self.forms += processed_forms
+            processed_forms.append(processor.get_all_filtered_forms())
             total_forms, new_forms = processor.get_total_form_stats()
 
             self.num_total_forms += total_forms
             self.num_new_forms += new_forms
 
+        # A single queryset stays lazy, so that it is paginated in SQL
+        if len(processed_forms) == 1 and isinstance(processed_forms[0], QuerySet):
+            self.forms = processed_forms[0].order_by('-submitted_at', '-pk')
+            return
+
+        for forms in processed_forms:
+            self.forms += forms
+
         self.forms = sorted(self.forms, key=lambda x: (x.submitted_at, x.priority), reverse=True)
         for i, form in enumerate(self.forms):
             form.counter = len(self.forms) - i
@@ -372,6 +388,8 @@ class DashboardCoordinator:
         return self.forms
 
     def get_num_filtered_forms(self):
+        if isinstance(self.forms, QuerySet):
+            return self.forms.count()
         return len(self.forms)
 
     def get_total_forms(self):
@@ -1,12 +1,11 @@
 from django.contrib.auth.models import User
 from django.conf import settings
-import smtplib
-from email.mime.text import MIMEText
 from app import functions as appFunc
+from app import mailer
 
 from key_request.models import RequestFormStatus, Room, RequestForm, ApprovalGroup
 from key_request.utils import APPROVED, EMAIL_FOOTER
-from key_request.functions import all_pis_approved, display_user_full_name, display_user_first_name
+from key_request.functions import all_pis_approved_many, display_user_full_name, display_user_first_name
 
 
 class ApprovalNotificationManager:
@@ -29,12 +28,15 @@ class ApprovalNotificationManager:
 
         seen_rooms_applicant = set()
 
+        rooms = Room.objects.in_bulk([req.room_id for req in self.request_form_statuses])
+        forms = RequestForm.objects.in_bulk([int(req.form_id) for req in self.request_form_statuses])
+        approved = all_pis_approved_many([(forms[int(req.form_id)], rooms[int(req.room_id)]) for req in self.request_form_statuses])
+
         for req in self.request_form_statuses:
-            room = Room.objects.get(id=req.room_id)
+            room = rooms[int(req.room_id)]
             form_id = int(req.form_id)
-            form = RequestForm.objects.get(id=form_id)
 
-            if room.id not in seen_rooms_applicant and all_pis_approved(form, room):
+            if room.id not in seen_rooms_applicant and approved[(form_id, room.id)]:
                 fully_approved.setdefault(form_id, []).append(room)
                 seen_rooms_applicant.add(room.id)
 
@@ -292,45 +294,18 @@ class ApprovalNotificationManager:
             'message': message
         }
 
-    def _send_multiple(self, contents):
-        try:
-            server = smtplib.SMTP(settings.EMAIL_HOST)
-            for item in contents:
-                user = item['user']
-                subject = item['subject']
-                message = item['message']
-                if settings.EMAIL_FROM and appFunc.check_email_valid(user.email):
-                    sender = settings.EMAIL_FROM
-                    receiver = '{0} <{1}>'.format(display_user_full_name(user), user.email)
-
-                    print(f'An email notification is sent to {receiver}')
-
-                    msg = MIMEText(message, 'html')
-                    msg['Subject'] = subject
-                    msg['From'] = sender
-                    msg['To'] = receiver
-                    server.sendmail(sender, receiver, msg.as_string())
-        except Exception as e:
-            print(e)
-        finally:
-            server.quit()
+    def _make_email(self, user, subject, message):
+        """ Make an email for the mailer, or None if the user cannot receive it """
 
-    def _send(self, user, subject, body):
         if settings.EMAIL_FROM and appFunc.check_email_valid(user.email):
-            sender = settings.EMAIL_FROM
             receiver = '{0} <{1}>'.format(display_user_full_name(user), user.email)
+            print(f'An email notification is sent to {receiver}')
+            return { 'receiver': receiver, 'subject': subject, 'message': message }
+        return None
 
-            print(f'SEND: An email notification is sent to {receiver}')
-
-            msg = MIMEText(body, 'html')
-            msg['Subject'] = subject
-            msg['From'] = sender
-            msg['To'] = receiver
+    def _send_multiple(self, contents):
+        emails = [self._make_email(item['user'], item['subject'], item['message']) for item in contents]
+        mailer.enqueue_emails([email for email in emails if email])
 
-            try:
-                server = smtplib.SMTP(settings.EMAIL_HOST)
-                server.sendmail(sender, receiver, msg.as_string())
-            except Exception as e:
-                print(e)
-            finally:
-                server.quit()
+    def _send(self, user, subject, body):
+        self._send_multiple([ self._make_send_obj(user, subject, body) ])
@@ -186,7 +186,7 @@ class KeyRequestForm(forms.ModelForm):
 
     class Meta:
         model = RequestForm
-        exclude = ['rooms', 'expiry_date', 'submitted_at', 'updated_at']
+        exclude = ['rooms', 'expiry_date', 'submitted_at', 'updated_at', 'latest_status', 'latest_status_at']
         labels = KEY_REQUEST_LABELS
         widgets = {
             'user': forms.HiddenInput(),
@@ -1,16 +1,19 @@
 from django.db.models.functions import Concat
-from django.db.models import Q, F, Max, CharField, Value, Count, OuterRef, Subquery, Exists
+from django.db.models import Q, F, Max, CharField, IntegerField, Value, Count, OuterRef, Subquery, Exists
 from urllib.parse import urlparse
 from django.forms.models import model_to_dict
 from django.utils import timezone
 from datetime import datetime, date
 import re
 import json
+import copy
 
 
 from django.contrib.auth.models import User
-from lfs_lab_cert_tracker.models import Cert, LabCert
-from .models import Building, Floor, Room, RequestForm, RequestFormStatus, ApprovalGroup, ApprovalGroupRole
+from lfs_lab_cert_tracker.models import Cert, LabCert, UserCert
+from app.functions import get_latest_user_certs
+from app import permissions
+from .models import Building, Floor, Room, RequestForm, RequestFormApproval, ApprovalGroup, ApprovalGroupRole
 from .utils import APPROVED, REV_REQUEST_STATUS_DICT
 
 
@@ -31,9 +34,7 @@ def get_headers(model):
 
 
 def is_room_approver(user_id):
-    if Room.objects.count() == 0:
-        return False
-    return Room.objects.filter(Q(managers__id=user_id) | Q(groups__roles__user_id=user_id)).exists()
+    return permissions.is_room_approver(user_id)
 
 def is_approval_group_coordinator(user_id):
     if ApprovalGroup.objects.count() == 0:
@@ -101,8 +102,7 @@ def check_user_trainings(user, selected_rooms):
     certs = Cert.objects.filter(usercert__user_id=user.id).distinct()
     missing_ids = [m.id for m in set(required_trainings).difference(set(certs))]
 
-    expired = user.usercert_set.values('cert_id').annotate(max_expiry_date=Max('expiry_date')).filter( Q(max_expiry_date__lt=date.today()) & ~Q(completion_date=F('expiry_date')) )
-    expired_ids = [e['cert_id'] for e in expired]
+    expired_ids = set(get_latest_user_certs([user.id]).filter(expiry_date__lt=date.today()).values_list('cert_id', flat=True))
 
     total_missing = 0
     total_expired = 0
@@ -121,48 +121,98 @@ def check_user_trainings(user, selected_rooms):
     return sorted(required_trainings, key=lambda x: x.name, reverse=False), total_missing, total_expired
 
 
+def check_user_trainings_bulk(forms):
+    """ Same as check_user_trainings for the users and rooms of each form on a page, in two queries. Sets user_trainings, total_missing and total_expired of each form """
+
+    forms = list(forms)
+
+    # Required trainings of the rooms of each form
+    required_trainings = {}
+    room_trainings = Room.trainings.through.objects.filter(room__requestform__in=[form.id for form in forms]).annotate(
+        form_id=F('room__requestform')
+    ).select_related('cert')
+    for room_training in room_trainings:
+        required_trainings.setdefault(room_training.form_id, {})[room_training.cert_id] = room_training.cert
+
+    # Records of the users, which are held or expired by the latest expiry date
+    held = set()
+    latest_expiry_dates = {}
+    user_certs = UserCert.objects.filter(
+        user_id__in=set(form.user_id for form in forms),
+        cert_id__in=set(cert_id for trainings in required_trainings.values() for cert_id in trainings)
+    ).values_list('user_id', 'cert_id', 'completion_date', 'expiry_date')
+    for user_id, cert_id, completion_date, expiry_date in user_certs:
+        held.add((user_id, cert_id))
+        if completion_date != expiry_date:
+            key = (user_id, cert_id)
+            if key not in latest_expiry_dates or expiry_date > latest_expiry_dates[key]:
+                latest_expiry_dates[key] = expiry_date
+
+    today = date.today()
+    for form in forms:
+        form.user_trainings = []
+        form.total_missing = 0
+        form.total_expired = 0
+        for cert in required_trainings.get(form.id, {}).values():
+            # Each form gets its own copy as the flags depend on the user
+            training = copy.copy(cert)
+            training.is_missing = (form.user_id, cert.id) not in held
+            expiry_date = latest_expiry_dates.get((form.user_id, cert.id))
+            training.is_expired = expiry_date is not None and expiry_date < today
+
+            form.total_missing += training.is_missing
+            form.total_expired += training.is_expired
+            form.user_trainings.append(training)
+
+        form.user_trainings.sort(key=lambda x: x.name)
+
+    return forms
+
+
 def make_request_form_identifier(room, form, entity_label, entity_id):
     return f"{entity_label}:{entity_id}__{form.id}:{room.id}"
 
 
 # Returns True if all PIs have approved a room; If there are no managers or groups, returns False
 def all_pis_approved(form, room):
+    """ Managers: ALL approve, and each group approves, by their latest status. Runs a single query """
 
-    if not room.managers.exists() and not room.groups.exists():
-        return False
+    def latest_status(entity_field, approver_field):
+        return Subquery(
+            RequestFormApproval.objects.filter(form_id=form.id, room_id=room.id, **{ entity_field: OuterRef(approver_field) }).values('status')[:1]
+        )
 
-    # Managers: ALL approve
-    manager_ids = room.managers.all().values_list("id", flat=True)
-    num_managers = len(manager_ids)
+    managers = Room.managers.through.objects.filter(room_id=room.id).annotate(latest_status=latest_status('manager_id', 'user_id')).values_list('latest_status')
+    groups = Room.groups.through.objects.filter(room_id=room.id).annotate(latest_status=latest_status('group_id', 'approvalgroup_id')).values_list('latest_status')
+    statuses = [status for status, in managers.union(groups, all=True)]
 
-    if num_managers > 0:
-        latest_status = RequestFormStatus.objects.filter(
-            form_id=form.id,
-            room_id=room.id,
-            manager_id=OuterRef("pk")
-        ).order_by('-created_at')
+    return len(statuses) > 0 and all(status == APPROVED for status in statuses)
 
-        managers_with_status = (User.objects.filter(id__in=manager_ids).annotate(
-            latest_status=Subquery(latest_status.values('status')[:1])
-        ))
 
-        approved_count = managers_with_status.filter(latest_status=APPROVED).count()
-        if approved_count != num_managers:
-            return False
+def all_pis_approved_many(form_rooms):
+    """ all_pis_approved for many (form, room) pairs in two queries. Returns { (form_id, room_id): bool } """
 
-    # Groups: at least one approve
-    for group in room.groups.all():
+    form_ids = set(form.id for form, _ in form_rooms)
+    room_ids = set(room.id for _, room in form_rooms)
 
-        latest_status = RequestFormStatus.objects.filter(
-            form_id=form.id,
-            room_id=room.id,
-            group_id=group.id
-        ).order_by('-created_at').first()
+    # Approvers of each room
+    room_approvers = {}
+    managers = Room.managers.through.objects.filter(room_id__in=room_ids).annotate(manager_id=F('user_id'), group_id=Value(None, output_field=IntegerField())).values_list('room_id', 'manager_id', 'group_id')
+    groups = Room.groups.through.objects.filter(room_id__in=room_ids).annotate(manager_id=Value(None, output_field=IntegerField()), group_id=F('approvalgroup_id')).values_list('room_id', 'manager_id', 'group_id')
+    for room_id, manager_id, group_id in managers.union(groups, all=True):
+        room_approvers.setdefault(room_id, []).append((manager_id, group_id))
 
-        if latest_status is None or latest_status.status != APPROVED:
-            return False
+    # Latest status of each approver
+    latest_statuses = RequestFormApproval.objects.filter(form_id__in=form_ids, room_id__in=room_ids).values_list('form_id', 'room_id', 'manager_id', 'group_id', 'status')
+    statuses = {(form_id, room_id, manager_id, group_id): status for form_id, room_id, manager_id, group_id, status in latest_statuses}
 
-    return True
+    approved = {}
+    for form, room in form_rooms:
+        approvers = room_approvers.get(room.id, [])
+        approved[(form.id, room.id)] = len(approvers) > 0 and all(
+            statuses.get((form.id, room.id, manager_id, group_id)) == APPROVED for manager_id, group_id in approvers
+        )
+    return approved
 
 def get_area_ids_from_session(session, key, room=None):
     area_ids = [area.id for area in room.areas.all()] if room else []
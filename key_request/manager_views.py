@@ -55,11 +55,7 @@ class ManagerDashboard(LoginRequiredMixin, View):
         except EmptyPage:
             forms = paginator.page(paginator.num_pages)
 
-        for form in forms:
-            user_trainings, total_missing, total_expired = func.check_user_trainings(form.user, [room.id for room in form.rooms.all()])
-            form.user_trainings = user_trainings
-            form.total_missing = total_missing
-            form.total_expired = total_expired
+        func.check_user_trainings_bulk(forms)
         
         return render(request, 'key_request/manager_dashboard/manager_dashboard.html', {
             'total_forms': coordinator.get_total_forms(),
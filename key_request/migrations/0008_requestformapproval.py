@@ -0,0 +1,74 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:21
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def populate_request_form_approvals(apps, schema_editor):
+    RequestForm = apps.get_model('key_request', 'RequestForm')
+    RequestFormStatus = apps.get_model('key_request', 'RequestFormStatus')
+    RequestFormApproval = apps.get_model('key_request', 'RequestFormApproval')
+
+    # Latest status of each manager and group
+    for entity_field in ['manager_id', 'group_id']:
+        latest = (
+            RequestFormStatus.objects.filter(**{ entity_field + '__isnull': False })
+            .order_by('form_id', 'room_id', entity_field, '-created_at', '-id')
+            .distinct('form_id', 'room_id', entity_field)
+        )
+        RequestFormApproval.objects.bulk_create([
+            RequestFormApproval(
+                form_id=rfs.form_id,
+                room_id=rfs.room_id,
+                manager_id=rfs.manager_id if entity_field == 'manager_id' else None,
+                group_id=rfs.group_id if entity_field == 'group_id' else None,
+                status=rfs.status,
+                status_created_at=rfs.created_at
+            )
+            for rfs in latest.iterator()
+        ], batch_size=1000)
+
+    # Latest status of each form
+    forms = []
+    for rfs in RequestFormStatus.objects.order_by('form_id', '-created_at', '-id').distinct('form_id').iterator():
+        forms.append(RequestForm(id=rfs.form_id, latest_status=rfs.status, latest_status_at=rfs.created_at))
+    RequestForm.objects.bulk_update(forms, ['latest_status', 'latest_status_at'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('key_request', '0007_rename_fob_room_card_access_alter_roomemail_type'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='requestform',
+            name='latest_status',
+            field=models.CharField(blank=True, choices=[('0', 'Approved'), ('1', 'Declined'), ('2', 'Insufficient Info')], db_index=True, max_length=1, null=True),
+        ),
+        migrations.AddField(
+            model_name='requestform',
+            name='latest_status_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='RequestFormApproval',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('0', 'Approved'), ('1', 'Declined'), ('2', 'Insufficient Info')], max_length=1)),
+                ('status_created_at', models.DateTimeField()),
+                ('form', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='approvals', to='key_request.requestform')),
+                ('group', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='request_form_approvals', to='key_request.approvalgroup')),
+                ('manager', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='request_form_approvals', to=settings.AUTH_USER_MODEL)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='key_request.room')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['room', 'manager'], name='key_request_room_id_57801b_idx'), models.Index(fields=['room', 'group'], name='key_request_room_id_bed402_idx')],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('manager__isnull', False)), fields=('form', 'room', 'manager'), name='unique_form_room_manager_approval'), models.UniqueConstraint(condition=models.Q(('group__isnull', False)), fields=('form', 'room', 'group'), name='unique_form_room_group_approval')],
+            },
+        ),
+        migrations.RunPython(populate_request_form_approvals, migrations.RunPython.noop),
+    ]
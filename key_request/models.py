@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, transaction
 from django.utils.text import slugify
 from django.contrib.auth.models import User, Group
 from lfs_lab_cert_tracker.models import Lab, Cert
@@ -130,11 +130,26 @@ class RequestForm(models.Model):
     submitted_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # Latest RequestFormStatus of the form, kept up to date by update_request_form_approvals
+    latest_status = models.CharField(max_length=1, choices=REQUEST_STATUS, null=True, blank=True, db_index=True)
+    latest_status_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
     class Meta:
         ordering = ['-pk', '-submitted_at']
 
 
+class RequestFormStatusQuerySet(models.QuerySet):
+
+    def bulk_create(self, objs, *args, **kwargs):
+        with transaction.atomic(using=self.db):
+            objs = super().bulk_create(objs, *args, **kwargs)
+            update_request_form_approvals(objs)
+        return objs
+
+
 class RequestFormStatus(models.Model):
+    """ History of the statuses of a form, which is kept as an audit log. Use RequestFormApproval to read the latest ones """
+
     form = models.ForeignKey(RequestForm, on_delete=models.CASCADE)
     room = models.ForeignKey(Room, on_delete=models.DO_NOTHING)
     manager = models.ForeignKey(User, blank=True, null=True, on_delete=models.SET_NULL, related_name='requestformstatus_manager_set')
@@ -143,6 +158,65 @@ class RequestFormStatus(models.Model):
     status = models.CharField(max_length=1, choices=REQUEST_STATUS, default=None)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = RequestFormStatusQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            is_new = self._state.adding
+            super(RequestFormStatus, self).save(*args, **kwargs)
+            if is_new:
+                update_request_form_approvals([self])
+
+
+class RequestFormApproval(models.Model):
+    """ Latest status of each manager and group of a room for a form """
+
+    form = models.ForeignKey(RequestForm, on_delete=models.CASCADE, related_name='approvals')
+    room = models.ForeignKey(Room, on_delete=models.CASCADE)
+    manager = models.ForeignKey(User, blank=True, null=True, on_delete=models.CASCADE, related_name='request_form_approvals')
+    group = models.ForeignKey(ApprovalGroup, blank=True, null=True, on_delete=models.CASCADE, related_name='request_form_approvals')
+    status = models.CharField(max_length=1, choices=REQUEST_STATUS)
+    status_created_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['form', 'room', 'manager'], condition=Q(manager__isnull=False), name='unique_form_room_manager_approval'),
+            models.UniqueConstraint(fields=['form', 'room', 'group'], condition=Q(group__isnull=False), name='unique_form_room_group_approval')
+        ]
+        indexes = [
+            models.Index(fields=['room', 'manager']),
+            models.Index(fields=['room', 'group'])
+        ]
+
+
+def update_request_form_approvals(request_form_statuses):
+    """ Record new RequestFormStatus rows in RequestFormApproval and RequestForm.latest_status, in the same transaction """
+
+    with transaction.atomic():
+        for rfs in sorted(request_form_statuses, key=lambda rfs: (rfs.created_at, rfs.id)):
+            RequestForm.objects.filter(Q(latest_status_at__isnull=True) | Q(latest_status_at__lte=rfs.created_at), id=rfs.form_id).update(
+                latest_status=rfs.status,
+                latest_status_at=rfs.created_at
+            )
+
+            if rfs.manager_id:
+                approver = { 'manager_id': rfs.manager_id }
+            elif rfs.group_id:
+                approver = { 'group_id': rfs.group_id }
+            else:
+                continue
+
+            approval, created = RequestFormApproval.objects.select_for_update().get_or_create(
+                form_id=rfs.form_id,
+                room_id=rfs.room_id,
+                **approver,
+                defaults={ 'status': rfs.status, 'status_created_at': rfs.created_at }
+            )
+            if not created and approval.status_created_at <= rfs.created_at:
+                approval.status = rfs.status
+                approval.status_created_at = rfs.created_at
+                approval.save(update_fields=['status', 'status_created_at'])
+
 
 class RoomEmail(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
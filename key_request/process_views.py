@@ -9,10 +9,9 @@ from django.views.decorators.http import require_GET, require_POST
 from django.contrib.auth.models import User
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.exceptions import SuspiciousOperation
-import smtplib
-from email.mime.text import MIMEText
 
 from app import functions as appFunc
+from app import mailer
 
 from .models import Building, Floor, Room
 from .forms import KeyRequestForm
@@ -256,18 +255,5 @@ def get_message(receiver, rooms, option, submitted_at, applicant=None):
 
 def send(user, subject, message):
     if settings.EMAIL_FROM and appFunc.check_email_valid(user.email):
-        sender = settings.EMAIL_FROM
         receiver = '{0} <{1}>'.format(user.get_full_name(), user.email)
-
-        msg = MIMEText(message, 'html')
-        msg['Subject'] = subject
-        msg['From'] = sender
-        msg['To'] = receiver
-
-        try:
-            server = smtplib.SMTP(settings.EMAIL_HOST)
-            server.sendmail(sender, receiver, msg.as_string())
-        except Exception as e:
-            print(e)
-        finally:
-            server.quit()
+        mailer.enqueue_emails([{ 'receiver': receiver, 'subject': subject, 'message': message }])
@@ -7,7 +7,7 @@ from key_request import functions as func
 from app import functions as appFunc
 from key_request.utils import REQUEST_STATUS_DICT
 from key_request.forms import KEY_REQUEST_LABELS
-from key_request.models import Room, RequestFormStatus, RequestForm, UserFilter
+from key_request.models import Room, RequestFormApproval, RequestForm, UserFilter
 
 from django.template.defaultfilters import pluralize
 from datetime import date
@@ -80,9 +80,8 @@ def get_status_by_manager(form_id, args):
     room_id = args_splited[0]
     manager_id = args_splited[1]
     
-    status_filtered = RequestFormStatus.objects.filter(form_id=form_id, room_id=room_id, manager_id=manager_id).order_by('-created_at')
-    if status_filtered.exists():
-        obj = status_filtered.first()
+    obj = RequestFormApproval.objects.filter(form_id=form_id, room_id=room_id, manager_id=manager_id).first()
+    if obj:
         return REQUEST_STATUS_DICT[obj.status]
     return None
 
@@ -124,9 +123,8 @@ def get_status_by_group(form_id, args):
     room_id = args_splited[0]
     group_id = args_splited[1]
 
-    status_filtered = RequestFormStatus.objects.filter(form_id=form_id, room_id=room_id, group_id=group_id).order_by('-created_at')
-    if status_filtered.exists():
-        obj = status_filtered.first()
+    obj = RequestFormApproval.objects.filter(form_id=form_id, room_id=room_id, group_id=group_id).first()
+    if obj:
         return REQUEST_STATUS_DICT[obj.status]
     return None
 
@@ -1,12 +1,19 @@
 from django.test import TestCase, Client
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.core.paginator import Paginator
+from django.db.models import QuerySet
 from django.urls import reverse
 from django.contrib.auth.models import User
 
-from key_request.dashboard_coordinators import ManagerFormProcessor, GroupFormProcessor, DashboardCoordinator
-from datetime import timedelta
+from key_request.dashboard_coordinators import RequestFormProcessor, ManagerFormProcessor, GroupFormProcessor, DashboardCoordinator
+from datetime import date, timedelta
 from django.utils import timezone
-from key_request.models import ApprovalGroup, ApprovalGroupRole, RequestFormStatus, Room, RequestForm, Building, Floor
+from key_request.models import ApprovalGroup, ApprovalGroupRole, RequestFormStatus, RequestFormApproval, Room, RequestForm, Building, Floor, update_request_form_approvals
 from key_request.utils import REQUEST_STATUS, APPROVED, INSUFFICIENT, DECLINED
+from key_request.functions import check_user_trainings, check_user_trainings_bulk, all_pis_approved, all_pis_approved_many
+from key_request.email_coordinator import ApprovalNotificationManager
+from lfs_lab_cert_tracker.models import Cert, UserCert
 
 LOGIN_URL = reverse('accounts:local_login')
 
@@ -442,4 +449,292 @@ class GroupTotalFormStatsTests(TestCase):
         total, new = processor.get_total_form_stats()
 
         self.assertEqual(total, 1)
-        self.assertEqual(new, 1)
\ No newline at end of file
+        self.assertEqual(new, 1)
+
+class DashboardQueryCountTests(TestCase):
+    """The dashboard loads in a fixed number of queries, regardless of rooms, approvers and forms."""
+    def make_room(self, **kwargs):
+        defaults = dict(building_id=self.building.id, floor_id=self.floor.id, number="101")
+        defaults.update(kwargs)
+        return Room.objects.create(**defaults)
+
+    def setUp(self):
+        self.admin_user = User.objects.create_superuser(
+            username='test_admin',
+            email='admin@test.com',
+            password='password'
+        )
+        self.building = Building.objects.create(id=1, name="Library")
+        self.floor = Floor.objects.create(id=1, name="1st")
+        self.user = User.objects.create_user("query_user")
+        self.groups = []
+        self.num_rooms = 0
+
+    def add_rooms(self, num_rooms):
+        group = ApprovalGroup.objects.create(name="Query Group {0}".format(len(self.groups)))
+        ApprovalGroupRole.objects.create(user=self.user, group=group, role=0)
+        self.groups.append(group)
+
+        for _ in range(num_rooms):
+            self.num_rooms += 1
+            room = self.make_room(number=str(500 + self.num_rooms))
+            room.managers.set([self.user])
+            room.groups.set(self.groups)
+            form = make_form(rooms=[room], user=self.admin_user)
+            RequestFormStatus.objects.create(
+                form=form, room=room, manager=self.user, operator=self.user,
+                status=INSUFFICIENT, created_at=timezone.now() - timedelta(days=1),
+            )
+            RequestFormStatus.objects.create(
+                form=form, room=room, manager=self.user, operator=self.user, status=APPROVED,
+            )
+
+    def run_coordinator(self):
+        coordinator = DashboardCoordinator(self.user, {})
+        coordinator.run()
+        return coordinator
+
+    def test_query_count_does_not_grow_with_rooms_and_groups(self):
+        self.add_rooms(1)
+        with self.assertNumQueries(15):
+            self.run_coordinator()
+
+        self.add_rooms(3)
+        with self.assertNumQueries(15):
+            coordinator = self.run_coordinator()
+
+        # 4 manager forms, and 1 + 2 + 2 + 2 group forms for the groups of each room
+        forms = coordinator.get_forms()
+        self.assertEqual(len(forms), 4 + 7)
+        self.assertEqual(coordinator.get_total_forms(), 11)
+        self.assertEqual(coordinator.get_num_new_forms(), 7)
+
+        manager_forms = [form for form in forms if form.manager]
+        self.assertTrue(all(form.status == APPROVED and not form.is_new for form in manager_forms))
+        self.assertTrue(all(form.is_new and form.status is None for form in forms if form.group))
+
+
+class RequestFormProcessorFilterTests(TestCase):
+    """Name and status filters of the admin requests run in SQL, and pages are loaded with LIMIT/OFFSET."""
+    def setUp(self):
+        self.admin_user = User.objects.create_superuser(
+            username='test_admin',
+            email='admin@test.com',
+            password='password'
+        )
+        self.building = Building.objects.create(id=1, name="Library")
+        self.floor = Floor.objects.create(id=1, name="1st")
+        self.room = Room.objects.create(building=self.building, floor=self.floor, number="601")
+
+        self.alice = User.objects.create_user(username='alice', first_name='Alice', last_name='Smith')
+        self.bob = User.objects.create_user(username='bob', first_name='Bob', last_name='Jones')
+
+        self.new_form = make_form(rooms=[self.room], user=self.alice)
+        self.approved_form = make_form(rooms=[self.room], user=self.bob)
+        RequestFormStatus.objects.create(
+            form=self.approved_form, room=self.room, operator=self.admin_user,
+            status=DECLINED, created_at=timezone.now() - timedelta(days=1),
+        )
+        RequestFormStatus.objects.create(
+            form=self.approved_form, room=self.room, operator=self.admin_user, status=APPROVED,
+        )
+
+    def get_forms(self, query):
+        coordinator = DashboardCoordinator(self.admin_user, query, [RequestFormProcessor])
+        coordinator.run()
+        return coordinator.get_forms()
+
+    def test_filters_by_full_name(self):
+        self.assertEqual(list(self.get_forms({'name': 'ice sm'})), [self.new_form])
+        self.assertEqual(list(self.get_forms({'name': 'BOB JONES'})), [self.approved_form])
+        self.assertEqual(list(self.get_forms({'name': 'carol'})), [])
+
+    def test_filters_by_latest_status(self):
+        self.assertEqual(list(self.get_forms({'status': 'New'})), [self.new_form])
+        self.assertEqual(list(self.get_forms({'status': 'Approved'})), [self.approved_form])
+        self.assertEqual(list(self.get_forms({'status': 'Declined'})), [])
+        self.assertEqual(list(self.get_forms({'status': 'Unknown'})), [])
+
+        forms = list(self.get_forms({}))
+        self.assertEqual(forms, [self.approved_form, self.new_form])
+        self.assertEqual([form.is_new for form in forms], [False, True])
+
+    def test_forms_are_paginated_in_sql(self):
+        forms = self.get_forms({})
+        self.assertIsInstance(forms, QuerySet)
+
+        with CaptureQueriesContext(connection) as queries:
+            page = Paginator(forms, 1).page(2)
+            self.assertEqual(list(page), [self.new_form])
+        self.assertIn('LIMIT 1 OFFSET 1', queries[-1]['sql'])
+
+
+class CheckUserTrainingsBulkTests(TestCase):
+    """The trainings of every form on a page are checked in a fixed number of queries."""
+    def setUp(self):
+        self.building = Building.objects.create(id=1, name="Library")
+        self.floor = Floor.objects.create(id=1, name="1st")
+        self.cert_a = Cert.objects.create(name="A Training", expiry_in_years=1)
+        self.cert_b = Cert.objects.create(name="B Training", expiry_in_years=1)
+        self.cert_c = Cert.objects.create(name="C Training", expiry_in_years=0)
+
+        self.room_1 = Room.objects.create(building=self.building, floor=self.floor, number="701")
+        self.room_1.trainings.set([self.cert_a, self.cert_b])
+        self.room_2 = Room.objects.create(building=self.building, floor=self.floor, number="702")
+        self.room_2.trainings.set([self.cert_b, self.cert_c])
+
+        self.alice = User.objects.create_user(username='alice', first_name='Alice', last_name='Smith')
+        self.bob = User.objects.create_user(username='bob', first_name='Bob', last_name='Jones')
+
+        # Alice: A is expired, B has been renewed and C never expires
+        self.add_user_cert(self.alice, self.cert_a, date(2020, 1, 1), date(2021, 1, 1))
+        self.add_user_cert(self.alice, self.cert_b, date(2020, 1, 1), date(2021, 1, 1))
+        self.add_user_cert(self.alice, self.cert_b, date.today(), date.today() + timedelta(days=365))
+        self.add_user_cert(self.alice, self.cert_c, date(2020, 1, 1), date(2020, 1, 1))
+
+        self.forms = [
+            make_form(rooms=[self.room_1, self.room_2], user=self.alice),
+            make_form(rooms=[self.room_1], user=self.bob),
+            make_form(rooms=[self.room_2], user=self.alice),
+        ]
+
+    def add_user_cert(self, user, cert, completion_date, expiry_date):
+        UserCert.objects.create(
+            user=user, cert=cert, cert_file='None', uploaded_date=date.today(),
+            completion_date=completion_date, expiry_date=expiry_date
+        )
+
+    def test_matches_check_user_trainings(self):
+        forms = list(RequestForm.objects.filter(id__in=[form.id for form in self.forms]))
+        with self.assertNumQueries(2):
+            check_user_trainings_bulk(forms)
+
+        for form in forms:
+            trainings, total_missing, total_expired = check_user_trainings(form.user, [room.id for room in form.rooms.all()])
+            self.assertEqual(form.total_missing, total_missing)
+            self.assertEqual(form.total_expired, total_expired)
+            self.assertEqual(
+                [(training.id, training.is_missing, training.is_expired) for training in form.user_trainings],
+                [(training.id, training.is_missing, training.is_expired) for training in trainings]
+            )
+
+        alice_form = next(form for form in forms if form.id == self.forms[0].id)
+        bob_form = next(form for form in forms if form.id == self.forms[1].id)
+        self.assertEqual((alice_form.total_missing, alice_form.total_expired), (0, 1))
+        self.assertEqual((bob_form.total_missing, bob_form.total_expired), (2, 0))
+
+
+class AllPisApprovedTests(TestCase):
+    """Every manager and group of a room approves, by their latest status."""
+    def setUp(self):
+        self.admin_user = User.objects.create_superuser(
+            username='test_admin',
+            email='admin@test.com',
+            password='password'
+        )
+        self.building = Building.objects.create(id=1, name="Library")
+        self.floor = Floor.objects.create(id=1, name="1st")
+        self.pi_1 = User.objects.create_user("approval_pi_1")
+        self.pi_2 = User.objects.create_user("approval_pi_2")
+        self.group = ApprovalGroup.objects.create(name="Approval Group")
+
+        self.room_no_approvers = Room.objects.create(building=self.building, floor=self.floor, number="801")
+        self.room = Room.objects.create(building=self.building, floor=self.floor, number="802")
+        self.room.managers.set([self.pi_1, self.pi_2])
+        self.room.groups.set([self.group])
+
+        self.form = make_form(rooms=[self.room, self.room_no_approvers], user=self.admin_user)
+        self.other_form = make_form(rooms=[self.room], user=self.admin_user)
+
+    def add_status(self, status, form=None, **entity):
+        return RequestFormStatus.objects.create(
+            form=form or self.form, room=self.room, operator=self.admin_user, status=status, **entity
+        )
+
+    def check(self, expected):
+        pairs = [(self.form, self.room), (self.form, self.room_no_approvers), (self.other_form, self.room)]
+        with self.assertNumQueries(1):
+            self.assertEqual(all_pis_approved(self.form, self.room), expected)
+
+        with self.assertNumQueries(2):
+            approved = all_pis_approved_many(pairs)
+        self.assertEqual(approved, {
+            (self.form.id, self.room.id): expected,
+            (self.form.id, self.room_no_approvers.id): False,
+            (self.other_form.id, self.room.id): False
+        })
+
+    def test_every_approver_must_approve(self):
+        self.check(False)
+
+        self.add_status(APPROVED, manager=self.pi_1)
+        self.add_status(APPROVED, group=self.group)
+        self.check(False)
+
+        self.add_status(DECLINED, manager=self.pi_2)
+        self.check(False)
+
+        self.add_status(APPROVED, manager=self.pi_2)
+        self.check(True)
+
+        self.add_status(INSUFFICIENT, group=self.group)
+        self.check(False)
+
+    def test_approval_emails_use_the_approvals(self):
+        self.add_status(APPROVED, manager=self.pi_1)
+        self.add_status(APPROVED, group=self.group)
+        request_form_status = self.add_status(APPROVED, manager=self.pi_2)
+
+        manager = ApprovalNotificationManager([request_form_status], APPROVED, self.pi_2)
+        form_pi_rooms, _, fully_approved = manager._collect_data()
+        self.assertEqual(form_pi_rooms, { self.form.id: { self.pi_2.id: [self.room] } })
+        self.assertEqual(fully_approved, { self.form.id: [self.room] })
+
+
+class RequestFormApprovalTests(TestCase):
+    """The latest statuses are kept up to date as the status history grows."""
+    def setUp(self):
+        self.admin_user = User.objects.create_superuser(
+            username='test_admin',
+            email='admin@test.com',
+            password='password'
+        )
+        self.building = Building.objects.create(id=1, name="Library")
+        self.floor = Floor.objects.create(id=1, name="1st")
+        self.pi = User.objects.create_user("summary_pi")
+        self.group = ApprovalGroup.objects.create(name="Summary Group")
+        self.room = Room.objects.create(building=self.building, floor=self.floor, number="901")
+        self.form = make_form(rooms=[self.room], user=self.admin_user)
+
+    def get_approvals(self):
+        return list(RequestFormApproval.objects.filter(form=self.form).order_by('id').values_list('manager_id', 'group_id', 'status'))
+
+    def test_created_statuses_update_the_approvals(self):
+        self.assertEqual(self.get_approvals(), [])
+        self.assertIsNone(RequestForm.objects.get(id=self.form.id).latest_status)
+
+        RequestFormStatus.objects.create(form=self.form, room=self.room, manager=self.pi, operator=self.pi, status=DECLINED)
+        RequestFormStatus.objects.create(form=self.form, room=self.room, manager=self.pi, operator=self.pi, status=APPROVED)
+        self.assertEqual(self.get_approvals(), [(self.pi.id, None, APPROVED)])
+
+        last_status = RequestFormStatus.objects.bulk_create([
+            RequestFormStatus(form=self.form, room=self.room, group=self.group, operator=self.admin_user, status=INSUFFICIENT),
+            RequestFormStatus(form=self.form, room=self.room, manager=self.pi, operator=self.admin_user, status=DECLINED),
+        ])[-1]
+        self.assertEqual(self.get_approvals(), [(self.pi.id, None, DECLINED), (None, self.group.id, INSUFFICIENT)])
+
+        form = RequestForm.objects.get(id=self.form.id)
+        self.assertEqual(form.latest_status, DECLINED)
+        self.assertEqual(form.latest_status_at, last_status.created_at)
+
+        # The history is kept
+        self.assertEqual(RequestFormStatus.objects.filter(form=self.form).count(), 4)
+
+    def test_older_statuses_do_not_replace_newer_ones(self):
+        RequestFormStatus.objects.create(form=self.form, room=self.room, manager=self.pi, operator=self.pi, status=APPROVED)
+        older = RequestFormStatus(form=self.form, room=self.room, manager=self.pi, operator=self.pi, status=DECLINED, created_at=timezone.now() - timedelta(days=1))
+        older.id = 0
+
+        update_request_form_approvals([older])
+        self.assertEqual(self.get_approvals(), [(self.pi.id, None, APPROVED)])
+        self.assertEqual(RequestForm.objects.get(id=self.form.id).latest_status, APPROVED)
@@ -37,12 +37,7 @@ class Index(LoginRequiredMixin, View):
         forms = processor.get_all_status_annotated_forms(forms)
 
 
-        for form in forms:
-            room_ids = form.rooms.all().values_list('id', flat=True)
-            user_trainings, total_missing, total_expired = func.check_user_trainings(form.user, room_ids)
-            form.user_trainings = user_trainings
-            form.total_missing = total_missing
-            form.total_expired = total_expired
+        func.check_user_trainings_bulk(forms)
 
         return render(request, 'key_request/index.html', {
             'total_forms': len(form_list),
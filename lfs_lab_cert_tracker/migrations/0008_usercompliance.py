@@ -0,0 +1,56 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:37
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Q, F, Max
+
+
+def populate_user_compliance(apps, schema_editor):
+    LabCert = apps.get_model('lfs_lab_cert_tracker', 'LabCert')
+    UserCert = apps.get_model('lfs_lab_cert_tracker', 'UserCert')
+    UserCompliance = apps.get_model('lfs_lab_cert_tracker', 'UserCompliance')
+
+    latest_expiry_dates = {}
+    for uc in UserCert.objects.values('user_id', 'cert_id').annotate(latest_expiry_date=Max('expiry_date', filter=~Q(completion_date=F('expiry_date')))):
+        latest_expiry_dates[(uc['user_id'], uc['cert_id'])] = uc['latest_expiry_date']
+
+    rows = []
+    for user_id, lab_id, cert_id in LabCert.objects.filter(lab__userlab__isnull=False).values_list('lab__userlab__user_id', 'lab_id', 'cert_id'):
+        key = (user_id, cert_id)
+        rows.append(UserCompliance(
+            user_id=user_id,
+            lab_id=lab_id,
+            cert_id=cert_id,
+            state=1 if key in latest_expiry_dates else 0,
+            latest_expiry_date=latest_expiry_dates.get(key)
+        ))
+
+    UserCompliance.objects.bulk_create(rows, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lfs_lab_cert_tracker', '0007_cert_is_lfs'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserCompliance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.IntegerField(choices=[(0, 'Missing'), (1, 'Completed')])),
+                ('latest_expiry_date', models.DateField(blank=True, null=True)),
+                ('cert', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lfs_lab_cert_tracker.cert')),
+                ('lab', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lfs_lab_cert_tracker.lab')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['lab', 'state'], name='lfs_lab_cer_lab_id_2f56b7_idx'), models.Index(fields=['state', 'latest_expiry_date'], name='lfs_lab_cer_state_e4758b_idx')],
+                'unique_together': {('user', 'lab', 'cert')},
+            },
+        ),
+        migrations.RunPython(populate_user_compliance, migrations.RunPython.noop),
+    ]
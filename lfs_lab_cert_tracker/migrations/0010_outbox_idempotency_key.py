@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lfs_lab_cert_tracker', '0009_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outbox',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='outbox',
+            name='idempotency_key',
+            field=models.CharField(blank=True, max_length=256, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='outbox',
+            name='status',
+            field=models.IntegerField(choices=[(0, 'Pending'), (1, 'Sent'), (2, 'Failed'), (3, 'Sending')], default=0),
+        ),
+    ]
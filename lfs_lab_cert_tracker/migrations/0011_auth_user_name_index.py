@@ -0,0 +1,17 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('lfs_lab_cert_tracker', '0010_outbox_idempotency_key'),
+    ]
+
+    # Keyset pages of users are ordered by (last_name, first_name, id), and auth_user belongs to django.contrib.auth
+    operations = [
+        migrations.RunSQL(
+            'CREATE INDEX IF NOT EXISTS auth_user_last_name_first_name_id_idx ON auth_user (last_name, first_name, id);',
+            'DROP INDEX IF EXISTS auth_user_last_name_first_name_id_idx;'
+        ),
+    ]
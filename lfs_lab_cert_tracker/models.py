@@ -1,11 +1,14 @@
 import os
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Q, F, Max
 from django.contrib.auth.models import User as AuthUser
 from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from django.core.mail import send_mail
 from django.conf import settings
 from io import BytesIO
+from datetime import date
+import hashlib
+import uuid
 import sys
 from PIL import Image as PILImage
 from django.core.files.uploadedfile import InMemoryUploadedFile
@@ -177,7 +180,7 @@ def send_notification(sender, created, **kwargs):
             print(e)
 
         if valid_email:
-            send_mail(title, message, settings.EMAIL_FROM, [ obj.user.email ], fail_silently=False, html_message=message)
+            enqueue_emails([{ 'receiver': obj.user.email, 'subject': title, 'message': message, 'key': 'user_lab:{0}'.format(obj.id) }])
 
 post_save.connect(send_notification, sender=UserLab)
 
@@ -200,3 +203,180 @@ class UserInactive(models.Model):
 
     user = models.ForeignKey(AuthUser, on_delete=models.CASCADE)
     inactive_date = models.DateField(null=True)
+
+
+
+class UserCompliance(models.Model):
+    """
+    Keeps track of the status of each training required for a user in a lab
+
+    Rows are rebuilt by signals on UserCert, UserLab and LabCert. Expiry is
+    checked against latest_expiry_date when reading, so rows do not need to
+    be touched as days pass
+    """
+
+    MISSING = 0
+    COMPLETED = 1
+
+    STATE_CHOICES = [ (MISSING, "Missing"), (COMPLETED, "Completed") ]
+
+    user = models.ForeignKey(AuthUser, on_delete=models.CASCADE)
+    lab = models.ForeignKey(Lab, on_delete=models.CASCADE)
+    cert = models.ForeignKey(Cert, on_delete=models.CASCADE)
+    state = models.IntegerField(choices=STATE_CHOICES)
+    latest_expiry_date = models.DateField(null=True, blank=True)
+
+    class Meta:
+        unique_together = (('user', 'lab', 'cert'))
+        indexes = [
+            models.Index(fields=['lab', 'state']),
+            models.Index(fields=['state', 'latest_expiry_date'])
+        ]
+
+
+def update_user_compliance(user_ids, cert_ids=None):
+    """ Rebuild compliance rows of users, or only the rows of some certs if cert_ids is given """
+
+    with transaction.atomic():
+        # Rebuilds of the same users wait for each other, so each one reads what the last one committed
+        list(AuthUser.objects.select_for_update().filter(id__in=user_ids).order_by('id').values_list('id', flat=True))
+
+        required_certs = LabCert.objects.filter(lab__userlab__user_id__in=user_ids)
+        user_certs = UserCert.objects.filter(user_id__in=user_ids)
+        compliance = UserCompliance.objects.filter(user_id__in=user_ids)
+        if cert_ids is not None:
+            required_certs = required_certs.filter(cert_id__in=cert_ids)
+            user_certs = user_certs.filter(cert_id__in=cert_ids)
+            compliance = compliance.filter(cert_id__in=cert_ids)
+
+        # Certs whose expiry date equals the completion date never expire
+        latest_expiry_dates = {}
+        for uc in user_certs.values('user_id', 'cert_id').annotate(latest_expiry_date=Max('expiry_date', filter=~Q(completion_date=F('expiry_date')))):
+            latest_expiry_dates[(uc['user_id'], uc['cert_id'])] = uc['latest_expiry_date']
+
+        rows = []
+        for user_id, lab_id, cert_id in required_certs.values_list('lab__userlab__user_id', 'lab_id', 'cert_id'):
+            key = (user_id, cert_id)
+            rows.append(UserCompliance(
+                user_id = user_id,
+                lab_id = lab_id,
+                cert_id = cert_id,
+                state = UserCompliance.COMPLETED if key in latest_expiry_dates else UserCompliance.MISSING,
+                latest_expiry_date = latest_expiry_dates.get(key)
+            ))
+
+        compliance.delete()
+        UserCompliance.objects.bulk_create(rows)
+
+
+def rebuild_all_user_compliance():
+    """ Rebuild compliance rows of all users """
+
+    update_user_compliance(AuthUser.objects.values('id'))
+
+
+# Compliance rows are rebuilt once the transaction commits, so cascading
+# deletes of users, labs and certs have finished before they are read again
+
+@receiver([post_save, post_delete], sender=UserCert)
+def update_compliance_by_user_cert(sender, instance, **kwargs):
+    transaction.on_commit(lambda: update_user_compliance([instance.user_id], [instance.cert_id]))
+
+@receiver([post_save, post_delete], sender=UserLab)
+def update_compliance_by_user_lab(sender, instance, **kwargs):
+    transaction.on_commit(lambda: update_user_compliance([instance.user_id]))
+
+@receiver([post_save, post_delete], sender=LabCert)
+def update_compliance_by_lab_cert(sender, instance, **kwargs):
+    transaction.on_commit(lambda: update_user_compliance(UserLab.objects.filter(lab_id=instance.lab_id).values('user_id'), [instance.cert_id]))
+
+
+class Outbox(models.Model):
+    """
+    Keeps track of every email to send. Producers only insert rows, which the
+    send_outbox command (or the scheduler) sends in batches. An email with an
+    idempotency key that has already been queued is never queued again
+    """
+
+    PENDING = 0
+    SENT = 1
+    FAILED = 2
+    SENDING = 3
+
+    STATUS_CHOICES = [ (PENDING, "Pending"), (SENT, "Sent"), (FAILED, "Failed"), (SENDING, "Sending") ]
+
+    idempotency_key = models.CharField(max_length=256, unique=True, null=True, blank=True)
+    sender = models.CharField(max_length=256)
+    receiver = models.CharField(max_length=256)
+    subject = models.CharField(max_length=256)
+    message = models.TextField()
+    status = models.IntegerField(choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created_at'])
+        ]
+
+    def __str__(self):
+        return '{0} - {1}'.format(self.receiver, self.subject)
+
+
+# Results of enqueue_email
+QUEUED = 'queued'
+ALREADY_QUEUED = 'already_queued'
+NOT_QUEUED = 'not_queued'
+
+
+def get_idempotency_key(receiver, subject, message):
+    """ The same email to the same receiver is sent once a day unless a key is given, for automatic producers """
+
+    content = '\n'.join([ date.today().isoformat(), receiver, subject, message ])
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def enqueue_emails(emails):
+    """
+    Queue emails in the outbox, skipping duplicates. Returns the number of emails queued
+    emails: [{ 'receiver': 'First Last <email>', 'subject': '...', 'message': '<html>...', 'key': optional }, ...]
+    """
+
+    if not settings.EMAIL_FROM:
+        return 0
+
+    outboxes = {}
+    for email in emails:
+        key = email.get('key') or get_idempotency_key(email['receiver'], email['subject'], email['message'])
+        outboxes[key] = Outbox(
+            idempotency_key = key,
+            sender = settings.EMAIL_FROM,
+            receiver = email['receiver'],
+            subject = email['subject'],
+            message = email['message']
+        )
+
+    existing_keys = set(Outbox.objects.filter(idempotency_key__in=outboxes.keys()).values_list('idempotency_key', flat=True))
+    new_outboxes = [outbox for key, outbox in outboxes.items() if key not in existing_keys]
+
+    # A concurrent producer may insert the same key in the meantime
+    Outbox.objects.bulk_create(new_outboxes, ignore_conflicts=True)
+    return len(new_outboxes)
+
+
+def get_unique_key():
+    """ A key for an email which an admin sends on purpose, so that sending it again is never deduped """
+    return uuid.uuid4().hex
+
+
+def enqueue_email(receiver, subject, message, key=None):
+    """ Queue one email. Returns QUEUED, ALREADY_QUEUED if its key has been queued before, or NOT_QUEUED if no sender is set """
+
+    if not settings.EMAIL_FROM:
+        return NOT_QUEUED
+
+    queued = enqueue_emails([{ 'receiver': receiver, 'subject': subject, 'message': message, 'key': key }])
+    return QUEUED if queued > 0 else ALREADY_QUEUED
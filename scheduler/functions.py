@@ -1,254 +1,101 @@
 from django.conf import settings
-from django.db.models import Q, F, Max
-from email.mime.text import MIMEText
-import smtplib
+from django.template.loader import render_to_string
 import requests
+import time
 from datetime import date
 
-from lfs_lab_cert_tracker.models import Cert, UserCert, LabCert
-from django.db.models import Q, F, Max, OuterRef, Exists
+from lfs_lab_cert_tracker.models import Cert, UserCert
+from .models import ApiSyncState
 
-from app import functions as appFunc
+from app import mailer
 
 
 # Missing trainings
 
-def get_users_missing_trainings():
-    ''' Get users' missing trainings '''
-
-    has_cert_subquery = UserCert.objects.filter(user=OuterRef('user'), cert=OuterRef('cert'))
-    area_trainings = LabCert.objects.filter(lab__userlab__user__isnull=False).annotate(
-        user=F('lab__userlab__user'),
-        first_name=F('lab__userlab__user__first_name'),
-        last_name=F('lab__userlab__user__last_name'),
-        email=F('lab__userlab__user__email'),
-        is_active=F('lab__userlab__user__is_active')
-    ).filter(
-        Q(is_active=False) &
-        Q(~Exists(has_cert_subquery))
-    ).values(
-        'user',
-        'lab',
-        'cert',
-        'lab__name',
-        'cert__name',
-        'first_name',
-        'last_name',
-        'email'
-    ).distinct()
-
-    users = {}
-    areas = {}
-    if area_trainings.exists():
-        for at in area_trainings.iterator():
-            user_id = str(at['user'])
-            area_id = str(at['lab'])
-
-            if user_id not in users.keys():
-                users[user_id] = {
-                    'first_name': at['first_name'],
-                    'last_name': at['last_name'],
-                    'email': at['email'],
-                    'areas': {}
-                }
-
-            if area_id not in users[user_id]['areas'].keys():
-                users[user_id]['areas'][area_id] = {
-                    'name': at['lab__name'],
-                    'missing_trainings': []
-                }
-
-            users[user_id]['areas'][area_id]['missing_trainings'].append(at['cert__name'])
-
-            if area_id not in areas.keys():
-                areas[area_id] = {}
-
-            if user_id not in areas[area_id].keys():
-                areas[area_id][user_id] = {
-                    'full_name': '{0} {1}'.format(at['first_name'], at['last_name']),
-                    'missing_trainings': []
-                }
-
-            areas[area_id][user_id]['missing_trainings'].append(at['cert__name'])
-
-    return users, areas
-
-
 def get_message_users_missing_trainings(user_id, areas):
     """ Get a message for lab users """
 
-    contents = []
-    for area_id in areas.keys():
-        area = areas[area_id]
-
-        content = '<p>{0}</p><ul>'.format(area['name'])
-        for tr_name in area['missing_trainings']:
-            content += '<li>{0}</li>'.format(tr_name)
-        content += '</ul>'
-
-        contents.append(content)
-
-    message = """\
-        <p>Our records indicate that you have missing training certification(s) required for each area. Please take a moment to update your records at your earliest convenience. Let us know if you need any assistance.</p>
-        <div>
-            {0}
-        </div>
-        <p>See <a href="{1}/app/users/{2}/report.pdf/">User Report</a></p>
-    """.format(''.join(contents), settings.SITE_URL, user_id)
-
-    return message
+    return render_email('users_missing_trainings.html', {
+        'areas': areas.values(),
+        'user_id': user_id
+    })
 
 
 def get_message_pis_missing_trainings(contents):
-    """ Get a message for PIs """
-
-    message = """\
-        <p>Please be advised that the following users have missing required training certification(s) for your area. Kindly review the list and ensure appropriate actions are taken.</p>
-        <div>
-            {0}
-        </div>
-        <p>Let us know if you need any further details or assistance.</p>
-    """.format(contents)
+    """ Get a message for PIs with a list of rendered fragments """
 
-    return message
+    return render_email('pis_missing_trainings.html', { 'contents': contents })
 
 
 
 # Expired trainings
 
-def get_users_with_expired_trainings(target_date, type):
-    ''' Get users with expired trainings '''
-
-    users = {}
-
-    filters = Q(user__is_active=True) & ~Q(completion_date=F('expiry_date'))
-    if type == 'before':
-        filters &= Q(expiry_date=target_date)
-    elif type == 'after':
-        filters &= Q(expiry_date__lt=target_date)
+def get_message_users_expired_trainings(user_id, trainings, days, type):
+    """ Get a message with a list of users for lab users """
 
-    values = ['user', 'cert', 'user__first_name', 'user__last_name', 'user__email', 'cert__name']
+    if type not in ['before', 'after']:
+        return ''
 
-    user_trainings = UserCert.objects.filter(filters).order_by('id')
-    print('========== user trainings:', user_trainings.exists(), user_trainings.count())
+    return render_email('users_expired_trainings.html', {
+        'user_id': user_id,
+        'trainings': trainings,
+        'days': days,
+        'type': type
+    })
 
-    """user_trainings = UserCert.objects.filter(filters).order_by('id').values(*values).annotate(latest_expiry_date=Max('expiry_date'))
-    if user_trainings.exists():
-        for ut in user_trainings.iterator():
-            user_id = str(ut['user'])
-            if user_id not in users.keys():
-                users[user_id] = {
-                    'id': user_id,
-                    'first_name': ut['user__first_name'],
-                    'last_name': ut['user__last_name'],
-                    'email': ut['user__email'],
-                    'expired_trainings': []
-                }
 
-            users[user_id]['expired_trainings'].append({
-                'name': ut['cert__name'],
-                'expiry_date': appFunc.convert_date_to_str(ut['latest_expiry_date'])
-            })"""
+def get_message_pis_expired_trainings(contents, days, type):
+    """ Get a message for PIs and admins with a list of rendered fragments """
 
-    return users
+    if type not in ['before', 'after']:
+        return ''
 
+    return render_email('pis_expired_trainings.html', {
+        'contents': contents,
+        'days': days,
+        'type': type
+    })
 
-def get_message_users_expired_trainings(user_id, trainings, days, type):
-    """ Get a message with a list of users for lab users """
 
-    contents = []
-    for tr in trainings:
-        content = '<li>{0} (Expiry Date: {1})</li>'.format(tr['name'], tr['expiry_date'])
-        contents.append(content)
+# Emails
 
-    message = ''
-    if type == 'before':
-        message = """\
-        <p>This is a friendly reminder that one or more of your trainings will expire in {0} days. Please update these certificates at your earliest convenience.</p>
-        <ul>{1}</ul>
-        <p>See <a href='{2}/app/users/{3}/report.pdf/'>User Report</a></p>
-        """.format(days, ''.join(contents), settings.SITE_URL, user_id)
+def render_email(template_name, context):
+    """ Render an email template, which is parsed once and kept by the cached template loader """
 
-    elif type == 'after':
-        message = """\
-        <p>This is a friendly reminder that your training has passed its expiration date. Please log in and update your training as soon as possible.</p>
-        <ul>{0}</ul>
-        <p>See <a href='{1}/app/users/{2}/report.pdf/'>User Report</a></p>
-        """.format(''.join(contents), settings.SITE_URL, user_id)
+    context.setdefault('site_url', settings.SITE_URL)
+    return render_to_string('scheduler/emails/' + template_name, context)
 
-    return message
 
+def render_user_trainings(users, area_name=None, report_link=False):
+    """ Render a list of users with their trainings, to be shared by every email which includes it """
 
-def get_message_pis_expired_trainings(contents, days, type):
-    """ Get a message with a list of users """
+    return render_email('user_trainings.html', {
+        'users': users,
+        'area_name': area_name,
+        'report_link': report_link
+    })
 
-    message = ''
-    if type == 'before':
-        message = """\
-            <p>Please be advised that the training certifications for the following users in your area will expire in {0} days. Please remind these individuals to complete the necessary renewal process before their certifications expire.</p>
-            <div>
-                {1}
-            </div>
-        """.format(days, contents)
 
-    elif type == 'after':
-        message = """\
-            <p>Please be advised that the training certifications for the following users in your area have already expired. Please remind them to complete their renewal at the earliest convenience to prevent any area access issues.</p>
-            <div>
-                {0}
-            </div>
-        """.format(contents)
+EMAIL_SUBJECT = 'Training Record Notification'
 
-    return message
+def make_email(receiver, template):
+    """ Make an email for the mailer """
+    return { 'receiver': receiver, 'subject': EMAIL_SUBJECT, 'message': template }
 
 
 def send_email(receiver, message):
     """ Send an email with a receiver and a message """
-
-    if settings.EMAIL_FROM:
-        sender = settings.EMAIL_FROM
-
-        msg = MIMEText(message, 'html')
-        msg['Subject'] = 'Training Record Notification'
-        msg['From'] = sender
-        msg['To'] = receiver
-
-        try:
-            server = smtplib.SMTP(settings.EMAIL_HOST)
-            server.sendmail(sender, receiver, msg.as_string())
-        except Exception as e:
-            print(e)
-        finally:
-            server.quit()
+    mailer.send_emails([ make_email(receiver, message) ])
 
 
 def html_template(first_name, last_name, message):
     """ Get a base of html template """
 
-    template = """\
-    <html>
-        <head></head>
-        <body>
-        <p>Hi {0} {1},</p>
-        <div>
-            {2}
-        </div>
-        <br /><br />
-        <div>
-            If you are trying to enroll in a missing or expired training, or to retrieve the training completion record, please visit the following links to get to the appropriate sites:
-            <p>
-                <b>UBC/LFS Mandatory Training</b><br />
-                <a href="https://my.landfood.ubc.ca/lfs-intranet/onboarding/lfs-mandatory-training/">https://my.landfood.ubc.ca/lfs-intranet/onboarding/lfs-mandatory-training/</a>
-            </p>
-        </div>
-        <br />
-        <p>Best regards,</p>
-        <p>LFS Access and Training Record System (LFS ATRS)</p>
-        </body>
-    </html>
-    """.format(first_name, last_name, message)
-
-    return template
+    return render_email('base.html', {
+        'first_name': first_name,
+        'last_name': last_name,
+        'message': message
+    })
 
 
 def get_receiver(first_name, last_name, email):
@@ -260,84 +107,158 @@ def get_receiver(first_name, last_name, email):
 # API service
 
 
-def get_next_url(curr_page):
-    return '{0}?page={1}&pageSize={2}'.format(settings.LFS_LAB_CERT_TRACKER_API_URL, curr_page, 50)
+def get_api_setting(name, default):
+    return getattr(settings, 'LFS_LAB_CERT_TRACKER_API_' + name, default)
 
 
-def get_expiry_date(completion_date, cert):
-    expiry_year = completion_date.year + int(cert.expiry_in_years)
-    return date(year=expiry_year, month=completion_date.month, day=completion_date.day)
+def get_next_url(curr_page, page_size=None):
+    if page_size is None:
+        page_size = get_api_setting('PAGE_SIZE', 50)
+    return '{0}?page={1}&pageSize={2}'.format(settings.LFS_LAB_CERT_TRACKER_API_URL, curr_page, page_size)
 
 
-def pull_by_api(headers, usernames, form_checking, multiple_trainings):
-    user_trainings = []
+def get_api_session(headers):
+    """ Get a session which keeps connections to the API open across requests and threads """
+
+    session = requests.Session()
+    session.headers.update(headers)
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=get_api_setting('MAX_WORKERS', 4))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def post_with_retry(session, limiter, url, body):
+    """ Post to the API, retrying errors and non-200 responses with backoff. Returns None if all attempts failed """
+
+    max_retries = get_api_setting('MAX_RETRIES', 3)
+    backoff = get_api_setting('RETRY_BACKOFF', 1)
+
+    for attempt in range(max_retries + 1):
+        if attempt > 0:
+            time.sleep(backoff * 2 ** (attempt - 1))
 
+        limiter.wait()
+        try:
+            res = session.post(url, json=body, timeout=get_api_setting('TIMEOUT', 60))
+        except requests.RequestException as e:
+            print('Error occurred:', e)
+            continue
+
+        if res.status_code == 200:
+            return res
+        print('Error occurred:', res.status_code)
+
+    return None
+
+
+def fetch_by_api(session, limiter, usernames):
+    """ Get the training items of usernames, walking through all pages. Returns None if a page failed """
+
+    items = []
     body = {'requestIdentifiers': [{'identifierType': 'CWL', 'identifier': username} for username in usernames]}
     next_url = get_next_url(1)
     hasNextPage = True
 
     while hasNextPage:
-        res = requests.post(next_url, json=body, headers=headers)
-        if res.status_code != 200:
-            print('Error occurred:', res.status_code)
-            break
+        res = post_with_retry(session, limiter, next_url, body)
+        if res is None:
+            return None
 
         json = res.json()
         if 'page' not in json.keys() or 'pageSize' not in json.keys() or 'hasNextPage' not in json.keys() or 'pageItems' not in json.keys():
             print('Error: page, pageSize, hasNextPage and pageItems are required.')
-            break
-
-        for item in json['pageItems']:
-            if 'requestedIdentifier' not in item.keys() or 'certificate' not in item.keys() or 'identifier' not in item['requestedIdentifier'].keys() or 'trainingName' not in item['certificate'].keys() or 'trainingId' not in item['certificate'].keys() or 'completionDate' not in item['certificate'].keys():
-                print('Warning: no requestedIdentifier, certificate, identifier, trainingName or completionDate')
-                continue
-
-            username = item['requestedIdentifier']['identifier']
-            training_name = item['certificate']['trainingName'].strip()
-            training_id = str(item['certificate']['trainingId']).strip()
-            completion_date = item['certificate']['completionDate'].split('T')[0].split('-')
-
-            if item['certificate']['status'] == 'active' and len(completion_date) == 3:
-                completion_date = date(year=int(completion_date[0]), month=int(completion_date[1]), day=int(completion_date[2]))
-                user = appFunc.get_user_by_username(username)
-
-                training = None
-                found_training = Cert.objects.filter(unique_id__iexact=training_id)
-                if found_training.exists():
-                    training = found_training.first()
-                else:
-                    if multiple_trainings.exists():
-                        for tr in multiple_trainings:
-                            unique_ids = tr.unique_id.split(',')
-                            for uid in unique_ids:
-                                if training_id == uid.strip():
-                                    training = tr
-                                    break
-                            if training:
-                                break
-
-                if user and training:
-                    form = '{0}_{1}_{2}'.format(user.id, training.id, completion_date)
-                    user_certs = user.usercert_set.filter(cert_id=training.id, completion_date=completion_date)
-                    if not user_certs.exists() and form not in form_checking:
-                        user_trainings.append(UserCert(
-                            user = user,
-                            cert = training,
-                            cert_file = 'None',
-                            uploaded_date = date.today(),
-                            completion_date = completion_date,
-                            expiry_date = get_expiry_date(completion_date, training),
-                            by_api = True
-                        ))
-
-                        form_checking.append(form)
-            else:
-                print('Warning: completion date is wrong, or status is not active:', username, training_name)
+            return None
+
+        items += json['pageItems']
 
         hasNextPage = json['hasNextPage']
         next_url = get_next_url(int(json['page']) + 1)
 
-    return user_trainings, form_checking
+    return items
+
+
+def get_expiry_date(completion_date, cert):
+    expiry_year = completion_date.year + int(cert.expiry_in_years)
+    return date(year=expiry_year, month=completion_date.month, day=completion_date.day)
+
+
+def get_certs_by_unique_id():
+    """ Get a map of a normalized unique_id to a cert, including each ID of comma-separated unique_ids """
+
+    certs = {}
+    multiple_trainings = []
+    for cert in Cert.objects.filter(unique_id__isnull=False).exclude(unique_id=''):
+        certs.setdefault(cert.unique_id.strip().lower(), cert)
+        if ',' in cert.unique_id:
+            multiple_trainings.append(cert)
+
+    # A cert whose whole unique_id matches takes precedence over one of multiple IDs
+    for cert in multiple_trainings:
+        for uid in cert.unique_id.split(','):
+            certs.setdefault(uid.strip().lower(), cert)
+
+    return certs
+
+
+def get_existing_user_trainings(user_ids):
+    """ Get a set of (user_id, cert_id, completion_date) of the users' trainings """
+    return set(UserCert.objects.filter(user_id__in=user_ids).values_list('user_id', 'cert_id', 'completion_date'))
+
+
+def save_sync_state(users, synced_at):
+    """ Mark users as synced """
+
+    ApiSyncState.objects.bulk_create(
+        [ApiSyncState(user=user, last_synced_at=synced_at) for user in users],
+        update_conflicts=True,
+        unique_fields=['user'],
+        update_fields=['last_synced_at']
+    )
+
+
+def pull_by_api(items, users, certs, existing):
+    """
+    Get new user trainings from the training items of the API
+    users: { username: user }, certs: { unique_id: cert }, existing: { (user_id, cert_id, completion_date) }
+    New trainings are added to existing, so that duplicates across batches are skipped
+    """
+
+    user_trainings = []
+
+    for item in items:
+        if 'requestedIdentifier' not in item.keys() or 'certificate' not in item.keys() or 'identifier' not in item['requestedIdentifier'].keys() or 'trainingName' not in item['certificate'].keys() or 'trainingId' not in item['certificate'].keys() or 'completionDate' not in item['certificate'].keys():
+            print('Warning: no requestedIdentifier, certificate, identifier, trainingName or completionDate')
+            continue
+
+        username = item['requestedIdentifier']['identifier']
+        training_name = item['certificate']['trainingName'].strip()
+        training_id = str(item['certificate']['trainingId']).strip()
+        completion_date = item['certificate']['completionDate'].split('T')[0].split('-')
+
+        if item['certificate']['status'] == 'active' and len(completion_date) == 3:
+            completion_date = date(year=int(completion_date[0]), month=int(completion_date[1]), day=int(completion_date[2]))
+            user = users.get(username)
+            training = certs.get(training_id.lower())
+
+            if user and training:
+                key = (user.id, training.id, completion_date)
+                if key not in existing:
+                    user_trainings.append(UserCert(
+                        user = user,
+                        cert = training,
+                        cert_file = 'None',
+                        uploaded_date = date.today(),
+                        completion_date = completion_date,
+                        expiry_date = get_expiry_date(completion_date, training),
+                        by_api = True
+                    ))
+
+                    existing.add(key)
+        else:
+            print('Warning: completion date is wrong, or status is not active:', username, training_name)
+
+    return user_trainings
 
 
 # def find_cert(training_name):
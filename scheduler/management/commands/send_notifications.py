@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+from datetime import date
+
+from scheduler import notifications
+
+
+class Command(BaseCommand):
+    help = 'Send reminders of missing and expired trainings to users, PIs and admins'
+
+    def add_arguments(self, parser):
+        parser.add_argument('rules', nargs='*', help='Rules to run, all rules by default: {0}'.format(', '.join(notifications.RULES.keys())))
+        parser.add_argument('--audience', action='append', choices=notifications.AUDIENCES, help='Send to this audience only, can be repeated')
+        parser.add_argument('--dry-run', action='store_true', help='Print the receivers instead of sending emails')
+        parser.add_argument('--limit', type=int, help='Maximum number of emails for each rule')
+        parser.add_argument('--since', type=date.fromisoformat, help='Only include trainings which expired on or after this date (YYYY-MM-DD), or users who joined on or after it for missing trainings')
+
+    def handle(self, *args, **options):
+        for name in options['rules']:
+            if name not in notifications.RULES.keys():
+                raise CommandError('Unknown rule: {0}'.format(name))
+
+        for name in options['rules'] or notifications.RULES.keys():
+            emails = notifications.run(name, audiences=options['audience'], since=options['since'], limit=options['limit'], dry_run=options['dry_run'])
+            self.stdout.write('{0}: {1} emails'.format(name, len(emails)))
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:06
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lfs_lab_cert_tracker', '0010_outbox_idempotency_key'),
+        ('scheduler', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rule', models.CharField(max_length=64)),
+                ('audiences', models.CharField(max_length=64)),
+                ('started_at', models.DateTimeField()),
+                ('num_users', models.IntegerField(default=0)),
+                ('num_emails', models.IntegerField(default=0)),
+                ('num_skipped', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='NotificationLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recipient', models.CharField(max_length=256)),
+                ('rule', models.CharField(max_length=64)),
+                ('expiry_date', models.DateField(blank=True, null=True)),
+                ('digest', models.CharField(max_length=64)),
+                ('sent_at', models.DateTimeField()),
+                ('cert', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='lfs_lab_cert_tracker.cert')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['rule', 'sent_at'], name='scheduler_n_rule_d5b589_idx')],
+            },
+        ),
+    ]
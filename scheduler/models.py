@@ -0,0 +1,54 @@
+from django.db import models
+from django.contrib.auth.models import User as AuthUser
+
+
+class ApiSyncState(models.Model):
+    """
+    Keeps track of the training API sync of each user. Users synced recently are
+    skipped, so a sync that stopped halfway resumes with the users it has not
+    reached yet
+    """
+
+    user = models.OneToOneField(AuthUser, on_delete=models.CASCADE)
+    last_synced_at = models.DateTimeField()
+
+    def __str__(self):
+        return '{0} - {1}'.format(self.user.username, self.last_synced_at)
+
+
+class NotificationLog(models.Model):
+    """
+    A ledger of the trainings each recipient has been reminded of by a rule. The digest
+    is a hash of every (user, cert, expiry_date) in the email, so a recipient whose digest
+    has not changed is not reminded again until the cool-down has passed
+    """
+
+    recipient = models.CharField(max_length=256)
+    rule = models.CharField(max_length=64)
+    user = models.ForeignKey(AuthUser, on_delete=models.CASCADE)
+    cert = models.ForeignKey('lfs_lab_cert_tracker.Cert', on_delete=models.CASCADE)
+    expiry_date = models.DateField(null=True, blank=True)
+    digest = models.CharField(max_length=64)
+    sent_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['rule', 'sent_at'])
+        ]
+
+    def __str__(self):
+        return '{0} - {1} - {2}'.format(self.rule, self.recipient, self.sent_at)
+
+
+class NotificationRun(models.Model):
+    """ A summary of each run of a notification rule """
+
+    rule = models.CharField(max_length=64)
+    audiences = models.CharField(max_length=64)
+    started_at = models.DateTimeField()
+    num_users = models.IntegerField(default=0)
+    num_emails = models.IntegerField(default=0)
+    num_skipped = models.IntegerField(default=0)
+
+    def __str__(self):
+        return '{0} - {1}'.format(self.rule, self.started_at)
@@ -0,0 +1,385 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+from datetime import date, timedelta
+import hashlib
+from abc import ABC, abstractmethod
+
+from lfs_lab_cert_tracker.models import LabCert, UserLab, enqueue_emails
+from app import functions as appFunc
+from app import mailer
+from . import functions as func
+from .models import NotificationLog, NotificationRun
+
+
+AUDIENCES = ['users', 'pis', 'admins']
+
+
+# Rules
+
+# The message builder which a rule must provide for each of its audiences
+MESSAGE_BUILDERS = {
+    'users': 'get_message_user',
+    'pis': 'get_message_pis',
+    'admins': 'get_message_admins'
+}
+
+
+class Rule(ABC):
+    """
+    A kind of reminder, which finds the trainings to remind of in one query.
+    A rule provides a message builder for each of its audiences, e.g. get_message_user(user) for users
+    and get_message_pis(contents) for PIs
+    """
+
+    audiences = AUDIENCES
+
+    def __init__(self, audiences=None):
+        if audiences is not None:
+            self.audiences = audiences
+
+        for audience in self.audiences:
+            if not hasattr(self, MESSAGE_BUILDERS[audience]):
+                raise TypeError('{0} has no {1} for the {2} audience'.format(type(self).__name__, MESSAGE_BUILDERS[audience], audience))
+
+    @abstractmethod
+    def get_records(self, today, since=None):
+        """
+        Get a record of each (user, cert, area) to remind of, ordered by user and cert name.
+        The area is None if no area of the user requires the cert
+        """
+
+
+class ExpiryRule(Rule):
+    """ Remind of the latest records of trainings which expire on a target date or have expired """
+
+    days = None
+    type = None
+
+    @abstractmethod
+    def filter(self, user_certs, today):
+        """ Filter the latest records of trainings to remind of """
+
+    def get_records(self, today, since=None):
+        user_certs = self.filter(appFunc.get_latest_user_certs(User.objects.filter(is_active=True).values('id')), today)
+        if since is not None:
+            user_certs = user_certs.filter(expiry_date__gte=since)
+
+        # Each record is joined with the areas of its user, and areas which do not require the cert are dropped
+        required = set(LabCert.objects.values_list('lab_id', 'cert_id'))
+        user_certs = user_certs.values(
+            'user', 'user__first_name', 'user__last_name', 'user__email', 'cert', 'cert__name', 'expiry_date', 'user__userlab__lab', 'user__userlab__lab__name'
+        ).order_by('user__last_name', 'user__first_name', 'user', 'cert__name')
+
+        for uc in user_certs.iterator(chunk_size=2000):
+            lab_id = uc['user__userlab__lab']
+            is_required = (lab_id, uc['cert']) in required
+            yield {
+                'user': uc['user'],
+                'first_name': uc['user__first_name'],
+                'last_name': uc['user__last_name'],
+                'email': uc['user__email'],
+                'cert': uc['cert'],
+                'cert_name': uc['cert__name'],
+                'expiry_date': uc['expiry_date'],
+                'lab': lab_id if is_required else None,
+                'lab_name': uc['user__userlab__lab__name'] if is_required else None
+            }
+
+    def get_message_user(self, user):
+        return func.get_message_users_expired_trainings(user['id'], user['trainings'], self.days, self.type)
+
+    def get_message_pis(self, contents):
+        return func.get_message_pis_expired_trainings(contents, self.days, self.type)
+
+    def get_message_admins(self, contents):
+        return func.get_message_pis_expired_trainings(contents, self.days, self.type)
+
+
+class BeforeExpiryRule(ExpiryRule):
+    """ Remind of trainings which expire in a number of days """
+
+    type = 'before'
+
+    def __init__(self, days, audiences=None):
+        super().__init__(audiences)
+        self.days = days
+
+    def filter(self, user_certs, today):
+        return user_certs.filter(expiry_date=today + timedelta(days=self.days))
+
+
+class AfterExpiryRule(ExpiryRule):
+    """ Remind of trainings which have expired """
+
+    type = 'after'
+
+    def filter(self, user_certs, today):
+        return user_certs.filter(expiry_date__lt=today)
+
+
+class MissingRule(Rule):
+    """ Remind of trainings which are required by an area but have not been uploaded """
+
+    audiences = ['users', 'pis']
+
+    def get_records(self, today, since=None):
+        compliance = appFunc.get_missing_compliance().filter(user__is_active=True)
+        if since is not None:
+            compliance = compliance.filter(user__date_joined__date__gte=since)
+
+        compliance = compliance.values(
+            'user', 'user__first_name', 'user__last_name', 'user__email', 'cert', 'cert__name', 'lab', 'lab__name'
+        ).order_by('user__last_name', 'user__first_name', 'user', 'cert__name')
+
+        for uc in compliance.iterator(chunk_size=2000):
+            yield {
+                'user': uc['user'],
+                'first_name': uc['user__first_name'],
+                'last_name': uc['user__last_name'],
+                'email': uc['user__email'],
+                'cert': uc['cert'],
+                'cert_name': uc['cert__name'],
+                'expiry_date': None,
+                'lab': uc['lab'],
+                'lab_name': uc['lab__name']
+            }
+
+    def get_message_user(self, user):
+        areas = {}
+        for area_id, area in user['areas'].items():
+            areas[area_id] = { 'name': area['name'], 'missing_trainings': [tr['name'] for tr in area['trainings']] }
+        return func.get_message_users_missing_trainings(user['id'], areas)
+
+    def get_message_pis(self, contents):
+        return func.get_message_pis_missing_trainings(contents)
+
+
+RULES = {
+    'before_expiry': BeforeExpiryRule(30, audiences=['users', 'pis']),
+    'before_expiry_admins': BeforeExpiryRule(14, audiences=['admins']),
+    'after_expiry': AfterExpiryRule(),
+    'missing': MissingRule()
+}
+
+
+# Engine
+
+def collect(records):
+    """ Group records by user, and by area and user, in one pass """
+
+    users = {}
+    areas = {}
+    for record in records:
+        training = {
+            'key': (record['user'], record['cert'], record['expiry_date']),
+            'name': record['cert_name'],
+            'expiry_date': appFunc.convert_date_to_str(record['expiry_date']) if record['expiry_date'] else None
+        }
+
+        user = users.get(record['user'])
+        if user is None:
+            user = users[record['user']] = {
+                'id': record['user'],
+                'first_name': record['first_name'],
+                'last_name': record['last_name'],
+                'email': record['email'],
+                'certs': set(),
+                'trainings': [],
+                'areas': {}
+            }
+        if record['cert'] not in user['certs']:
+            user['certs'].add(record['cert'])
+            user['trainings'].append(training)
+
+        if record['lab'] is not None:
+            user['areas'].setdefault(record['lab'], { 'name': record['lab_name'], 'trainings': [] })['trainings'].append(training)
+
+            area = areas.setdefault(record['lab'], { 'name': record['lab_name'], 'users': {} })
+            area_user = area['users'].get(record['user'])
+            if area_user is None:
+                area_user = area['users'][record['user']] = {
+                    'id': record['user'],
+                    'first_name': record['first_name'],
+                    'last_name': record['last_name'],
+                    'trainings': []
+                }
+            area_user['trainings'].append(training)
+
+    return users, areas
+
+
+def get_items(trainings):
+    """ Get the (user, cert, expiry_date) of each training in an email """
+    return [ training['key'] for training in trainings ]
+
+
+def get_user_emails(rule, users, ledger):
+    emails = []
+    for user in users.values():
+        if appFunc.check_email_valid(user['email']):
+            items = get_items(user['trainings'])
+            if ledger.is_recent(user['email'], 'users', items):
+                continue
+
+            receiver = func.get_receiver(user['first_name'], user['last_name'], user['email'])
+            template = func.html_template(user['first_name'], user['last_name'], rule.get_message_user(user))
+            emails.append(ledger.add(func.make_email(receiver, template), user['email'], 'users', items))
+        else:
+            print('{} is not valid.'.format(user['email']))
+    return emails
+
+
+def get_pi_emails(rule, areas, ledger):
+    """ Get one email for each PI covering all of their areas, where each area's list is rendered once """
+
+    contents = {}
+    pis = {}
+    for pi in UserLab.objects.filter(lab_id__in=areas.keys(), role=UserLab.PRINCIPAL_INVESTIGATOR, user__is_active=True).select_related('user', 'lab').order_by('lab__name'):
+        pis.setdefault(pi.user_id, { 'user': pi.user, 'areas': [] })['areas'].append(pi.lab)
+
+    emails = []
+    for pi in pis.values():
+        user = pi['user']
+        if appFunc.check_email_valid(user.email):
+            items = []
+            for area in pi['areas']:
+                for area_user in areas[area.id]['users'].values():
+                    items += get_items(area_user['trainings'])
+            if ledger.is_recent(user.email, 'pis', items):
+                continue
+
+            for area in pi['areas']:
+                if area.id not in contents.keys():
+                    contents[area.id] = func.render_user_trainings(areas[area.id]['users'].values(), area_name=area.name)
+
+            receiver = func.get_receiver(user.first_name, user.last_name, user.email)
+            template = func.html_template(user.first_name, user.last_name, rule.get_message_pis([ contents[area.id] for area in pi['areas'] ]))
+            emails.append(ledger.add(func.make_email(receiver, template), user.email, 'pis', items))
+        else:
+            print('{} is not valid.'.format(user.email))
+    return emails
+
+
+def get_admin_emails(rule, users, ledger):
+    """ Get an email for each admin, which is rendered once for all admins """
+
+    items = []
+    for user in users.values():
+        items += get_items(user['trainings'])
+
+    template = None
+    emails = []
+    for admin in User.objects.filter(is_active=True, is_superuser=True).order_by('id'):
+        if appFunc.check_email_valid(admin.email) and not ledger.is_recent(admin.email, 'admins', items):
+            if template is None:
+                contents = func.render_user_trainings(users.values(), report_link=True)
+                template = func.html_template('LFS TRMS', 'administrators', rule.get_message_admins([ contents ]))
+
+            emails.append(ledger.add(func.make_email(func.get_receiver(admin.first_name, admin.last_name, admin.email), template), admin.email, 'admins', items))
+    return emails
+
+
+# Ledger
+
+def get_cooldown_days():
+    """ Days during which a recipient is not reminded of the same trainings again """
+    return getattr(settings, 'NOTIFICATION_COOLDOWN_DAYS', 28)
+
+
+class Ledger:
+    """ Skip recipients whose digest has not changed since they were reminded within the cool-down """
+
+    def __init__(self, name, now):
+        self.name = name
+        self.now = now
+        self.num_skipped = 0
+        self.recent = set(
+            NotificationLog.objects.filter(rule=name, sent_at__gte=now - timedelta(days=get_cooldown_days())).values_list('recipient', 'digest').distinct()
+        )
+
+    def get_digest(self, audience, items):
+        content = '|'.join(
+            '{0}:{1}:{2}'.format(user_id, cert_id, expiry_date.isoformat() if expiry_date else '') for user_id, cert_id, expiry_date in sorted(set(items), key=str)
+        )
+        return hashlib.sha256('{0}|{1}|{2}'.format(self.name, audience, content).encode('utf-8')).hexdigest()
+
+    def is_recent(self, recipient, audience, items):
+        if (recipient.lower(), self.get_digest(audience, items)) in self.recent:
+            self.num_skipped += 1
+            return True
+        return False
+
+    def add(self, email, recipient, audience, items):
+        """ Keep the ledger entries of an email with it, to be saved once the email is queued """
+
+        email['ledger'] = (recipient.lower(), self.get_digest(audience, items), set(items))
+        return email
+
+    def save(self, emails):
+        logs = []
+        for email in emails:
+            recipient, digest, items = email['ledger']
+            for user_id, cert_id, expiry_date in items:
+                logs.append(NotificationLog(
+                    recipient=recipient,
+                    rule=self.name,
+                    user_id=user_id,
+                    cert_id=cert_id,
+                    expiry_date=expiry_date,
+                    digest=digest,
+                    sent_at=self.now
+                ))
+        NotificationLog.objects.bulk_create(logs, batch_size=1000)
+
+
+def run(name, audiences=None, today=None, since=None, limit=None, dry_run=False):
+    """ Send the reminders of a rule to its audiences. Returns the emails, which are only printed in a dry run """
+
+    rule = RULES[name]
+    if audiences is None:
+        audiences = rule.audiences
+    else:
+        for audience in audiences:
+            if audience not in rule.audiences:
+                print('Notifications: {0} - not sent to {1}, which is not an audience of this rule'.format(name, audience))
+        audiences = [audience for audience in audiences if audience in rule.audiences]
+    if today is None:
+        today = date.today()
+
+    started_at = timezone.now()
+    ledger = Ledger(name, started_at)
+    users, areas = collect(rule.get_records(today, since))
+
+    emails = []
+    if len(users.keys()) > 0:
+        if 'users' in audiences:
+            emails += get_user_emails(rule, users, ledger)
+        if 'pis' in audiences and len(areas.keys()) > 0:
+            emails += get_pi_emails(rule, areas, ledger)
+        if 'admins' in audiences:
+            emails += get_admin_emails(rule, users, ledger)
+
+    if limit is not None:
+        emails = emails[:limit]
+
+    if dry_run:
+        for email in emails:
+            print('Dry run: {0} to {1}'.format(name, email['receiver']))
+    else:
+        with transaction.atomic():
+            enqueue_emails(emails)
+            ledger.save(emails)
+            NotificationRun.objects.create(
+                rule=name,
+                audiences=','.join(audiences),
+                started_at=started_at,
+                num_users=len(users.keys()),
+                num_emails=len(emails),
+                num_skipped=ledger.num_skipped
+            )
+        mailer.send_pending()
+
+    print('Notifications: {0} - {1} users, {2} areas, {3} emails, {4} skipped'.format(name, len(users.keys()), len(areas.keys()), len(emails), ledger.num_skipped))
+    return emails